@@ -0,0 +1,170 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+
+import numpy as np
+
+
+class evcache:
+    """
+    On disk cache of the filtered eigenvalues of gene SNP-SNP correlation matrices. 
+    
+    The eigenvalues only depend on the reference panel, the scoring settings and the set of SNPs passing the filters, but not on the GWAS p-values. Scoring several GWAS against the same reference panel can therefore skip the LD computation for genes seen before.
+    
+    Entries are stored as one .npy file each, sharded into subdirectories by key. The total size is bounded: if exceeded, the least recently used entries (by file modification time, refreshed on every hit) are removed until the cache is filled to 80% of its size limit. The cache can be shared by several processes.
+    
+    """
+    def __init__(self,path,maxsize=2**30):
+        """
+        Args:
+        
+            path(string): Directory of the cache (created if not exists)
+            maxsize(int): Max size of the cache in bytes
+        """
+        self._path = path
+        self._maxsize = maxsize
+        
+        os.makedirs(path,exist_ok=True)
+        
+        self._size = sum([x[2] for x in self._entries()])
+        
+    def key(self,*args):
+        """
+        Returns the cache key for a set of values (SNP ids, settings, ...)
+        """
+        h = hashlib.sha1()
+        
+        for x in args:
+            if isinstance(x,np.ndarray):
+                h.update(x.tobytes())
+            elif isinstance(x,(list,tuple)):
+                h.update('\t'.join([str(y) for y in x]).encode())
+            else:
+                h.update(str(x).encode())
+                
+            h.update(b'\n')
+            
+        return h.hexdigest()
+    
+    def _file(self,key):
+        return os.path.join(self._path,key[:2],key+'.npy')
+    
+    def get(self,key):
+        """
+        Returns the cached eigenvalues for a key (None if not cached)
+        
+        Args:
+        
+            key(string): Key (see key)
+        """
+        fn = self._file(key)
+        
+        try:
+            L = np.load(fn)
+            
+            # Mark as recently used
+            os.utime(fn)
+        except (OSError,ValueError):
+            return None
+            
+        return L
+        
+    def put(self,key,L):
+        """
+        Stores eigenvalues 
+        
+        Args:
+        
+            key(string): Key (see key)
+            L(list): Eigenvalues
+        """
+        fn = self._file(key)
+        
+        os.makedirs(os.path.dirname(fn),exist_ok=True)
+        
+        tmp = fn+'.'+str(os.getpid())+'.tmp'
+        with open(tmp,'wb') as f:
+            np.save(f,np.asarray(L,dtype='float64'))
+            
+        os.replace(tmp,fn)
+        
+        self._size += os.path.getsize(fn)
+        
+        if self._size > self._maxsize:
+            self._evict()
+        
+    def _entries(self):
+        """
+        Returns the cached entries as [file, modification time, size]
+        """
+        E = []
+        
+        for d in os.scandir(self._path):
+            if d.is_dir():
+                for f in os.scandir(d.path):
+                    if f.name.endswith('.npy'):
+                        try:
+                            s = f.stat()
+                            E.append([f.path,s.st_mtime_ns,s.st_size])
+                        except FileNotFoundError:
+                            pass
+                            
+        return E
+        
+    def _evict(self):
+        """
+        Removes the least recently used entries
+        """
+        E = self._entries()
+        E.sort(key=lambda x: x[1])
+        
+        size = sum([x[2] for x in E])
+        
+        for x in E:
+            if size <= 0.8*self._maxsize:
+                break
+                
+            try:
+                os.remove(x[0])
+            except FileNotFoundError:
+                pass
+            
+            size -= x[2]
+        
+        self._size = size
+        
+    def size(self):
+        """
+        Returns the current size of the cache in bytes
+        """
+        return sum([x[2] for x in self._entries()])
+    
+    def clear(self):
+        """
+        Removes all entries
+        """
+        for x in self._entries():
+            try:
+                os.remove(x[0])
+            except FileNotFoundError:
+                pass
+                
+        self._size = 0
@@ -17,7 +17,7 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from PascalX import wchissum,snpdb,tools,refpanel,genome,hpstats
+from PascalX import wchissum,snpdb,tools,refpanel,genome,hpstats,gwas,evcache
 from PascalX.mapper import mapper
 
 import gzip
@@ -38,6 +38,7 @@ import sys
 import os.path
 
 from scipy.stats import norm
+from scipy.sparse.linalg import eigsh, ArpackNoConvergence, ArpackError
 
 from sortedcontainers import SortedSet
 
@@ -52,6 +53,18 @@ try:
 except ModuleNotFoundError:
     cp = None
 
+
+def _ldkeys(X):
+    # Keys of the SNPs of a gene in the correlation tile cache
+    return list(zip(X['pos'].tolist(),X['rsid'].tolist()))
+
+
+def _chi2stats(rsid,p):
+    # SNP id -> (p-value, chi2 statistic of the p-value)
+    p = np.asarray(p,dtype='float64')
+    
+    return dict(zip(rsid,zip(p.tolist(),tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(p).tolist())))
+
     
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -72,7 +85,7 @@ class genescorer(ABC):
         pass
     
     
-    def load_refpanel(self, filename, parallel=1,keepfile=None,qualityT=100,SNPonly=False,chrlist=None):
+    def load_refpanel(self, filename, parallel=1,keepfile=None,qualityT=100,SNPonly=False,chrlist=None,columnar=False,subsetcache=False,membudget=None,lazy=False):
         """
         Sets the reference panel to use
         
@@ -81,18 +94,22 @@ class genescorer(ABC):
             filename(string): /path/filename (without .chr#.db ending)
             parallel(int): Number of cores to use for parallel import of reference panel
             
-            keepfile: File with sample ids (one per line) to keep (only for .vcf) 
+            keepfile: File with sample ids (one per line) to keep (only for .vcf and .bed) 
             qualityT: Quality threshold for variant to keep (only for .vcf)
-            SNPonly : Import only SNPs (only for .vcf)
+            SNPonly : Import only SNPs (only for .vcf and .bed)
             chrlist(list): List of chromosomes to import. (None to import 1-22)
+            columnar(bool|string): Convert the reference panel into memory mapped columnar storage (.chr#.cdb). Set to 'packed' for 2-bit packed genotypes.
+            subsetcache(bool): Materialise sample subsets (keep_idx) once as columnar storages on disk, keyed by a hash of keep_idx
+            membudget(int): Memory budget (bytes) for importing the reference panel (None for no limit)
+            lazy(bool): Read not imported chromosomes on demand from bgzipped and tabix indexed .chr#.vcf.gz files instead of importing them
             
         Note:
         
-            One file per chromosome with ending .chr#.db required (#: 1-22). If imported reference panel is not present, PascalX will automatically try to import from .chr#.tped.gz or .chr#.vcf.gz files.
+            One file per chromosome with ending .chr#.db required (#: 1-22). If imported reference panel is not present, PascalX will automatically try to import from .chr#.tped.gz, .chr#.vcf.gz or PLINK .chr#.bed/.bim/.fam files.
             
         """
         self._ref = refpanel.refpanel()
-        self._ref.set_refpanel(filename=filename,parallel=parallel,keepfile=keepfile,qualityT=qualityT,SNPonly=SNPonly,chrlist=chrlist)
+        self._ref.set_refpanel(filename=filename,parallel=parallel,keepfile=keepfile,qualityT=qualityT,SNPonly=SNPonly,chrlist=chrlist,columnar=columnar,subsetcache=subsetcache,membudget=membudget,lazy=lazy)
 
     
     def load_genome(self,file,ccol=1,cid=0,csymb=5,cstx=2,cetx=3,cs=4,cb=None,chrStart=0,splitchr='\t',NAgeneid='n/a',useNAgenes=False,header=False):
@@ -199,54 +216,42 @@ class genescorer(ABC):
         self._GWAS_beta = {}
         self._GWAS_alleles = {}
         
-        if file[-3:] == '.gz':
-            f = gzip.open(file,'rt')
-        else:
-            f = open(file,'rt')
-            
-        if header:
-            f.readline()
+        T = gwas.gwas()
+        T.load_gwas(file,rscol,pcol,bcol,a1col,a2col,delimiter=delimiter,header=header,NAid=NAid)
         
+        # Threshold very small SNPs (1e-300 recommended for numerical stability)
         c = 0
-        for line in f:
-            if delimiter is None:
-                L = line.split()
-            else:
-                L = line.split(delimiter)
-
-            if L[pcol] != NAid and L[rscol] != NAid:
-                p = float(L[pcol])
-                
-                # Threshold very small SNPs (1e-300 recommended for numerical stability)
-                if cutoff is not None and p < cutoff:
-                    p = cutoff
-                    c +=1
-                    
-                if log10p:
-                    p = 10**(-p)
-                    
-                if p > 0 and p < 1 and L[rscol][:2]=='rs':
-                    self._GWAS[L[rscol]] = p
-                else:
-                    continue
-            else:
-                continue
-                    
-            if bcol is not None:
-                b = float(L[bcol])
-                self._GWAS_beta[L[rscol]] = b
-              
-            if a1col is not None and a2col is not None:
-                self._GWAS_alleles[L[rscol]] = [L[a1col].upper(),L[a2col].upper()]
+        if cutoff is not None:
+            M = T.p < cutoff
+            c = int(np.sum(M))
+            T.p[M] = cutoff
             
-        f.close()
+        if log10p:
+            T.p = 10**(-T.p)
+            
+        T = T.take((T.p > 0) & (T.p < 1) & (T.rsid.astype('U2') == 'rs')).unique()
+        
+        self._GWAS_table = T
+        
+        rsid = T.rsid.tolist()
+        
+        self._GWAS = dict(zip(rsid,T.p.tolist()))
+        
+        # Per SNP chi2 statistics of the p-values
+        self._GWAS_chi2 = _chi2stats(rsid,T.p)
+        
+        if bcol is not None:
+            self._GWAS_beta = dict(zip(rsid,T.beta.tolist()))
+            
+        if T.alleles is not None:
+            self._GWAS_alleles = dict(zip(rsid,T.alleles.tolist()))
 
         if c > 0:
             print(c,"SNPs cutoff to",cutoff)
                 
         print(len(self._GWAS),"SNPs loaded")
         
-    def matchAlleles(self, SNPonly=False):
+    def matchAlleles(self, SNPonly=False, parallel=1):
         """
         Matches alleles between loaded GWAS and reference panel 
         (SNPs with non matching alleles are removed)
@@ -254,47 +259,38 @@ class genescorer(ABC):
         Args:
         
             SNPonly(bool) : Keep only SNPs
+            parallel(int) : Number of cores to use for building the allele table of the reference panel (only once per panel)
             
         """
-        db = {}
-        for i in range(1,23):
-            db[i] = self._ref.load_snp_reference(i)
-    
-        todel = []
-        Nr = 0
-        Ns = 0
-        N = 0
-        for x in self._GWAS_alleles:
-            N += 1
-            found = False
-            
-            A = self._GWAS_alleles[x]
-            if SNPonly == False or (len(A[0])==1 and len(A[1])==1):  
-            
-                for c in db:
-                    snp = db[c].getSNPs([x])
-                    if len(snp) > 0:
-                        for s in snp:
-                            if s is not None and [s[3],s[4]] == A: 
-                                found = True
-                                break
-
-                    if found:
-                        break
-            else:
-                Ns += 1
+        T = self._GWAS_table
+        
+        if T is not None and T.alleles is not None:
+            # Join on the integer SNP ids of the reference panel
+            if T.sid is None:
+                T.intern(self._ref,parallel)
                 
-            if not found:
-                # Remove if alleles do not match to ref panel
-                Nr += 1
-                todel.append(x)
+            X = T.rsid.tolist()
+            A = T.alleles
+            S = (not SNPonly) | ((np.char.str_len(A[:,0]) == 1) & (np.char.str_len(A[:,1]) == 1))
+            M = self._ref.matchAlleles(X,A,parallel,T.sid) & S
             
+            self._GWAS_table = T.take(M)
+        else:
+            X = list(self._GWAS_alleles.keys())
+            A = [self._GWAS_alleles[x] for x in X]
+            S = np.array([SNPonly == False or (len(a[0])==1 and len(a[1])==1) for a in A],dtype='bool')
+            M = self._ref.matchAlleles(X,A,parallel) & S
         
-        del db
-    
+        todel = [X[k] for k in np.flatnonzero(~M)]
+        
+        N = len(X)
+        Ns = int(np.sum(~S))
+        Nr = len(todel)
+            
         for x in todel:
                 
-            del self._GWAS_alleles[x]
+            if x in self._GWAS_alleles:
+                del self._GWAS_alleles[x]
             
             if x in self._GWAS:
                 del self._GWAS[x]
@@ -334,6 +330,12 @@ class genescorer(ABC):
 
         for i in range(0,len(SNPs)):
             self._GWAS[SNPs[i]] = wr[i]
+        
+        self._GWAS_chi2 = _chi2stats(SNPs,wr)
+        
+        if self._GWAS_table is not None:
+            I = self._GWAS_table.ids(SNPs)
+            self._GWAS_table.p[I[I >= 0]] = wr[I >= 0]
 
         print(len(SNPs),"SNPs ( min p:", f'{1./(len(p)+1):.2e}',")")
     
@@ -631,8 +633,57 @@ class genescorer(ABC):
         self._SCORES = {}
         self._SKIPPED = {}
         
-               
-    def score_chr(self,chrs,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,parallel=1,nobar=False,autorescore=False,keep_idx=None):
+    
+    def _getGeneSNPs(self,cr,gene,REF,useAll=False,wAlleles=False,rsid_filter=None):
+        # Selects the reference panel SNPs of a gene as arrays (one variant per SNP id, matching the alleles of the loaded GWAS if wAlleles)
+        X = self._getGeneVariants(cr,gene,REF,useAll,rsid_filter)
+        X = snpdb.take(X,self._selectVariants(X,self._GWAS_alleles if wAlleles else None))
+        
+        return X['rsid'],X
+    
+    def _getGeneVariants(self,cr,gene,REF,useAll=False,rsid_filter=None):
+        # All reference panel variants of a gene as arrays (one batched query per gene), filtered by the SNPs of the loaded GWAS (or rsid_filter)
+        DB = REF[str(cr)][0]
+        
+        F = None if useAll else (self._GWAS if rsid_filter is None else rsid_filter)
+        unpack = not DB._packed
+        
+        if self._MAP is None or self._joint:
+            G = self._GENEID[gene]
+            X = DB.get_range(G[1]-self._window,G[2]+self._window,self._MAF,F,unpack)
+            
+            if self._MAP is not None and gene in self._MAP:
+                P = DB.getPosatSNPsBulk(list(self._MAP[gene].keys()),last=True)
+                P = np.unique(P[P >= 0])
+                P = P[(P < G[1]-self._window) | (P > G[2]+self._window)]
+                
+                X = snpdb.merge(X,DB.get_pos(P,self._MAF,F,unpack))
+                
+        elif gene in self._MAP:
+            P = DB.getPosatSNPsBulk(list(self._MAP[gene].keys()),last=True)
+            X = DB.get_pos(np.unique(P[P >= 0]),self._MAF,F,unpack)
+        else:
+            X = DB.get_pos([],self._MAF,F,unpack)
+        
+        return X
+    
+    def _selectVariants(self,X,alleles=None,rsid_filter=None):
+        # Indices of the variants of X to use: one per SNP id (see snpdb.select_unique) of the SNP ids in rsid_filter (None for all) and matching the alleles (SNP id -> [alt,ref], None for all)
+        I = np.arange(0,len(X['rsid']))
+        
+        if rsid_filter is not None and len(I) > 0:
+            I = I[np.array([x in rsid_filter for x in X['rsid']],dtype='bool')]
+        
+        if alleles is not None and len(I) > 0:
+            if X['alt'] is None:
+                I = I[:0]
+            else:
+                I = I[np.array([alleles.get(X['rsid'][i]) == [X['alt'][i],X['ref'][i]] for i in I],dtype='bool')]
+        
+        return I[snpdb._unique_rows(snpdb.take(X,I))]
+    
+    
+    def score_chr(self,chrs,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,parallel=1,nobar=False,autorescore=False,keep_idx=None,shared=False):
         """
         Perform gene scoring for full chromosomes
         
@@ -647,6 +698,7 @@ class genescorer(ABC):
             parallel(int) : # of cores to use
             nobar(bool): Do not show progress bar
             autorescore(bool): Automatically try to re-score failed genes via Pearson's algorithm
+            shared(bool): Load the index of the reference panel into shared memory for all cores, one chromosome at a time (only for parallel > 1)
         
         """
         tic = time.time()
@@ -659,12 +711,12 @@ class genescorer(ABC):
         
         lock = mp.Manager().Lock()
         
-        # Build list of genes for chromosomes
+        # Build list of genes for chromosomes (in position order to share LD computations)
         G = []
         for c in S:
-            G.extend(self._CHR[str(c)][0])
+            G.extend(sorted(self._CHR[str(c)][0],key=lambda x: self._GENEID[x][1] if x in self._GENEID else 0))
         
-        res = self.score(G,parallel,unloadRef,method,mode,reqacc,intlimit,nobar,autorescore,keep_idx)
+        res = self.score(G,parallel,unloadRef,method,mode,reqacc,intlimit,nobar,autorescore,keep_idx,shared)
         
         toc = time.time()
         
@@ -674,7 +726,7 @@ class genescorer(ABC):
         return res
         
 
-    def score_all(self,parallel=1,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,nobar=False,autorescore=False,keep_idx=None):
+    def score_all(self,parallel=1,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,nobar=False,autorescore=False,keep_idx=None,shared=False):
         """
         Perform full gene scoring
         
@@ -687,13 +739,84 @@ class genescorer(ABC):
             intlimit(int) : Max # integration terms to use
             nobar(bool): Do not show progress bar
             autorescore(bool): Automatically try to re-score failed genes via Pearson's algorithm
+            shared(bool): Load the index of the reference panel into shared memory for all cores, one chromosome at a time (only for parallel > 1)
         
         """
         
         self._SCORES = {}
         
-        return self.score_chr([i for i in range(1,23)],True,method,mode,reqacc,intlimit,parallel,nobar,autorescore,keep_idx)
+        return self.score_chr([i for i in range(1,23)],True,method,mode,reqacc,intlimit,parallel,nobar,autorescore,keep_idx,shared)
+        
+    def _scoreparallel(self,G,parallel,keep_idx,shared,args,main=None,n=None):
+        """
+        Scores the genes G via _scoremain (or main) on parallel cores
+        
+        Args:
+        
+            G(list): Gene ids to score
+            parallel(int): # of cores to use
+            keep_idx(list): Indices of reference panel samples to use (None for all)
+            shared(bool): Load the reference panel into shared memory. The chromosomes are scored one after the other, such that only the index of one chromosome is in shared memory at a time.
+            args(function): Returns the arguments of _scoremain for (genes, core #, shared reference)
+            main(function): Scoring function to run on the cores (None for _scoremain)
+            n(int): # of [RESULT,FAIL,TOTALFAIL] returned by main (None for one)
+            
+        Returns:
+        
+            list: [RESULT,FAIL,TOTALFAIL] of all cores (list of n if n is not None)
+        """
+        if main is None:
+            main = self._scoremain
+            
+        R = [[[],[],[]] for k in range(0,1 if n is None else n)]
+        
+        if shared:
+            C = {}
+            for x in G:
+                C.setdefault(self._GENEID[x][0],[]).append(x)
+            
+            groups = list(C.items())
+        else:
+            groups = [(None,G)]
+        
+        for cr, genes in groups:
+            SHARED = None
+            if cr is not None:
+                SHARED = self._ref.load_shared_reference([cr],keep_idx)
+            
+            # Workers are started after the shared blocks are created (they attach via the same resource tracker)
+            pool = mp.Pool(max(1,min(parallel,mp.cpu_count())))
+            
+            try:
+                S = np.array_split(genes,parallel)
+                
+                result_objs = []
+                for i in range(0,len(S)):
+                    if len(S[i]) > 0:
+                        result_objs.append(pool.apply_async(main, args(S[i],i,SHARED)))
+                
+                for result in result_objs:
+                    r = result.get()
+                    
+                    for k in range(0,len(R)):
+                        X = r if n is None else r[k]
+                        
+                        R[k][0].extend(X[0])
+                        R[k][1].extend(X[1])
+                        R[k][2].extend(X[2])
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                # Wait for the workers to exit (and detach) before the shared blocks are unlinked
+                pool.close()
+                pool.join()
+                
+                if SHARED is not None:
+                    for c in SHARED:
+                        SHARED[c].release()
         
+        return R[0] if n is None else R
     
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -726,6 +849,8 @@ class chi2sum(genescorer):
         self._GWAS = {}
         self._GWAS_beta = {}
         self._GWAS_alleles = {}
+        self._GWAS_table = None
+        self._GWAS_chi2 = None
         
         self._GENES = {}
         self._CHR = {}
@@ -751,152 +876,226 @@ class chi2sum(genescorer):
             self._useGPU = False
             if gpu and cp is None:
                 print("Error: Cupy library not detected => Using CPUs")
-
-       
-    def _calcGeneSNPcorr(self,cr,gene,REF,useAll=False):
         
-        if self._joint and self._MAP is not None:
-            G = self._GENEID[gene]
-            P = SortedSet(REF[str(cr)][1].irange(G[1]-self._window,G[2]+self._window))
-
-            if gene in self._MAP:
-                P.update(list(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys()))))
-                #P = list(set(P))
-     
-        elif self._MAP is None:
-            G = self._GENEID[gene]
-
-            P = REF[str(cr)][1].irange(G[1] - self._window, G[2] + self._window)
+        # Correlation tile cache of the current chromosome (see set_ldcache)
+        self._LD = None
+        self._LDmaxbytes = None
+        
+        # On disk eigenvalue cache (see set_evcache)
+        self._EVcache = None
+        
+        # Eigenvalue solver (see set_evsolver)
+        self._EVsolver = 'dense'
+        self._EVmindim = 2000
+        
+    def set_evcache(self,path,maxsize=2**30):
+        """
+        Stores the filtered eigenvalues of the gene SNP-SNP correlation matrices on disk. Scoring with the same reference panel and settings (e.g. for different GWAS) then skips the LD computation for genes scored before.
+        
+        Args:
+        
+            path(string): Directory of the cache (None to disable)
+            maxsize(int): Max size of the cache in bytes (least recently used entries are removed)
+            
+        Note:
+        
+            The cache is keyed by the reference panel (and its modification state), the sample subset, window, MAF, varcutoff and the SNPs of the gene passing the filters.
+        """
+        if path is None:
+            self._EVcache = None
         else:
-            if gene in self._MAP:
-                P = set(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys())))
-            else:
-                P = []
+            self._EVcache = evcache.evcache(path,maxsize)
+    
+    def set_ldcache(self,maxbytes=2**28):
+        """
+        Caches the SNP-SNP correlations between tiles of SNPs, such that overlapping gene windows (genes scored in position order) share the correlation computations
         
-        DATA = REF[str(cr)][0].get(list(P))
-      
-        filtered = {}
+        Args:
         
-        #use = []
-        #RID = []
+            maxbytes(int): Max size of the cached correlations per process in bytes (None to disable)
+            
+        Note:
         
-        # Sort out
-        for D in DATA:
-            # Select
-            if (D[0] in self._GWAS or useAll) and (D[1] > self._MAF) and (D[0] not in filtered or D[1] < filtered[D[0]][0]):
-                filtered[D[0]] = [D[1],D[2]]
-                #use.append(D[2])
-                #RID.append(s)
-                
-
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
+            The correlations are computed in float64 from the genotypes and equal np.corrcoef. The cache is not used for packed storages and with gpu=True.
+        """
+        self._LDmaxbytes = maxbytes
+        self._LD = None
+        
+    def set_evsolver(self,solver='auto',mindim=2000):
+        """
+        Sets the solver for the eigenvalues of the gene SNP-SNP correlation matrices
+        
+        Args:
+        
+            solver(string): 'dense' (all eigenvalues) or 'auto' (Lanczos iteration for the leading eigenvalues up to varcutoff of large matrices)
+            mindim(int): Min # SNPs of a gene to try the Lanczos iteration in 'auto' mode
             
-        use = np.array(use)
+        Note:
         
-        if len(use) > 1:
-            if self._useGPU:
-                C = cp.asnumpy(cp.corrcoef(cp.asarray(use)))
-            else:
-                C = np.corrcoef(use)
+            The dense solver takes the sum of the positive eigenvalues as total variance. The Lanczos iteration does not compute all eigenvalues and takes the trace of the matrix instead, which differs by the (numerically small) negative eigenvalues. It is only used if the spectrum is concentrated enough for few eigenvalues to reach varcutoff, else (and with gpu=True) the dense solver is used.
+        """
+        solvers = ['dense','auto']
+        
+        if solver not in solvers:
+            print("No valid eigenvalue solver. Available solvers:",solvers)
         else:
-            C = np.ones((1,1))
+            self._EVsolver = solver
+            self._EVmindim = mindim
+            
+    def _evkey(self,cr,gene,X,keep_idx=None):
+        # Cache key of the eigenvalues of a gene with the selected variants X (see _getGeneSNPs)
+        if cr not in self._EVstamp:
+            self._EVstamp[cr] = self._ref._stamp(cr)
             
+        K = None if keep_idx is None else np.asarray(keep_idx,dtype='int64')
+        R = X['rsid']
+        
+        # Small matrices are always solved dense
+        S = self._EVsolver if len(R) >= self._EVmindim else 'dense'
+        
+        # The variants selected for a SNP id depend on the GWAS alleles at multi-allelic sites
+        A = [None] if X['alt'] is None else [list(X['alt']),list(X['ref'])]
+        
+        return self._EVcache.key(type(self).__name__,self._EVstamp[cr],K,self._window,self._MAF,self._varcutoff,S,list(R),np.asarray(X['pos'],dtype='int64'),*A)
+
+       
+    def _calcGeneSNPcorr(self,cr,gene,REF,useAll=False):
+        
+        RID,X = self._getGeneSNPs(cr,gene,REF,useAll)
         
-        return C,np.array(RID)
+        return self._geneCorr(cr,gene,REF,RID,X),RID
 
     
     def _calcGeneSNPcorr_wAlleles(self,cr,gene,REF,useAll=False):
         
-        if self._joint and self._MAP is not None:
-            G = self._GENEID[gene]
-            P = SortedSet(REF[str(cr)][1].irange(G[1]-self._window,G[2]+self._window))
+        RID,X = self._getGeneSNPs(cr,gene,REF,useAll,wAlleles=True)
+        
+        return self._geneCorr(cr,gene,REF,RID,X),RID
 
-            if gene in self._MAP:
-                P.update(list(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys()))))
-                #P = list(set(P))
-          
-        elif self._MAP is None:
-            G = self._GENEID[gene]
+    
+    def _geneCorr(self,cr,gene,REF,RID,X):
+        # SNP-SNP correlation matrix of the SNPs selected for a gene (see _getGeneSNPs)
+        return self._corrcoef(X['gt'],REF[str(cr)][0],X['mean'],X['std'],_ldkeys(X))
 
-            P = REF[str(cr)][1].irange(G[1] - self._window, G[2] + self._window)
+    
+    def _getRefData(self,DB,P):
+        # Packed storages deliver packed genotypes to the popcount correlation kernel
+        if DB._packed:
+            return DB.get(list(P),unpack=False)
         else:
-            if gene in self._MAP:
-                P = set(REF[str(cr)][0].getSNPsPos( list(self._MAP[gene].keys()) ))
-            else:
-                P = []
+            return DB.get(list(P))
         
-        DATA = REF[str(cr)][0].get(list(P))
-            
-        filtered = {}
-        
-        #use = []
-        #RID = []
-        
-        # Sort out
-        for D in DATA:
-            # Select
-            if (D[0] in self._GWAS or useAll) and D[1] > self._MAF and (D[0] not in filtered or D[1] < filtered[D[0]][0]) and self._GWAS_alleles[D[0]][0] == D[3] and self._GWAS_alleles[D[0]][1] == D[4]:
-                          
-                filtered[D[0]] = [D[1],D[2]]
-
-                #use.append(D[2])
-                #RID.append(s)
-
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
-            
-        use = np.array(use)
+    def _corrcoef(self,use,DB,mean=None,std=None,keys=None):
         
         if len(use) > 1:
+            use = np.array(use)
+            
+            # Genes scored in position order share correlation tiles (see set_ldcache)
+            if keys is not None and getattr(self,'_LDmaxbytes',None) and not DB._packed and not self._useGPU:
+                if self._LD is None or self._LD[0] is not DB:
+                    self._LD = [DB,snpdb.ldtiles(maxbytes=self._LDmaxbytes)]
+                    
+                return self._LD[1].corrcoef(keys,use)
+            
+            if DB._packed:
+                if self._useGPU:
+                    use = snpdb.unpack_genotypes(use,DB._nsamples)
+                else:
+                    return snpdb.corrcoef_packed(use,DB._nsamples)
+                
             if self._useGPU:
                 C = cp.asnumpy(cp.corrcoef(cp.asarray(use)))
+            elif std is not None:
+                # Precomputed per SNP statistics of the storage
+                C = snpdb.corrcoef_stats(use,mean,std)
             else:
                 C = np.corrcoef(use)
         else:
             C = np.ones((1,1))
-            
         
-        return C,np.array(RID)
-
+        return C
     
-    def _getChi2Sum_mapper(self,RIDs,gene):
-        #print([GWAS[x] for x in RIDs])
+    def _getChi2_mapper(self,RIDs,gene,GWAS=None):
+        # p-values of the mapper take precedence over the GWAS (the loaded one or GWAS=(p-values,chi2 statistics))
+        P = self._GWAS if GWAS is None else GWAS[0]
+        
         ps = np.zeros(len(RIDs))
         for i in range(0,len(ps)):
-            #ps = chi2.ppf(1- np.array([GWAS[x] for x in RIDs]),1)
             if RIDs[i] in self._MAP[gene] and self._MAP[gene][RIDs[i]][4] is not None:
-                ps[i] = tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(self._MAP[gene][RIDs[i]][4])
+                ps[i] = self._MAP[gene][RIDs[i]][4]
             else:
-                ps[i] = tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(self._GWAS[RIDs[i]])
+                ps[i] = P[RIDs[i]]
                 
-        return np.sum(ps)
+        return tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(ps)
+    
+    def _getChi2Sum_mapper(self,RIDs,gene,GWAS=None):
+        return np.sum(self._getChi2_mapper(RIDs,gene,GWAS))
         
-    def _getChi2Sum(self,RIDs):
-        #print([GWAS[x] for x in RIDs])
-        ps = np.zeros(len(RIDs))
-        for i in range(0,len(ps)):
-            #ps = chi2.ppf(1- np.array([GWAS[x] for x in RIDs]),1)
-            ps[i] = tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(self._GWAS[RIDs[i]])
-        return np.sum(ps)
+    def _getChi2Sum(self,RIDs,GWAS=None):
+        # Sum of the chi2 statistics of the loaded GWAS (or GWAS=(p-values,chi2 statistics))
+        P = self._GWAS if GWAS is None else GWAS[0]
+        C = self._GWAS_chi2 if GWAS is None else GWAS[1]
+        
+        ps = np.array([P[x] for x in RIDs],dtype='float64')
+        
+        if C is None:
+            return np.sum(tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(ps))
+        
+        # Precomputed statistics of p-values not changed since (others are transformed on the fly)
+        S = np.array([C[x][1] if x in C and C[x][0] == ps[i] else np.nan for i,x in enumerate(RIDs)],dtype='float64')
+        
+        M = np.isnan(S)
+        if np.any(M):
+            S[M] = tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(ps[M])
+            
+        return np.sum(S)
     
-    def _calcAndFilterEV(self,C):
-        try:
-            if self._useGPU:
-                L = cp.asnumpy(cp.linalg.eigvalsh(cp.asarray(C)))
-            else:
-                L = np.linalg.eigvalsh(C)
-        except: 
-            return None
+    def _leadingEV(self,C):
+        # Leading eigenvalues of C covering varcutoff of the total variance (trace) via Lanczos iteration (None if the dense solver is faster)
+        n = len(C)
         
-        F = L > 0
-        L = L[F][::-1]
+        T = np.trace(C)
+        if not T > 0 or self._varcutoff >= 1:
+            return None,None
+        
+        # Participation ratio of the spectrum as estimate of the # EVs to compute
+        k = int(np.ceil(10*T**2/np.vdot(C,C)))
+        
+        while k <= n//16:
+            try:
+                L = eigsh(C,k=k,which='LA',return_eigenvectors=False,v0=np.ones(n))
+            except (ArpackNoConvergence,ArpackError):
+                return None,None
+            
+            L = np.sort(L)[::-1]
+            L = L[L > 0]
+            
+            # All EVs within varcutoff found
+            if np.sum(L) >= self._varcutoff*T:
+                return L,T
+            
+            k = 2*k
+            
+        return None,None
+    
+    def _calcAndFilterEV(self,C):
+        L = None
+        if self._EVsolver == 'auto' and not self._useGPU and len(C) >= self._EVmindim:
+            L,T = self._leadingEV(C)
+            
+        if L is None:
+            try:
+                if self._useGPU:
+                    L = cp.asnumpy(cp.linalg.eigvalsh(cp.asarray(C)))
+                else:
+                    L = np.linalg.eigvalsh(C)
+            except: 
+                return None
+            
+            F = L > 0
+            L = L[F][::-1]
+            
+            T = np.sum(L)
         
         if len(L) > 0:
             N_L = []
@@ -905,7 +1104,6 @@ class chi2sum(genescorer):
             c = L[0]
             N_L.append(L[0])
             
-            T = np.sum(L)
             
             # Cutoff variance for remaining EVs
             for i in range(1,len(L)):
@@ -918,6 +1116,60 @@ class chi2sum(genescorer):
         else:
             return None
     
+    def _calcGeneEV(self,cr,gene,REF,keep_idx=None):
+        # Filtered eigenvalues of the SNP-SNP correlation matrix of a gene (looked up in the eigenvalue cache if set)
+        R,X = self._getGeneSNPs(cr,gene,REF,wAlleles=len(self._GWAS_alleles) > 0)
+        
+        if len(R) <= 1:
+            return None,R
+        
+        key = None
+        if self._EVcache is not None:
+            key = self._evkey(cr,gene,X,keep_idx)
+            
+            L = self._EVcache.get(key)
+            if L is not None:
+                return L.tolist(),R
+        
+        N_L = self._calcAndFilterEV(self._geneCorr(cr,gene,REF,R,X))
+        
+        if key is not None and N_L is not None:
+            self._EVcache.put(key,N_L)
+            
+        return N_L,R
+    
+    def _scoreGene(self,g,N_L,R,method,mode,reqacc,intlimit,RESULT,FAIL,TOTALFAIL,GWAS=None):
+        # Scores gene g with SNPs R and eigenvalues N_L against the loaded GWAS (or GWAS=(p-values,chi2 statistics))
+        P = self._GWAS if GWAS is None else GWAS[0]
+        
+        if len(R) > 1:
+            # Score
+            if self._MAP is not None and self._joint == False:
+                S = self._getChi2Sum_mapper(R,g,GWAS) 
+            else:
+                S = self._getChi2Sum(R,GWAS)
+
+            RES = self._scoreThread(N_L,S,g,method,mode,reqacc,intlimit)
+
+            if RES is not None and (RES[1][1]==0 or RES[1][1]==5) and RES[1][0] > 0 and RES[1][0] <= 1 and (RES[1][0] > reqacc*1e3 or ( (method=='auto' or method=='satterthwaite' or method=='pearson' or method=='saddle')  )):
+                RESULT.append( [self._GENEIDtoSYMB[RES[0]],float(RES[1][0]),len(R)])
+            elif RES is not None:
+                FAIL.append([self._GENEIDtoSYMB[RES[0]],len(R),RES[1]])
+            else:
+                TOTALFAIL.append([self._GENEIDtoSYMB[g],"Singular covariance matrix"])
+
+        elif len(R) == 1:
+            if self._MAP is not None and self._joint == False:
+                if R[0] in self._MAP[g] and self._MAP[g][R[0]][0] is not None:
+                    RESULT.append( [self._GENEIDtoSYMB[g],float(self._MAP[g][R[0]][0]),1] )
+                else:
+                    RESULT.append( [self._GENEIDtoSYMB[g],float(P[R[0]]),1] )
+                    
+            else:
+                RESULT.append( [self._GENEIDtoSYMB[g],float(P[R[0]]),1] )
+        else:
+            TOTALFAIL.append([self._GENEIDtoSYMB[g],"No SNPs"])
+    
     def _scoreThread(self,N_L,S,g,method,mode,reqacc,intlimit):
         
         if N_L is not None:
@@ -938,7 +1190,7 @@ class chi2sum(genescorer):
         else:
             return None
         
-    def _scoremain(self,gene,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,label='',baroffset=0,nobar=False,lock=None,keep_idx=None):
+    def _scoremain(self,gene,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,label='',baroffset=0,nobar=False,lock=None,keep_idx=None,shared=None):
         
         G = np.array(gene)
         RESULT = []
@@ -948,6 +1200,8 @@ class chi2sum(genescorer):
         #pool = mp.Pool(cores)
         REF = {}
         
+        self._EVstamp = {}
+        
         #print("# cores:",max(1,min(parallel,mp.cpu_count())))
         #with tqdm(total=len(G), bar_format="{l_bar}{bar} [ estimated time left: {remaining} ]", file=sys.stdout, position=baroffset, leave=True,disable=nobar) as pbar:
        
@@ -975,50 +1229,18 @@ class chi2sum(genescorer):
                     if unloadRef:
                         REF = {}
 
-                    REF[cr] = self._ref.load_pos_reference(cr,keep_idx)
-
-                    
-                if len(self._GWAS_alleles)==0:
-                    C,R = self._calcGeneSNPcorr(cr,G[i],REF)
-                else:
-                    C,R = self._calcGeneSNPcorr_wAlleles(cr,G[i],REF)
-
-                if len(R) > 1:
-                    # Score
-                    if self._MAP is not None and self._joint == False:
-                        S = self._getChi2Sum_mapper(R,G[i]) 
+                    if shared is not None:
+                        REF[cr] = [shared[cr],shared[cr].getSortedKeys()]
                     else:
-                        S = self._getChi2Sum(R)
-
-                    RES = self._scoreThread(self._calcAndFilterEV(C),S,G[i],method,mode,reqacc,intlimit)
+                        REF[cr] = self._ref.load_pos_reference(cr,keep_idx)
 
-                    if RES is not None and (RES[1][1]==0 or RES[1][1]==5) and RES[1][0] > 0 and RES[1][0] <= 1 and (RES[1][0] > reqacc*1e3 or ( (method=='auto' or method=='satterthwaite' or method=='pearson' or method=='saddle')  )):
-                        RESULT.append( [self._GENEIDtoSYMB[RES[0]],float(RES[1][0]),len(R)])
-                    elif RES is not None:
-                        FAIL.append([self._GENEIDtoSYMB[RES[0]],len(R),RES[1]])
-                    else:
-                        TOTALFAIL.append([self._GENEIDtoSYMB[G[i]],"Singular covariance matrix"])
-                        
-                        
-                    with lock:
-                        pbar.update(1)
-
-                else:
-
-                    if len(R) == 1:
-                        if self._MAP is not None and self._joint == False:
-                            if R[0] in self._MAP[G[i]] and self._MAP[G[i]][R[0]][0] is not None:
-                                RESULT.append( [self._GENEIDtoSYMB[G[i]],float(self._MAP[G[i]][R[0]][0]),1] )
-                            else:
-                                RESULT.append( [self._GENEIDtoSYMB[G[i]],float(self._GWAS[R[0]]),1] )
-                                
-                        else:
-                            RESULT.append( [self._GENEIDtoSYMB[G[i]],float(self._GWAS[R[0]]),1] )
-                    else:
-                        TOTALFAIL.append([self._GENEIDtoSYMB[G[i]],"No SNPs"])
+                    
+                N_L,R = self._calcGeneEV(cr,G[i],REF,keep_idx)
 
-                    with lock:
-                        pbar.update(1)
+                self._scoreGene(G[i],N_L,R,method,mode,reqacc,intlimit,RESULT,FAIL,TOTALFAIL)
+                
+                with lock:
+                    pbar.update(1)
             else:
                 TOTALFAIL.append([self._GENEIDtoSYMB[G[i]],"Not in annotation"])
 
@@ -1029,10 +1251,12 @@ class chi2sum(genescorer):
         with lock:  
             pbar.set_postfix_str("done".ljust(15))
             pbar.close()
-            
+        
+        self._LD = None
+        
         return RESULT,FAIL,TOTALFAIL
     
-    def score(self,gene,parallel=1,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=1000000,nobar=False,autorescore=False,keep_idx=None):
+    def score(self,gene,parallel=1,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=1000000,nobar=False,autorescore=False,keep_idx=None,shared=False):
         """
         Performs gene scoring for a given list of gene symbols
         
@@ -1047,6 +1271,7 @@ class chi2sum(genescorer):
             intlimit(int) : Max # integration terms to use
             nobar(bool): Do not show progress bar
             autorescore(bool): Automatically try to re-score failed genes via Pearson's algorithm
+            shared(bool): Load the index of the reference panel into shared memory for all cores, one chromosome at a time (only for parallel > 1)
         
         """
         
@@ -1074,31 +1299,14 @@ class chi2sum(genescorer):
             else:
                 print("[WARNING]: "+gene[i]+" not in annotation -> ignoring")
         
+        self._LD = None
+        
         lock = mp.Manager().Lock()
         
         if parallel <= 1:
             R = self._scoremain(G,unloadRef,method,mode,reqacc,intlimit,'',0,nobar,lock,keep_idx)
         else:
-            R = [[],[],[]]
-            S = np.array_split(G,parallel)
-            
-            result_objs = []
-            pool = mp.Pool(max(1,min(len(S),mp.cpu_count())))
-                
-            for i in range(0,len(S)): 
-                
-                if len(S[i]) > 0:
-                    result = pool.apply_async(self._scoremain, (S[i],True,method,mode,reqacc,intlimit,'',i,nobar,lock,keep_idx))
-                    result_objs.append(result)
-
-            results = [result.get() for result in result_objs]    
-
-            for r in results:
-                R[0].extend(r[0])
-                R[1].extend(r[1])
-                R[2].extend(r[2])
-            
-            pool.close()
+            R = self._scoreparallel(G,parallel,keep_idx,shared,lambda S,i,SHARED: (S,True,method,mode,reqacc,intlimit,'',i,nobar,lock,keep_idx,SHARED))
      
     
         print(len(R[0]),"genes scored")
@@ -1131,6 +1339,174 @@ class chi2sum(genescorer):
                 
         return R
      
+    def _scoremulti(self,gene,GWAS,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,label='',baroffset=0,nobar=False,lock=None,keep_idx=None,shared=None):
+        
+        G = np.array(gene)
+        RESULT = [[[],[],[]] for k in range(0,len(GWAS))]
+        REF = {}
+        
+        self._EVstamp = {}
+        
+        # Union of the SNPs of all GWAS
+        U = set()
+        for D in GWAS:
+            U.update(D[0].keys())
+        
+        if not nobar:
+            print(' ', end='', flush=True) # Hack to work with jupyter notebook 
+       
+        with lock:
+            pbar = tqdm(total=len(G), bar_format="{l_bar}{bar} [ estimated time left: {remaining} ] {postfix}", position=baroffset, leave=True,disable=nobar)
+
+        for i in range(pbar.total):
+            if G[i] in self._GENEID:
+                
+                with lock:
+                    pbar.set_postfix_str(str(self._GENEID[G[i]][4]).ljust(15))
+                    
+                cr = self._GENEID[G[i]][0]
+
+                if not cr in REF:
+                    REF = {}
+                    
+                    if shared is not None:
+                        REF[cr] = [shared[cr],shared[cr].getSortedKeys()]
+                    else:
+                        REF[cr] = self._ref.load_pos_reference(cr,keep_idx)
+                
+                # Variants of the SNPs of all GWAS in the gene
+                X = self._getGeneVariants(cr,G[i],REF,rsid_filter=U)
+                
+                # Variants used by each GWAS (GWAS using the same variants share the eigenvalues)
+                V = {}
+                for k in range(0,len(GWAS)):
+                    V.setdefault(tuple(self._selectVariants(X,GWAS[k][2],GWAS[k][0]).tolist()),[]).append(k)
+                
+                W = np.unique(np.array([r for I in V for r in I],dtype='int64'))
+                XW = snpdb.take(X,W)
+                
+                # SNP-SNP correlation of the variants of all GWAS (only if the eigenvalues of a variant set are not cached)
+                C = None
+                
+                for I in V:
+                    J = np.searchsorted(W,np.array(I,dtype='int64'))
+                    XI = snpdb.take(XW,J)
+                    
+                    N_L = None
+                    if len(J) > 1:
+                        key = None
+                        if self._EVcache is not None:
+                            key = self._evkey(cr,G[i],XI,keep_idx)
+                            N_L = self._EVcache.get(key)
+                            
+                        if N_L is None:
+                            if C is None:
+                                C = self._geneCorr(cr,G[i],REF,XW['rsid'],XW)
+                                
+                            N_L = self._calcAndFilterEV(C[np.ix_(J,J)])
+                            
+                            if key is not None and N_L is not None:
+                                self._EVcache.put(key,N_L)
+                        else:
+                            N_L = N_L.tolist()
+                            
+                    for k in V[I]:
+                        self._scoreGene(G[i],N_L,XI['rsid'],method,mode,reqacc,intlimit,RESULT[k][0],RESULT[k][1],RESULT[k][2],GWAS[k])
+                
+            else:
+                for k in range(0,len(GWAS)):
+                    RESULT[k][2].append([self._GENEIDtoSYMB[G[i]],"Not in annotation"])
+
+            with lock:
+                pbar.update(1)
+                    
+        with lock:  
+            pbar.set_postfix_str("done".ljust(15))
+            pbar.close()
+        
+        self._LD = None
+        
+        return RESULT
+    
+    def score_multi(self,GWAS,genes=None,parallel=1,method='saddle',mode='auto',reqacc=1e-100,intlimit=100000,nobar=False,keep_idx=None,shared=False):
+        """
+        Performs gene scoring for several GWAS in one pass over the reference panel. The SNP-SNP correlation matrix of each gene is computed once and its eigenvalues once per distinct set of gene SNPs, shared by all GWAS.
+        
+        Args:
+        
+            GWAS(dict|list): GWAS to score as dict of name -> p-values. The p-values are given as dict SNP id -> p-value (e.g. ._GWAS after .load_GWAS) or GWAS table (PascalX.gwas.gwas). A list is named 0,1,...
+            genes(list): Gene symbols to score (None for all genes of the loaded annotation)
+            parallel(int) : # of cores to use
+            method(string): Method to use to evaluate tail probability ('auto','davies','ruben','satterthwaite','pearson','saddle')
+            mode(string): Precision mode to use ('','128b','100d','auto')
+            reqacc(float): requested accuracy 
+            intlimit(int) : Max # integration terms to use
+            nobar(bool): Do not show progress bar
+            keep_idx(list): Indices of reference panel samples to use (None for all)
+            shared(bool): Load the index of the reference panel into shared memory for all cores, one chromosome at a time (only for parallel > 1)
+            
+        Returns:
+        
+            dict: name -> [RESULT,FAIL,TOTALFAIL] as returned by .score 
+            
+        Note:
+        
+            For GWAS tables with alleles only the variants matching the GWAS alleles are used, as by .score for a GWAS loaded with alleles (e.g. pass ._GWAS_table after .matchAlleles). The scores are not stored in the scorer.
+        """
+        methods = ['auto','saddle','pearson','satterthwaite','ruben','davies']
+        
+        if method not in methods:
+            print("No valid scoring method set. Available methods:",methods)
+            return None
+        else:
+            print("Scoring with method",method)
+            
+        if not isinstance(GWAS,dict):
+            GWAS = {k: GWAS[k] for k in range(0,len(GWAS))}
+        
+        names = list(GWAS.keys())
+        D = []
+        for x in names:
+            A = None
+            if isinstance(GWAS[x],gwas.gwas):
+                rsid, p = GWAS[x].rsid.tolist(), GWAS[x].p
+                
+                if GWAS[x].alleles is not None:
+                    A = dict(zip(rsid,GWAS[x].alleles.tolist()))
+            else:
+                rsid, p = list(GWAS[x].keys()), np.array(list(GWAS[x].values()),dtype='float64')
+            
+            # p-values with their per SNP chi2 statistics and alleles
+            D.append((dict(zip(rsid,p.tolist())),_chi2stats(rsid,p),A))
+        
+        if genes is None:
+            genes = [self._GENEIDtoSYMB[x] for c in self._CHR for x in self._CHR[c][0] if x in self._GENEIDtoSYMB]
+            
+        G = []
+        for i in range(0,len(genes)):
+            if genes[i] in self._GENESYMB:
+                G.append(self._GENESYMB[genes[i]])
+            elif genes[i] in self._GENEID:
+                G.append(genes[i])        
+            else:
+                print("[WARNING]: "+genes[i]+" not in annotation -> ignoring")
+        
+        # Walk the chromosomes in position order
+        G.sort(key=lambda x: (int(self._GENEID[x][0]) if str(self._GENEID[x][0]).isdigit() else 0,self._GENEID[x][1]) if x in self._GENEID else (0,0))
+        
+        self._LD = None
+        
+        lock = mp.Manager().Lock()
+        
+        if parallel <= 1:
+            R = self._scoremulti(G,D,method,mode,reqacc,intlimit,'',0,nobar,lock,keep_idx)
+        else:
+            R = self._scoreparallel(G,parallel,keep_idx,shared,lambda S,i,SHARED: (S,D,method,mode,reqacc,intlimit,'',i,nobar,lock,keep_idx,SHARED),self._scoremulti,len(D))
+        
+        print(len(D),"GWAS scored |",sum([len(x[0]) for x in R]),"scores |",sum([len(x[1]) for x in R]),"failed")
+        
+        return {names[k]: R[k] for k in range(0,len(D))}
+    
     def activateFails(self,RESULT):
         """
         Helper method to force activate failed genes to success genes 
@@ -1175,6 +1551,8 @@ class chi2sum(genescorer):
             else:
                 print("[WARNING]: "+GENES[i]+" not in annotation -> ignoring")
         
+        self._LD = None
+        
         lock = mp.Manager().Lock()
         
         if parallel <= 1:
@@ -1248,6 +1626,7 @@ class chi2sum(genescorer):
 
         # Init GWAS dummy data
         self._GWAS = {}
+        self._GWAS_table = None
         for rsid in data[0]:
             self._GWAS[rsid]= None
         
@@ -1272,6 +1651,8 @@ class chi2sum(genescorer):
             for j in range(0,len(data[0])):
                 self._GWAS[data[0][j]] = data[2][i,j]
             
+            self._GWAS_chi2 = None
+            
             if len(R) > 1:
                 S = self._getChi2Sum(R)
 
@@ -1326,7 +1707,7 @@ class chi2sum(genescorer):
                 else:
                     P = []
                     
-            DATA = REF[str(cr)][0].get(list(P))
+            DATA = self._getRefData(REF[str(cr)][0],P)
     
             # Sort out
             for D in DATA:
@@ -1344,15 +1725,7 @@ class chi2sum(genescorer):
         for i in range(0,len(RID)):
             use.append(filtered[RID[i]][1])
             
-        use = np.array(use)
-        
-        if len(use) > 1:
-            if self._useGPU:
-                C = cp.asnumpy(cp.corrcoef(cp.asarray(use)))
-            else:
-                C = np.corrcoef(use)
-        else:
-            C = np.ones((1,1))
+        C = self._corrcoef(use,REF[str(cr)][0])
             
         
         return C,np.array(RID),pos
@@ -1575,142 +1948,22 @@ class wchi2sum(chi2sum):
         SNP weights have to be supplied via Mapper
     
     """
-    def _getChi2Sum_mapper(self,RIDs,gene):
-        #print([GWAS[x] for x in RIDs])
-        ps = np.zeros(len(RIDs))
-        for i in range(0,len(ps)):
-            
+    def _getChi2Sum_mapper(self,RIDs,gene,GWAS=None):
+        w = np.ones(len(RIDs))
+        for i in range(0,len(w)):
             if RIDs[i] in self._MAP[gene] and self._MAP[gene][RIDs[i]][0] is not None:
-                w = self._MAP[gene][RIDs[i]][0] 
-            else:
-                w = 1
+                w[i] = self._MAP[gene][RIDs[i]][0] 
                 
-            if RIDs[i] in self._MAP[gene] and self._MAP[gene][RIDs[i]][4] is not None:
-                ps[i] = w*tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(self._MAP[gene][RIDs[i]][4])
-            else:
-                ps[i] = w*tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(self._GWAS[RIDs[i]])
-                
-        return np.sum(ps)
+        return np.sum(w*self._getChi2_mapper(RIDs,gene,GWAS))
     
     
-    def _calcGeneSNPcorr(self,cr,gene,REF,useAll=False):
-        
-        if self._joint and self._MAP is not None:
-            G = self._GENEID[gene]
-            P = SortedSet(REF[str(cr)][1].irange(G[1]-self._window,G[2]+self._window))
-
-            if gene in self._MAP:
-                P.update(list(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys()))))
-                #P = list(set(P))
-     
-        elif self._MAP is None:
-            G = self._GENEID[gene]
-
-            P = REF[str(cr)][1].irange(G[1] - self._window, G[2] + self._window)
-        else:
-            if gene in self._MAP:
-                P = set(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys())))
-            else:
-                P = []
-        
-        DATA = REF[str(cr)][0].get(list(P))
-      
-        filtered = {}
-        
-        #use = []
-        #RID = []
-        
-        # Sort out
-        for D in DATA:
-            # Select
-            if (D[0] in self._GWAS or useAll) and (D[1] > self._MAF) and (D[0] not in filtered or D[1] < filtered[D[0]][0]):
-                filtered[D[0]] = [D[1],D[2]]
-                #use.append(D[2])
-                #RID.append(s)
-                
-
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
-            
-        use = np.array(use)
-        
-        # Get weights
-        w = np.ones(len(RID))
-        for i in range(0,len(RID)):
-            if RID[i] in self._MAP[gene] and self._MAP[gene][RID[i]][0] is not None:
-                w[i] = self._MAP[gene][RID[i]][0] 
-        
-        Wh = np.sqrt(np.diag(w))
+    def _evkey(self,cr,gene,X,keep_idx=None):
+        # The SNP weights enter the correlation matrix
+        w = [self._MAP[gene][x][0] if x in self._MAP[gene] else None for x in X['rsid']]
         
-        if len(use) > 1:
-            if self._useGPU:
-                C = cp.corrcoef(cp.asarray(use))
-                Whc = cp.asarray(Wh)
-                C = cp.asnumpy(Whc.dot(C.dot(Whc)))
-            else:
-                C = np.corrcoef(use)
-                C = Wh.dot(C.dot(Wh))   
-        else:
-            C = np.ones((1,1))*Wh
-        
-        return C,np.array(RID)
-
+        return self._EVcache.key(super()._evkey(cr,gene,X,keep_idx),w)
     
-    def _calcGeneSNPcorr_wAlleles(self,cr,gene,REF,useAll=False):
-        
-        if self._joint and self._MAP is not None:
-            G = self._GENEID[gene]
-            P = SortedSet(REF[str(cr)][1].irange(G[1]-self._window,G[2]+self._window))
-
-            if gene in self._MAP:
-                P.update(list(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys()))))
-                #P = list(set(P))
-          
-        elif self._MAP is None:
-            G = self._GENEID[gene]
-
-            P = REF[str(cr)][1].irange(G[1] - self._window, G[2] + self._window)
-        else:
-            if gene in self._MAP:
-                P = set(REF[str(cr)][0].getSNPsPos( list(self._MAP[gene].keys()) ))
-            else:
-                P = []
-        
-        DATA = REF[str(cr)][0].get(list(P))
-            
-        filtered = {}
-        
-        #use = []
-        #RID = []
-        
-        # Sort out
-        for D in DATA:
-            # Select
-            if (D[0] in self._GWAS or useAll) and D[1] > self._MAF and (D[0] not in filtered or D[1] < filtered[D[0]][0]) and self._GWAS_alleles[D[0]][0] == D[3] and self._GWAS_alleles[D[0]][1] == D[4]:
-                          
-                filtered[D[0]] = [D[1],D[2]]
-
-                #use.append(D[2])
-                #RID.append(s)
-
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
-            
-        use = np.array(use)
-        
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
-            
-        use = np.array(use)
+    def _geneCorr(self,cr,gene,REF,RID,X):
         
         # Get weights
         w = np.ones(len(RID))
@@ -1720,22 +1973,17 @@ class wchi2sum(chi2sum):
         
         Wh = np.sqrt(np.diag(w))
         
-        if len(use) > 1:
-            if self._useGPU:
-                C = cp.corrcoef(cp.asarray(use))
-                Whc = cp.asarray(Wh)
-                C = cp.asnumpy(Whc.dot(C.dot(Whc)))
-            else:
-                C = np.corrcoef(use)
-                C = Wh.dot(C.dot(Wh))   
+        if len(RID) > 1:
+            C = self._corrcoef(X['gt'],REF[str(cr)][0],X['mean'],X['std'],_ldkeys(X))
+            C = Wh.dot(C.dot(Wh))   
         else:
             C = np.ones((1,1))*Wh
         
-        return C,np.array(RID)
+        return C
 
     
     
-    def score(self,gene,parallel=1,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=1000000,nobar=False,autorescore=False,keep_idx=None):
+    def score(self,gene,parallel=1,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=1000000,nobar=False,autorescore=False,keep_idx=None,shared=False):
         """
         Performs gene scoring for a given list of gene symbols
         
@@ -1750,6 +1998,7 @@ class wchi2sum(chi2sum):
             intlimit(int) : Max # integration terms to use
             nobar(bool): Do not show progress bar
             autorescore(bool): Automatically try to re-score failed genes via Pearson's algorithm
+            shared(bool): Load the index of the reference panel into shared memory for all cores, one chromosome at a time (only for parallel > 1)
         
         """     
         if self._MAP is None:
@@ -1758,7 +2007,7 @@ class wchi2sum(chi2sum):
             return None
                   
         else:
-            return super().score(gene,parallel,unloadRef,method,mode,reqacc,intlimit,nobar,autorescore,keep_idx)
+            return super().score(gene,parallel,unloadRef,method,mode,reqacc,intlimit,nobar,autorescore,keep_idx,shared)
         
         
         
@@ -1799,6 +2048,8 @@ class cauchysum(genescorer):
         self._GWAS = {}
         self._GWAS_beta = {}
         self._GWAS_alleles = {}
+        self._GWAS_table = None
+        self._GWAS_chi2 = None
         
         self._GENES = {}
         self._CHR = {}
@@ -1820,81 +2071,16 @@ class cauchysum(genescorer):
             
     def _getSNPs(self,cr,gene,REF,useAll=False):
         
-        if self._joint and self._MAP is not None:
-            G = self._GENEID[gene]
-            P = SortedSet(REF[str(cr)][1].irange(G[1]-self._window,G[2]+self._window))
-
-            if gene in self._MAP:
-                P.update(list(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys()))))
-                #P = list(set(P))
-     
-        elif self._MAP is None:
-            G = self._GENEID[gene]
-
-            P = REF[str(cr)][1].irange(G[1] - self._window, G[2] + self._window)
-        else:
-            if gene in self._MAP:
-                P = set(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys())))
-            else:
-                P = []
+        RID,X = self._getGeneSNPs(cr,gene,REF,useAll)
         
-        DATA = REF[str(cr)][0].get(list(P))
-           
-        filtered = {}
-         
-        # Sort out
-        for D in DATA:
-            # Select
-            if (D[0] in self._GWAS or useAll) and (D[1] > self._MAF) and (D[0] not in filtered or D[1] < filtered[D[0]][0]):
-                filtered[D[0]] = [D[1],D[2]]
-                #use.append(D[2])
-                #RID.append(s)
-                
-
-        # Calc corr
-        RID = list(filtered.keys())
-        
-        return np.array(RID)
+        return RID
 
     
     def _getSNPs_wAlleles(self,cr,gene,REF,useAll=False):
         
-        if self._joint and self._MAP is not None:
-            G = self._GENEID[gene]
-            P = SortedSet(REF[str(cr)][1].irange(G[1]-self._window,G[2]+self._window))
-
-            if gene in self._MAP:
-                P.update(list(REF[str(cr)][0].getSNPsPos(list(self._MAP[gene].keys()))))
-                #P = list(set(P))
-          
-        elif self._MAP is None:
-            G = self._GENEID[gene]
-
-            P = REF[str(cr)][1].irange(G[1] - self._window, G[2] + self._window)
-        else:
-            if gene in self._MAP:
-                P = set(REF[str(cr)][0].getSNPsPos( list(self._MAP[gene].keys()) ))
-            else:
-                P = []
-        
-        DATA = REF[str(cr)][0].get(list(P))
-            
-        filtered = {}
-          
-        # Sort out
-        for D in DATA:
-            # Select
-            if (D[0] in self._GWAS or useAll) and D[1] > self._MAF and (D[0] not in filtered or D[1] < filtered[D[0]][0]) and self._GWAS_alleles[D[0]][0] == D[3] and self._GWAS_alleles[D[0]][1] == D[4]:
-                          
-                filtered[D[0]] = [D[1],D[2]]
-
-                #use.append(D[2])
-                #RID.append(s)
-
-        # Calc corr
-        RID = list(filtered.keys())
+        RID,X = self._getGeneSNPs(cr,gene,REF,useAll,wAlleles=True)
         
-        return np.array(RID)
+        return RID
         
             
             
@@ -1918,7 +2104,7 @@ class cauchysum(genescorer):
             ps[i] = self._GWAS[RIDs[i]]
         return ps      
         
-    def _scoremain(self,gene,unloadRef,label='',baroffset=0,nobar=False,lock=None):
+    def _scoremain(self,gene,unloadRef,label='',baroffset=0,nobar=False,lock=None,shared=None):
         
         G = np.array(gene)
         RESULT = []
@@ -1949,7 +2135,10 @@ class cauchysum(genescorer):
                     if unloadRef:
                         REF = {}
 
-                    REF[cr] = self._ref.load_pos_reference(cr)
+                    if shared is not None:
+                        REF[cr] = [shared[cr],shared[cr].getSortedKeys()]
+                    else:
+                        REF[cr] = self._ref.load_pos_reference(cr)
 
                 
                 # Load SNPs
@@ -1997,7 +2186,7 @@ class cauchysum(genescorer):
     
     
     
-    def score(self,gene,parallel=1,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=1000000,nobar=False,autorescore=False,keep_idx=None):
+    def score(self,gene,parallel=1,unloadRef=False,method='saddle',mode='auto',reqacc=1e-100,intlimit=1000000,nobar=False,autorescore=False,keep_idx=None,shared=False):
         """
         Performs gene scoring for a given list of gene symbols
         
@@ -2007,6 +2196,7 @@ class cauchysum(genescorer):
             parallel(int) : # of cores to use
             unloadRef(bool): Keep only reference data for one chromosome in memory (True, False) per core
             nobar(bool): Do not show progress bar
+            shared(bool): Load the index of the reference panel into shared memory for all cores, one chromosome at a time (only for parallel > 1)
            
         """
         
@@ -2025,25 +2215,7 @@ class cauchysum(genescorer):
         if parallel <= 1:
             R = self._scoremain(G,unloadRef,'',0,nobar,lock)
         else:
-            R = [[],[],[]]
-            S = np.array_split(G,parallel)
-            
-            result_objs = []
-            pool = mp.Pool(max(1,min(parallel,mp.cpu_count())))
-                
-            for i in range(0,len(S)): 
-
-                result = pool.apply_async(self._scoremain, (S[i],True,'',i,nobar,lock))
-                result_objs.append(result)
-
-            results = [result.get() for result in result_objs]    
-
-            for r in results:
-                R[0].extend(r[0])
-                R[1].extend(r[1])
-                R[2].extend(r[2])
-            
-            pool.close()
+            R = self._scoreparallel(G,parallel,None,shared,lambda S,i,SHARED: (S,True,'',i,nobar,lock,SHARED))
      
     
         print(len(R[0]),"genes scored")
@@ -0,0 +1,287 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+
+import numpy as np
+
+
+# Whitespace characters and upper case conversion table
+_WS = np.zeros(256,dtype='bool')
+_WS[[9,10,11,12,13,32]] = True
+
+_UPPER = np.arange(0,256,dtype=np.uint8)
+_UPPER[97:123] -= 32
+
+class gwas:
+    """
+    Array backed table of GWAS summary statistics. The rows are addressed by integer SNP ids (row index).
+    
+    Attributes:
+    
+        rsid(ndarray): SNP ids
+        p(ndarray): p-values
+        beta(ndarray): Betas (None if not loaded)
+        alleles(ndarray): Alternate and reference alleles as (n,2) array (None if not loaded)
+        group(ndarray): Identifiers of the GWAS, if several different GWAS in one file (None if not loaded)
+        sid(ndarray): Integer ids of the SNPs in the reference panel (None if not interned, see intern)
+    """
+    def __init__(self):
+        self.rsid = np.zeros(0,dtype='U1')
+        self.p = np.zeros(0)
+        self.beta = None
+        self.alleles = None
+        self.group = None
+        self.sid = None
+        
+        self._order = None
+        
+    def __len__(self):
+        return len(self.rsid)
+    
+    def load_gwas(self,file,rscol=0,pcol=1,bcol=None,a1col=None,a2col=None,idcol=None,delimiter=None,header=False,NAid='NA',NAcols=None,chunksize=2**24):
+        """
+        Loads the columns of GWAS summary statistics in chunks of lines
+        
+        Args:
+        
+            file(string): File containing the GWAS summary statistics data. Either as textfile or gzip compressed with ending .gz
+            rscol(int): Column of SNP ids
+            pcol(int) : Column of p-values
+            bcol(int) : Column of betas (None for ignoring)
+            a1col(int): Column of alternate allele (None for ignoring alleles) 
+            a2col(int): Column of reference allele (None for ignoring alleles)
+            idcol(int): Column of identifiers, if several different GWAS in one file (None for ignoring)
+            delimiter(String): Split character (None for whitespace)
+            header(bool): Header present
+            NAid(String): Code for not available
+            NAcols(list): Rows with NAid in one of these columns are ignored (None for rscol and pcol). NAid in other numerical columns is loaded as nan.
+            chunksize(int): Number of bytes to parse at once
+        """
+        if NAcols is None:
+            NAcols = [rscol,pcol]
+        
+        wAlleles = a1col is not None and a2col is not None
+        
+        cols = [rscol,pcol]
+        if bcol is not None:
+            cols.append(bcol)
+        if wAlleles:
+            cols.extend([a1col,a2col])
+        if idcol is not None:
+            cols.append(idcol)
+        
+        cols = cols + [c for c in NAcols if c not in cols]
+        
+        na = NAid.encode()
+        
+        D = {c: [] for c in cols}
+        
+        if file[-3:] == '.gz':
+            f = gzip.open(file,'rb')
+        else:
+            f = open(file,'rb')
+            
+        if header:
+            f.readline()
+            
+        for chunk in _chunks(f,chunksize):
+            
+            C = _columns(chunk,delimiter,cols)
+            
+            # Skip rows with missing data
+            M = np.ones(len(C[0]),dtype='bool')
+            for c in NAcols:
+                M &= C[cols.index(c)] != na
+            
+            for k in range(0,len(cols)):
+                D[cols[k]].append(C[k][M])
+                
+        f.close()
+        
+        D = {c: np.concatenate(D[c]) if len(D[c]) > 0 else np.zeros(0,dtype='S1') for c in D}
+        
+        self.rsid = D[rscol].astype(str)
+        self.p = _float(D[pcol],na)
+        self.beta = _float(D[bcol],na) if bcol is not None else None
+        self.alleles = np.stack([_upper(D[a1col]),_upper(D[a2col])],axis=1).astype(str) if wAlleles else None
+        self.group = D[idcol].astype(str) if idcol is not None else None
+        self.sid = None
+        
+        self._order = None
+    
+    def take(self,I):
+        """
+        Returns a new table with the rows I 
+        
+        Args:
+        
+            I(ndarray): Row indices or boolean mask
+        """
+        T = gwas()
+        T.rsid = self.rsid[I]
+        T.p = self.p[I]
+        T.beta = self.beta[I] if self.beta is not None else None
+        T.alleles = self.alleles[I] if self.alleles is not None else None
+        T.group = self.group[I] if self.group is not None else None
+        T.sid = self.sid[I] if self.sid is not None else None
+        
+        return T
+    
+    def unique(self):
+        """
+        Returns a new table with one row per SNP id. Multiple occurrences take the data of the last row at the position of the first one (as for repeated dict insertion).
+        """
+        if len(self.rsid) == 0:
+            return self.take(np.zeros(0,dtype='int64'))
+        
+        U, first, inv = np.unique(self.rsid,return_index=True,return_inverse=True)
+        
+        last = np.zeros(len(U),dtype='int64')
+        np.maximum.at(last,inv.reshape(-1),np.arange(0,len(self.rsid)))
+        
+        return self.take(last[np.argsort(first)])
+    
+    def intern(self,ref,parallel=1):
+        """
+        Sets the integer ids of the SNPs in a reference panel (attribute sid)
+        
+        Args:
+        
+            ref(refpanel): Reference panel
+            parallel(int): Number of cores to use for building the SNP id table of the reference panel (only once per panel)
+        """
+        self.sid = ref.intern(self.rsid,parallel)
+        
+    def ids(self,snpids):
+        """
+        Returns the integer ids (rows) of SNPs (-1 if not in table)
+        
+        Args:
+        
+            snpids(list): SNP ids
+        """
+        if self._order is None:
+            self._order = np.argsort(self.rsid,kind='stable')
+            
+        snpids = np.asarray(snpids,dtype=str)
+        
+        if len(self.rsid) == 0:
+            return np.full(len(snpids),-1,dtype='int64')
+        
+        I = np.searchsorted(self.rsid,snpids,sorter=self._order)
+        I[I == len(self.rsid)] = 0
+        
+        R = self._order[I]
+        R[self.rsid[R] != snpids] = -1
+        
+        return R
+    
+
+def _chunks(f,size):
+    """
+    Yields blocks of complete lines of about size bytes 
+    """
+    rest = b''
+    while True:
+        B = f.read(size)
+        
+        if len(B) == 0:
+            break
+            
+        B = rest + B
+        
+        e = B.rfind(b'\n')
+        if e < 0:
+            rest = B
+            continue
+            
+        rest = B[e+1:]
+        
+        yield B[:e+1]
+        
+    if len(rest.strip()) > 0:
+        yield rest + b'\n'
+        
+
+def _columns(chunk,delimiter,cols):
+    """
+    Splits a block of lines into byte string arrays of the columns cols
+    """
+    chunk = chunk.replace(b'\r\n',b'\n')
+    
+    B = np.frombuffer(chunk,dtype=np.uint8)
+    nl = np.flatnonzero(B == 10)
+    
+    # Number of fields per line
+    if delimiter is None:
+        W = _WS[B]
+        
+        P = np.ones(len(W),dtype='bool')
+        P[1:] = W[:-1]
+        
+        starts = np.flatnonzero(~W & P)
+        nf = np.bincount(np.searchsorted(nl,starts),minlength=len(nl))
+    elif len(delimiter.encode()) == 1:
+        nf = np.bincount(np.searchsorted(nl,np.flatnonzero(B == delimiter.encode()[0])),minlength=len(nl)) + 1
+    else:
+        nf = None
+        
+    if nf is not None and len(nf) > 0 and np.all(nf == nf[0]) and nf[0] > max(cols):
+        if delimiter is None:
+            T = chunk.split()
+        else:
+            d = delimiter.encode()
+            T = chunk[:-1].replace(b'\n',d).split(d)
+            
+        return [np.array(T[c::nf[0]]) for c in cols]
+        
+    # Irregular lines
+    C = [[] for c in cols]
+    for line in chunk.split(b'\n'):
+        if len(line.strip()) == 0:
+            continue
+            
+        if delimiter is None:
+            L = line.split()
+        else:
+            L = line.split(delimiter.encode())
+            
+        for k in range(0,len(cols)):
+            C[k].append(L[cols[k]])
+            
+    return [np.array(C[k],dtype='S') for k in range(0,len(cols))]
+
+
+def _upper(A):
+    """
+    Converts a byte string array to upper case (ASCII)
+    """
+    return _UPPER[A.view(np.uint8)].view(A.dtype)
+
+
+def _float(A,na):
+    """
+    Converts a byte string array to float (nan for na)
+    """
+    M = A == na
+    if np.any(M):
+        A = np.where(M,b'nan',A)
+        
+    return A.astype(np.float64)
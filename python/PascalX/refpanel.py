@@ -17,7 +17,7 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from PascalX import snpdb
+from PascalX import snpdb, tabix
 
 from tqdm import tqdm
 
@@ -25,6 +25,8 @@ import multiprocessing as mp
 
 import os.path
 import sys
+import shutil
+import glob
 
 import gzip
 import numpy as np
@@ -33,9 +35,29 @@ from fastnumbers import int
 
 import re
 
+from collections import OrderedDict
+
+# PLINK .bed genotype codes (00: homozygous A1, 01: missing, 10: heterozygous, 11: homozygous A2) to A1 allele counts (missing as 0)
+_BED = np.array([2,0,1,0],dtype='B')
+
 class refpanel:
     
     def __init__(self):
+        # Number of source lines between import checkpoints
+        self._commitlines = 100000
+        self._subsetcache = False
+        
+        # Size of the line batches parsed at once (characters)
+        self._batchbytes = 2**24
+        
+        # Terms of the memory estimate of an import process (see set_memory_model)
+        self._memmodel = {'base':2**26,'tped':15,'vcf':3,'bed':10,'block':3*256,'buffered':250,'stored':200,'bim':200,'margin':1.25}
+        
+        # Chromosomes served directly from tabix indexed .vcf.gz files
+        self._lazy = {}
+        self._alleletable = None
+        self._snpids = None
+        
         pass
     
     def load_pos_reference(self,cr,keep_idx = None):
@@ -47,12 +69,7 @@ class refpanel:
             cr(int): Chromosome number
         
         """
-        if keep_idx is None:
-            db = snpdb.db()
-        else:
-            db = snpdb.db_subset(keep_idx)
-            
-        db.open(self._refData+'.chr'+str(cr))
+        db = self._open_db(cr,keep_idx)
         
         return [db,db.getSortedKeys()]
     
@@ -65,16 +82,322 @@ class refpanel:
             cr(int): Chromosome number
         
         """
-        if keep_idx is None:
-            db = snpdb.db()
+        return self._open_db(cr,keep_idx)
+    
+    def load_shared_reference(self,crs,keep_idx = None):
+        """
+        Loads the index of the storages of chromosomes once into shared memory for multiprocess scoring. Genotypes are read from the memory mapped storage files.
+        
+        Args:
+        
+            crs(list): Chromosome numbers
+            
+        Returns:
+        
+            dict: snpdb object for each chromosome. Workers receiving the objects attach without copying.
+        
+        Note:
+        
+            release() has to be called on the returned objects once the workers are done. To bound the shared memory, load one chromosome at a time.
+        """
+        SHARED = {}
+        for cr in crs:
+            if str(cr) not in SHARED:
+                SHARED[str(cr)] = self._open_db(cr,keep_idx).share()
+            
+        return SHARED
+    
+    def load_allele_table(self,parallel=1):
+        """
+        Returns the table of reference panel alleles of all available chromosomes. The table is built once and stored as .alleles.npz.
+        
+        Args:
+        
+            parallel(int): Number of cores to use for building the table
+            
+        Returns:
+        
+            dict: Arrays 'rsid', 'chr', 'alt' and 'ref' (one entry per SNP id and variant, sorted by SNP id)
+        """
+        if self._alleletable is not None:
+            return self._alleletable
+        
+        fn = self._refData+'.alleles.npz'
+        
+        if os.path.isfile(fn):
+            with np.load(fn) as T:
+                self._alleletable = {k: T[k] for k in ['rsid','chr','alt','ref']}
+                
+            return self._alleletable
+        
+        chrs = [i for i in range(1,23) if str(i) in self._lazy or self._is_imported(i)]
+        
+        if parallel > 1 and len(chrs) > 1:
+            pool = mp.Pool(min(parallel,len(chrs)))
+            res = pool.map(self._alleles,chrs)
+            pool.close()
         else:
-            db = snpdb.db_subset(keep_idx)
+            res = [self._alleles(i) for i in chrs]
             
-        db.open(self._refData+'.chr'+str(cr))
+        T = {'rsid':[np.zeros(0,dtype='U1')],'chr':[np.zeros(0,dtype='int8')],'alt':[np.zeros(0,dtype='U1')],'ref':[np.zeros(0,dtype='U1')]}
+        for k in range(0,len(chrs)):
+            if res[k][1] is not None:
+                T['rsid'].append(res[k][0])
+                T['chr'].append(np.full(len(res[k][0]),chrs[k],dtype='int8'))
+                T['alt'].append(res[k][1])
+                T['ref'].append(res[k][2])
+                
+        T = {k: np.concatenate(T[k]) for k in T}
+        
+        I = np.lexsort((T['ref'],T['alt'],T['rsid']))
+        T = {k: T[k][I] for k in T}
+        
+        with open(fn+'.tmp','wb') as f:
+            np.savez(f,**T)
+            
+        os.replace(fn+'.tmp',fn)
+        
+        self._alleletable = T
+        
+        return T
+    
+    def load_snpids(self,parallel=1):
+        """
+        Returns the sorted SNP ids of all available chromosomes. The index of a SNP id in this array is its integer id (int32), shared by all users of the reference panel. The array is built once from the SNP id indices of the storages (independent of stored alleles) and stored as .snpids.npy.
+        
+        Args:
+        
+            parallel(int): Number of cores to use for building the array
+            
+        Returns:
+        
+            ndarray: SNP ids (bytes)
+        """
+        if self._snpids is not None:
+            return self._snpids
+        
+        fn = self._refData+'.snpids.npy'
+        
+        if not os.path.isfile(fn):
+            chrs = [i for i in range(1,23) if str(i) in self._lazy or self._is_imported(i)]
+            
+            if parallel > 1 and len(chrs) > 1:
+                pool = mp.Pool(min(parallel,len(chrs)))
+                res = pool.map(self._snpids_chr,chrs)
+                pool.close()
+            else:
+                res = [self._snpids_chr(i) for i in chrs]
+            
+            with open(fn+'.tmp','wb') as f:
+                np.save(f,np.unique(np.concatenate([np.zeros(0,dtype='S1')]+res)))
+                
+            os.replace(fn+'.tmp',fn)
+        
+        self._snpids = np.load(fn,mmap_mode='r')
+        
+        return self._snpids
+    
+    def _snpids_chr(self,cr):
+        db = self._open_db(cr)
+        S = db._scan()[2] if isinstance(db,vcfdb) else np.asarray(db._sidx)
+        S = np.unique(S)
+        db.close()
+        
+        return S
+    
+    def intern(self,snpids,parallel=1):
+        """
+        Returns the integer ids of SNPs in the reference panel
+        
+        Args:
+        
+            snpids(list): SNP ids
+            parallel(int): Number of cores to use for building the SNP id table (see load_snpids)
+            
+        Returns:
+        
+            ndarray: Integer ids (int32, -1 for SNPs not in the reference panel)
+        """
+        S = self.load_snpids(parallel)
+        
+        I = np.full(len(snpids),-1,dtype='int32')
+        
+        if len(snpids) == 0 or len(S) == 0:
+            return I
+        
+        K = np.char.encode(np.asarray(snpids,dtype='U'))
+        
+        i = np.searchsorted(S,K)
+        F = i < len(S)
+        F[F] = S[i[F]] == K[F]
+        
+        I[F] = i[F]
+        
+        return I
+    
+    def snpnames(self,ids):
+        """
+        Returns the SNP ids of integer ids (see intern)
+        
+        Args:
+        
+            ids(ndarray): Integer ids
+        """
+        return np.char.decode(np.asarray(self.load_snpids()[np.asarray(ids)]))
+    
+    def _alleles(self,cr):
+        db = self._open_db(cr)
+        A = db.getAlleles()
+        db.close()
+        
+        return A
+    
+    def matchAlleles(self,snpids,alleles,parallel=1,sid=None):
+        """
+        Checks which SNPs are in the reference panel with matching alleles 
+        
+        Args:
+        
+            snpids(list): SNP ids
+            alleles(list): Alleles [ALT,REF] of the SNPs
+            parallel(int): Number of cores to use for building the allele table (see load_allele_table)
+            sid(ndarray): Integer ids of the SNPs (see intern). None to intern snpids.
+            
+        Returns:
+        
+            ndarray: True for SNPs found with the same alleles
+        """
+        T = self.load_allele_table(parallel)
+        
+        if len(snpids) == 0:
+            return np.zeros(0,dtype='bool')
+        
+        if sid is None:
+            sid = self.intern(snpids,parallel)
+        
+        A = np.array(alleles,dtype='U').reshape((len(snpids),2))
+        
+        # Join on integer SNP id and allele pair codes
+        if 'key' not in T:
+            P, code = np.unique(np.char.add(np.char.add(T['alt'],'\t'),T['ref']),return_inverse=True)
+            
+            T['pairs'] = P
+            T['key'] = np.unique(self.intern(T['rsid'],parallel).astype('int64')*len(P) + code.reshape(-1))
+        
+        P = T['pairs']
+        if len(P) == 0:
+            return np.zeros(len(snpids),dtype='bool')
+        
+        Q = np.char.add(np.char.add(A[:,0],'\t'),A[:,1])
+        code = np.minimum(np.searchsorted(P,Q),len(P)-1)
+        
+        F = (np.asarray(sid) >= 0) & (P[code] == Q)
+        F[F] = np.isin(np.asarray(sid)[F].astype('int64')*len(P) + code[F],T['key'])
+        
+        return F
+    
+    def _open_db(self,cr,keep_idx=None):
+        """
+        Opens the storage of a chromosome (columnar .cdb storage is preferred if present)
+        """
+        fn = self._refData+'.chr'+str(cr)
+        
+        if str(cr) in self._lazy:
+            db = vcfdb(*self._lazyopts,keep_idx=keep_idx)
+            db.open(self._lazy[str(cr)])
+            
+            return db
+        
+        if keep_idx is not None and self._subsetcache:
+            db = snpdb.cdb()
+            db.open(snpdb.subset(fn,keep_idx))
+            
+            return db
+        
+        if os.path.isfile(fn+'.cdb/meta.json'):
+            if keep_idx is None:
+                db = snpdb.cdb()
+            else:
+                db = snpdb.cdb_subset(keep_idx)
+        else:
+            if keep_idx is None:
+                db = snpdb.db()
+            else:
+                db = snpdb.db_subset(keep_idx)
+            
+        db.open(fn)
         
         return db
     
-    def set_refpanel(self,filename, parallel=1, keepfile=None, qualityT=100, SNPonly=False, chrlist=None, sourcefilename=None,regEx=None,nobar=True):
+    def _stamp(self,cr):
+        """
+        Returns a string identifying the state of the storage of a chromosome (changes on re-import and updates)
+        """
+        fn = self._refData+'.chr'+str(cr)
+        
+        if str(cr) in self._lazy:
+            F = [self._lazy[str(cr)]]
+        else:
+            F = [fn+'.db',fn+'.idx',fn+'.cols',fn+'.cdb']
+            
+        S = []
+        for f in F:
+            if os.path.exists(f):
+                s = os.stat(f)
+                S.append(f+':'+str(s.st_mtime_ns)+':'+str(s.st_size))
+                
+        return ';'.join(S)
+    
+    def _is_imported(self,cr):
+        """
+        Checks if the storage of a chromosome exists
+        """
+        fn = self._refData+'.chr'+str(cr)
+        
+        if os.path.isfile(fn+'.cdb/meta.json'):
+            return True
+        
+        return self._is_complete(fn)
+    
+    def _is_complete(self,fn):
+        """
+        Checks if a storage has been written completely
+        """
+        if not ((os.path.isfile(fn+'.idx/pos.npy') or os.path.isfile(fn+'.idx.old/pos.npy') or os.path.isfile(fn+'.idx.gz')) and os.path.isfile(fn+'.db')):
+            return False
+        
+        # Partially imported chromosomes carry a checkpoint
+        db = snpdb.db()
+        db.open(fn)
+        complete = db.getCheckpoint() is None
+        db.close()
+        
+        return complete
+    
+    def set_memory_model(self,**terms):
+        """
+        Sets terms of the memory estimate of one import process, which bounds the # of import processes for a membudget. The defaults were measured (tracemalloc) for the parsers of this module on x86_64 Linux.
+        
+        Args:
+        
+            base(int): Bytes independent of the data (interpreter and modules). Default 64MB
+            tped(float): Peak bytes per byte of a .tped line batch (lines and their parse with int64 genotypes). Default 15
+            vcf(float): Peak bytes per byte of a .vcf line batch. Default 3
+            bed(float): Peak bytes per byte of a packed .bed batch. Default 10
+            block(float): Bytes per sample of a compression block (256 records, their pickle and compressed copy), times 8 for .tped genotypes. Default 768
+            buffered(float): Bytes per record buffered until the next commit. Default 250
+            stored(float): Bytes per stored record for the index rebuild in commit. Default 200
+            bim(float): Bytes per line of the .bim table of .bed sources. Default 200
+            margin(float): Safety factor applied to the data dependent terms. Default 1.25
+        """
+        for k in terms:
+            if k not in self._memmodel:
+                print("ERROR: No term",k,"in the memory model. Available terms:",list(self._memmodel.keys()))
+                return
+            
+        self._memmodel.update(terms)
+        
+    def set_refpanel(self,filename, parallel=1, keepfile=None, qualityT=100, SNPonly=False, chrlist=None, sourcefilename=None,regEx=None,nobar=True,columnar=False,subsetcache=False,membudget=None,lazy=False):
         """
         Sets the reference panel to use
         
@@ -83,43 +406,84 @@ class refpanel:
             filename(string): /path/filename (without .chr#.db ending)
             parallel(int): Number of cores to use for parallel import of reference panel
             
-            keepfile(string): [only for .vcf] File with sample ids (one per line) to keep.  None to keep all.
+            keepfile(string): [only for .vcf and .bed] File with sample ids (one per line) to keep.  None to keep all.
             qualityT(int): [only for .vcf] Quality threshold for variant to keep (None to ignore)
-            SNPonly(bool): [only for .vcf] Load only SNPs 
+            SNPonly(bool): [only for .vcf and .bed] Load only SNPs 
             chrlist(list): List of chromosomes to import. (None to import 1-22)
             sourcefilename(string): /path/filename (without .chr#. ending) of .tped | .vcf files. None to use same as filename
-            regEx(string): Regular expression to filter sample ids. First capture group is kept. [only for .vcf]
+            regEx(string): Regular expression to filter sample ids. First capture group is kept. [only for .vcf and .bed]
             nobar(bool): Show progress bar (updates only if a chromosome finished)
+            columnar(bool|string): Convert the imported chromosomes into memory mapped columnar storage (.chr#.cdb). Set to 'packed' for 2-bit packed genotypes.
+            subsetcache(bool): Materialise sample subsets (keep_idx) once as columnar storages (.chr#.keep<hash>.cdb) instead of selecting the samples on every query
+            membudget(int): Memory budget (bytes) for the import. The number of import processes is reduced to stay within, estimating the memory per process with the memory model (see set_memory_model) (None for no limit)
+            lazy(bool): Serve not imported chromosomes directly from bgzipped and tabix indexed .chr#.vcf.gz files (.tbi or .csi index) instead of importing them
+            
+        Note:
+        
+            One file per chromosome with ending .chr#.db required (#: 1-22). If imported reference panel is not present, PascalX will automatically try to import from .chr#.tped.gz, .chr#.vcf.gz or PLINK .chr#.bed/.bim/.fam files.
+            
+        Note:
+        
+            Imported chromosomes can be updated without re-import via append_variants, remove_variants, add_samples and compact.
+            
+        Note:
+        
+            If present, the columnar storage .chr#.cdb is used instead of .chr#.db.
             
         Note:
         
-            One file per chromosome with ending .chr#.db required (#: 1-22). If imported reference panel is not present, PascalX will automatically try to import from .chr#.tped.gz or .chr#.vcf.gz files.
+            With lazy=True, gene windows are read from the .vcf.gz file on demand. SNP id lookups (e.g. for mapped SNPs outside of the window) only find SNPs of already read regions.
             
         Note:
         
-            Alleles (under .vcf import) are stored internally in the order [ALT,REF].
+            Alleles (under .vcf import) are stored internally in the order [ALT,REF]. Under .bed import, they are stored in the order [A1,A2] (genotypes count A1).
             
         """
         self._refData = filename
         self._srcData = sourcefilename
+        self._subsetcache = subsetcache
         
         if chrlist is None:
-            NF = []
-            for i in range(1,23):
-                if not os.path.isfile(filename+".chr"+str(i)+".idx.gz") or not os.path.isfile(filename+".chr"+str(i)+".db"):
-                    NF.append(i)
-        else: 
-            NF = []
+            chrlist = [i for i in range(1,23)]
+        
+        self._lazy = {}
+        if lazy:
+            src = filename if sourcefilename is None else sourcefilename
+            
             for i in chrlist:
-                if not os.path.isfile(filename+".chr"+str(i)+".idx.gz") or not os.path.isfile(filename+".chr"+str(i)+".db"):
-                    NF.append(i)
+                vcf = src+'.chr'+str(i)+'.vcf.gz'
+                
+                if not self._is_imported(i) and os.path.isfile(vcf) and (os.path.isfile(vcf+'.tbi') or os.path.isfile(vcf+'.csi')):
+                    self._lazy[str(i)] = vcf
+            
+            self._lazyopts = [keepfile,qualityT,SNPonly,regEx]
+            
+            # Store sample keys
+            if len(self._lazy) > 0:
+                db = self._open_db(list(self._lazy.keys())[0])
+                
+                with open(self._refData+'.sampleIds.txt','wt') as g:
+                    g.write("\t".join(db.getSampleIds())+'\n')
+                    
+                db.close()
+        
+        NF = []
+        for i in chrlist:
+            if not self._is_imported(i) and str(i) not in self._lazy:
+                NF.append(i)
             
         # Import if missing
         if len(NF) > 0:
             print("Reference panel data not imported. Trying to import...")
-            self._import_reference(chrs=NF,parallel=parallel,keepfile=keepfile,qualityT=qualityT,SNPonly=SNPonly,regEx=regEx,nobar=nobar)
+            self._import_reference(chrs=NF,parallel=parallel,keepfile=keepfile,qualityT=qualityT,SNPonly=SNPonly,regEx=regEx,nobar=nobar,membudget=membudget)
+        
+        # Convert to columnar storage
+        if columnar:
+            for i in chrlist:
+                if not os.path.isfile(filename+".chr"+str(i)+".cdb/meta.json") and os.path.isfile(filename+".chr"+str(i)+".db"):
+                    snpdb.convert(filename+".chr"+str(i),packed=(columnar=='packed'))
             
-    def _import_reference_thread_tped(self,i):
+    def _import_reference_thread_tped(self,i,unit=None):
         
         # Load
         if self._srcData is None:
@@ -127,45 +491,161 @@ class refpanel:
         else:
             fn = self._srcData
             
-        with gzip.open(fn+'.chr'+str(i)+'.tped.gz','rt') as f:
+        # Work unit [storage name, virtual offset of the first line, virtual end offset] (None for the whole file)
+        if unit is None:
+            unit = [self._refData+'.chr'+str(i),None,None]
+        elif self._is_complete(unit[0]):
+            return True
+            
+        with _open_unit(fn+'.chr'+str(i)+'.tped.gz',unit) as f:
             
             db = snpdb.db()
-            db.open(self._refData+'.chr'+str(i))
+            db.open(unit[0])
             
-            for line in f:
-               
-                L = line.split() # [chr,rid,irrelevant,pos,genotype]
+            # Resume interrupted import
+            C = db.getCheckpoint()
+            skip = 0 if C is None else C['lines']
+            commit = skip
             
-                # Get genotype and dephase
-                if L[1][0:2] == 'rs':
-                    
-                    dephased = (np.array(L[4:],dtype='b') - 1)
-                    genotype = np.sum(dephased.reshape((int(len(dephased)/2),2)),axis=1)
-                    
-                    # PLINK uses 1 for minor allele -> Convert to minor allele count
-                    genotype[genotype==2] = -1
-                    genotype[genotype==0] = 2
-                    genotype[genotype==-1] = 0
-                    
-                    m = np.mean(genotype)
-                    s = np.std(genotype)
-                    
-                    if s!=0:
-                        # Compute MAF
-                        MAF = m/2.
-                        if (MAF > 0.5):
-                            MAF = 1.0 - MAF;
-
-                        T = [L[1],round(MAF,3),genotype]
+            for n, lines in _batches(f,skip,self._batchbytes):
+                R = _parse_tped_batch(lines)
+                
+                db.insert_many([x[0] for x in R],[x[1] for x in R])
+                
+                if n - commit >= self._commitlines:
+                    db.commit({'lines':n})
+                    commit = n
                     
-                        # Store                             
-                        db.insert({int(L[3]):T})
-                                  
+            db.commit()
             db.close()
             
         return True
         
-    def _import_reference_thread_vcf(self,i,keepfile,qualityT,SNPonly,regEx=None):
+    def _import_reference_thread_bed(self,i,keepfile,SNPonly,regEx=None,unit=None):
+        # Load filter info
+        keep = set([])
+        if keepfile is not None:
+            f = open(keepfile,'r')
+            for line in f:
+                S = line.split("\t")[0]
+                keep.add(S)
+
+            f.close()
+        
+        # Load
+        if self._srcData is None:
+            fn = self._refData
+        else:
+            fn = self._srcData
+        
+        fn = fn+'.chr'+str(i)
+        
+        # Work unit [storage name, first position, end position (exclusive)]
+        if unit is None:
+            unit = [self._refData+'.chr'+str(i),None,None]
+        elif self._is_complete(unit[0]):
+            return True
+        
+        # Samples (individual ids of the .fam file)
+        with open(fn+'.fam','r') as f:
+            tmp = [line.split()[1] for line in f if line.strip() != '']
+        
+        m = len(tmp)
+        
+        # RegEx processing of sample names
+        if regEx is not None:
+            for j in range(0,len(tmp)):
+                M = re.search(regEx,tmp[j])
+                try:
+                    tmp[j] = M.group(1)
+                except:
+                    continue
+        
+        sampleKeys = np.array([j for j in range(0,m) if (keepfile is None) or (tmp[j] in keep)],dtype='int64')
+        
+        # Store sample keys
+        with open(self._refData+'.sampleIds.txt','wt') as g:
+            g.write("\t".join([tmp[j] for j in sampleKeys])+'\n')
+        
+        # Variants in position order
+        rid, pos, A1, A2 = _read_bim(fn+'.bim')
+        
+        rows = np.argsort(pos,kind='stable')
+        
+        # Position range of the work unit
+        if unit[1] is not None:
+            rows = rows[pos[rows] >= unit[1]]
+            
+        if unit[2] is not None:
+            rows = rows[pos[rows] < unit[2]]
+        
+        # Genotypes (variant-major, 2 bits per sample)
+        w = (m+3)//4
+        
+        bed = np.memmap(fn+'.bed',dtype='B',mode='r')
+        
+        if len(bed) < 3 or bed[0] != 0x6c or bed[1] != 0x1b:
+            raise IOError(fn+".bed is not a PLINK .bed file")
+            
+        if bed[2] != 1:
+            raise IOError(fn+".bed is not in variant-major mode")
+            
+        if len(bed) != 3 + w*len(pos):
+            raise IOError(fn+".bed does not match "+fn+".bim and "+fn+".fam")
+            
+        G = bed[3:].reshape((len(pos),w))
+        
+        db = snpdb.db()
+        db.open(unit[0])
+        
+        # Resume interrupted import
+        C = db.getCheckpoint()
+        skip = 0 if C is None else C['lines']
+        commit = skip
+        
+        # Variants per batch
+        step = max(1,self._batchbytes//(4*w))
+        
+        for k in range(skip,len(rows),step):
+            
+            if k - commit >= self._commitlines:
+                db.commit({'lines':k})
+                commit = k
+            
+            R = rows[k:k+step]
+            
+            # Minor (A1) allele count
+            X = _BED[snpdb.unpack_genotypes(G[R],m)[:,sampleKeys]]
+            
+            mean = np.mean(X,axis=1)
+            std = np.std(X,axis=1)
+            
+            for j in range(0,len(R)):
+                r = R[j]
+                
+                if (rid[r][:2] != 'rs') or (SNPonly and (len(A1[r]) > 1 or len(A2[r]) > 1)):
+                    continue
+                
+                if std[j] != 0:
+                    # Compute MAF
+                    MAF = mean[j]/2.
+                    if (MAF > 0.5):
+                        MAF = 1.0 - MAF;
+                    
+                    T = [rid[r],round(MAF,3),X[j],A1[r],A2[r]]
+                    
+                    # Store
+                    db.insert({int(pos[r]):T})
+        
+        del G
+        del bed
+        
+        db.commit()
+        db.close()
+        
+        return True
+    
+    def _import_reference_thread_vcf(self,i,keepfile,qualityT,SNPonly,regEx=None,unit=None):
         # Load filter info
         keep = set([])
         if keepfile is not None:
@@ -184,6 +664,12 @@ class refpanel:
         else:
             fn = self._srcData
             
+        # Work unit [storage name, virtual offset of the first line, virtual end offset] (None for the whole file)
+        if unit is None:
+            unit = [self._refData+'.chr'+str(i),None,None]
+        elif self._is_complete(unit[0]):
+            return True
+            
         with gzip.open(fn+'.chr'+str(i)+'.vcf.gz','rt') as f:
             
             # Find header
@@ -194,22 +680,7 @@ class refpanel:
 
                 # Detect sample names
                 if line[:2] == "#C":
-                    data = line.split("\t")
-                    tmp = data[9:]
-                    
-                    # RegEx processing of sample names
-                    if regEx is not None:
-                        for j in range(0,len(tmp)):
-                            m = re.search(regEx,tmp[j])
-                            try:
-                                tmp[j] = m.group(1)
-                            except:
-                                continue
-                            
-                    for j in range(0,len(tmp)):
-                        if (keepfile is None) or (tmp[j] in keep):
-                            sampleMap[j] = tmp[j]
-
+                    sampleMap = _sample_map(line,keepfile,keep,regEx)
                     break
 
             sampleKeys = list(sampleMap.keys())
@@ -226,102 +697,50 @@ class refpanel:
                 
                 
             db = snpdb.db()
-            db.open(self._refData+'.chr'+str(i))
+            db.open(unit[0])
             
-            # Main data import loop
-            for line in f:
-
-                # Data line
-                data = line.split("\t")
-
-                # Get GT pos
-                tmp = data[8].split(":")
-                GT = -1
-                for j in range(0,len(tmp)):
-                    if tmp[j] == 'GT':
-                        GT = j
-                        break
-
-                # Checks
-                if (GT == -1) or (data[2][:2] != 'rs') or (data[6] != 'PASS' and qualityT is not None and (int(data[5]) < qualityT)):
-                    continue
-
-                # Read genotype
-                genotypes = data[9:]
-
-                # Infer alternate alleles (pos 0: ref allele)
-                alleles = [data[3]]
-                alleles.extend(data[4].split(","))
-                
-                if SNPonly and (len(data[3]) > 1):
-                    continue
-                               
-                counter = np.zeros(len(alleles),dtype='int') 
-
-                # Only read samples in sampleMap
-                genomap = {}
-                for j in range(0,len(sampleKeys)):
-                    
-                    geno = genotypes[sampleKeys[j]].split(":")[GT]
-
-                    # Ignore half-calls
-                    if geno[0] != "." and geno[2] != ".":
-                        counter[int(geno[0])] += 1
-                        counter[int(geno[2])] += 1
-                    
-                    genomap[sampleKeys[j]] = geno
-                    
-                # Reference allele
-                refp = 0
+            # Resume interrupted import
+            C = db.getCheckpoint()
+            skip = 0 if C is None else C['lines']
+            commit = skip
+            
+            sampleKeys = np.array(sampleKeys,dtype='int64')
+            
+            # Seek to the lines of the work unit
+            if unit[1] is not None or unit[2] is not None:
+                f.close()
+                f = _open_unit(fn+'.chr'+str(i)+'.vcf.gz',unit)
+            
+            # Main data import loop 
+            for n, lines in _batches(f,skip,self._batchbytes):
+                for T in _parse_vcf_batch(lines,sampleKeys,qualityT,SNPonly):
+                    db.insert({T[0]:T[1]})
                 
-                SC = np.argsort(counter) # Sort alleles count
-                for p in SC:
-                    
-                    if p != refp:
-                        if SNPonly and len(alleles[p]) > 1:
-                            continue
-
-                        minp = str(p)
-
-                        gd = np.zeros(len(sampleKeys),dtype='B')
-
-                        for j in range(0,len(sampleKeys)):
-                            #geno = genotypes[sampleKeys[j]].split(":")[GT]
-                            geno = genomap[sampleKeys[j]]
-
-                            # Ignore half-calls
-                            if geno[0] != '.' and geno[2] != '.':
-
-                                if geno[0] == minp:
-                                    gd[j] += 1
-
-                                if geno[2] == minp:
-                                    gd[j] += 1
-
-                        # Compute MAF
-                        MAF = np.mean(gd)/2.
-                        if (MAF > 0.5):
-                            MAF = 1.0 - MAF;
-                        
-                        T = [data[2],MAF,gd,alleles[p],alleles[refp]] # Stores alt and ref allele
-
-                        db.insert({int(data[1]):T})
+                if n - commit >= self._commitlines:
+                    db.commit({'lines':n})
+                    commit = n
                 
             f.close()
+            db.commit()
             db.close()
             
         return True
         
 
-    def _import_reference(self,chrs=[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22],parallel=1,keepfile=None,qualityT=100,SNPonly=False,regEx=None,nobar=True):
+    def _import_reference(self,chrs=[1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22],parallel=1,keepfile=None,qualityT=100,SNPonly=False,regEx=None,nobar=True,membudget=None):
         """
-        Imports reference data from .tped.gz or .vcf.gz files.
+        Imports reference data from .tped.gz, .vcf.gz or .bed/.bim/.fam files.
         (Has only to be run once. The imported data is stored on disk for later usage.)
         
         chrs    : List of chromosomes to import
-        parallel: # of cores to use (WARNING: Take care that you have sufficient memory!)
-        keepfile: File with sample ids (one per line) to keep (only for .vcf) 
+        parallel: # of cores to use
+        keepfile: File with sample ids (one per line) to keep (only for .vcf and .bed) 
         qualityT: Quality threshold for variant to keep (only for .vcf) (None to ignore)
+        membudget: Memory budget in bytes (None for no limit). The # of cores is reduced if the estimated memory use would exceed it.
+        
+        Interrupted imports are resumed from the last checkpoint (written every _commitlines source lines).
+        
+        With parallel > 1, large chromosomes are split into work units of similar size, which are imported longest first and merged afterwards. Units of bgzip compressed .tped.gz/.vcf.gz files start reading directly at their first line (plain gzip compressed files are imported as one unit).
         
         Warning: 
             Direct .vcf import is currently only experimental !
@@ -335,37 +754,381 @@ class refpanel:
             fn = self._srcData
             
         for i in chrs:
-            if not os.path.isfile(fn+".chr"+str(i)+".tped.gz") and not os.path.isfile(fn+".chr"+str(i)+".vcf.gz"):
-                print("ERROR: ", fn+".chr"+str(i)+".(tped|vcf).gz", "not found")   
-                return
-
             if os.path.isfile(fn+".chr"+str(i)+".tped.gz"):
                 cmd = 'tped'
-            else:
+            elif os.path.isfile(fn+".chr"+str(i)+".vcf.gz"):
                 cmd = 'vcf'
+            elif os.path.isfile(fn+".chr"+str(i)+".bed"):
+                cmd = 'bed'
+            else:
+                print("ERROR: ", fn+".chr"+str(i)+".(tped.gz|vcf.gz|bed)", "not found")   
+                return
             
-        # Start import    
-        pool = mp.Pool(max(1,min(parallel,mp.cpu_count())))
-           
-        with tqdm(total=len(chrs), desc="Importing reference panel", bar_format="{l_bar}{bar} [ estimated time left: {remaining} ]",file=sys.stdout,disable=nobar) as pbar:
+        self._drop_snp_tables()
+        
+        # Plan work units
+        cores = max(1,min(parallel,mp.cpu_count()))
+        
+        if membudget is not None:
+            M = max([self._worker_memory(_source(fn,i,cmd),cmd) for i in chrs])
+            n = max(1,int(membudget//M))
+            
+            if n < cores:
+                print("[WARNING]: Using",n,"instead of",cores,"import processes to stay within the memory budget")
+                cores = n
+                
+        units = self._plan_units(chrs,fn,cmd,cores)
+        
+        # Start import    
+        with tqdm(total=len(units), desc="Importing reference panel", bar_format="{l_bar}{bar} [ estimated time left: {remaining} ]",file=sys.stdout,disable=nobar) as pbar:
         
             def update(*a):
                 pbar.update(1)
-
-            res = []
-            for i in chrs:
-                if cmd == 'tped':
-                    res.append(pool.apply_async(self._import_reference_thread_tped, args=(i,), callback=update))
-                elif cmd == 'vcf':
-                    res.append(pool.apply_async(self._import_reference_thread_vcf, args=(i,keepfile,qualityT,SNPonly,regEx), callback=update))
             
+            if cores == 1:
+                for U in units:
+                    self._import_unit(cmd,U,keepfile,qualityT,SNPonly,regEx)
+                    update()
+            else:
+                pool = mp.Pool(cores)
                 
-            # Wait to finish
-            for r in res:
-                r.get()
-
-        pool.close()
+                res = []
+                for U in units:
+                    res.append(pool.apply_async(self._import_unit, args=(cmd,U,keepfile,qualityT,SNPonly,regEx), callback=update))
+                
+                # Wait to finish
+                for r in res:
+                    r.get()
+                    
+                pool.close()
+        
+        # Merge the work units of split chromosomes
+        for i in chrs:
+            parts = [U[1][0] for U in units if U[0] == i and U[1][0] != self._refData+'.chr'+str(i)]
+            
+            if len(parts) > 0:
+                snpdb.concat(sorted(parts,key=lambda x: int(x.rsplit('.part',1)[1])),self._refData+'.chr'+str(i))
+                
+                for P in parts:
+                    os.remove(P+'.db')
+                    shutil.rmtree(P+'.idx',ignore_errors=True)
+        
+    def _worker_memory(self,filename,cmd):
+        """
+        Estimates the peak memory (bytes) of one import process for a chromosome source file from the terms of the memory model (see set_memory_model): line batch, compression block and index
+        
+        The number of stored records is derived from the .bim file for .bed sources and extrapolated from the compression ratio of the first 4MB of lines otherwise. Split chromosomes are accounted as a whole.
+        """
+        M = self._memmodel
+        
+        if cmd == 'bed':
+            with open(filename[:-4]+'.fam','r') as f:
+                m = sum(1 for line in f if line.strip() != '')
+            
+            with open(filename[:-4]+'.bim','rb') as f:
+                n = sum(1 for line in f)
+            
+            # Unpacked batch, .bim table and index
+            return int(M['base'] + M['margin']*(M['bed']*self._batchbytes + M['block']*m + M['buffered']*self._commitlines + (M['stored']+M['bim'])*n))
+        
+        m = 0
+        c = 0
+        b = 0
+        with gzip.open(filename,'rb') as f:
+            for line in f:
+                if line[:1] == b'#':
+                    continue
+                
+                if c == 0:
+                    m = max(0,(len(line.split())-4)//2) if cmd == 'tped' else max(0,line.count(b'\t')-8)
+                
+                c += 1
+                b += len(line)
+                
+                if b >= 2**22:
+                    break
+            
+            r = f.fileobj.tell()
+        
+        # Extrapolate the number of lines
+        n = c if b < 2**22 else int(c*os.path.getsize(filename)/max(1,r))
+        batch = self._batchbytes + b/max(1,c)
+        
+        if cmd == 'tped':
+            E = M['tped']*batch + 8*M['block']*m
+        else:
+            E = M['vcf']*batch + M['block']*m
+            
+        return int(M['base'] + M['margin']*(E + M['buffered']*self._commitlines + M['stored']*n))
+    
+    def _import_unit(self,cmd,U,keepfile,qualityT,SNPonly,regEx):
+        if cmd == 'tped':
+            return self._import_reference_thread_tped(U[0],U[1])
+        elif cmd == 'bed':
+            return self._import_reference_thread_bed(U[0],keepfile,SNPonly,regEx,U[1])
+        else:
+            return self._import_reference_thread_vcf(U[0],keepfile,qualityT,SNPonly,regEx,U[1])
+    
+    def _plan_units(self,chrs,fn,cmd,cores):
+        """
+        Splits the chromosomes into work units of similar size, sorted longest first. .bed files are split into position ranges, bgzip compressed .tped.gz and .vcf.gz files into virtual offset ranges of lines (other .gz files are not split).
+        
+        Returns:
+        
+            list: [chromosome, [storage name, first position (offset), end position (offset)], estimated size]
+        """
+        S = {}
+        for i in chrs:
+            S[i] = os.path.getsize(_source(fn,i,cmd))
+        
+        # About four units per core
+        target = max(1,sum(S.values()))/(4*cores)
+        
+        K = {}
+        for i in chrs:
+            K[i] = 1 if cores == 1 else max(1,int(round(S[i]/target)))
+        
+        units = []
+        for i in chrs:
+            name = self._refData+'.chr'+str(i)
+            
+            B = []
+            if K[i] > 1 and cmd == 'bed':
+                # Boundaries at quantiles of the positions (variants at the same position stay in one unit)
+                P = np.sort(_read_bim(fn+'.chr'+str(i)+'.bim')[1])
+                B = [int(x) for x in np.unique(P[(len(P)*np.arange(1,K[i]))//K[i]])] if len(P) > 0 else []
+            
+            elif K[i] > 1 and tabix.isbgzf(_source(fn,i,cmd)):
+                # Boundaries at line starts of similar compressed size (units seek directly to their first line)
+                X = tabix.bgzf(_source(fn,i,cmd))
+                B = X.split(K[i])
+                X.close()
+                
+            elif K[i] > 1:
+                print("[WARNING]: "+_source(fn,i,cmd)+" is not bgzip compressed -> imported as one unit")
+                
+            if len(B) == 0:
+                units.append([i,[name,None,None],S[i]])
+            else:
+                B = [None] + B + [None]
+                
+                for k in range(0,len(B)-1):
+                    units.append([i,[name+'.part'+str(k),B[k],B[k+1]],S[i]/(len(B)-1)])
+                
+        units.sort(key=lambda U: U[2],reverse=True)
+        
+        return units
+        
+    def append_variants(self,cr,sourcefilename,keepfile=None,qualityT=100,SNPonly=False,regEx=None):
+        """
+        Appends new variants to an imported chromosome
+        
+        Args:
+        
+            cr(int): Chromosome number
+            sourcefilename(string): /path/filename (without .chr#. ending) of the .tped.gz, .vcf.gz or .bed/.bim/.fam file with the new variants
+            keepfile(string): [only for .vcf and .bed] File with sample ids (one per line) to keep.  None to keep all.
+            qualityT(int): [only for .vcf] Quality threshold for variant to keep (None to ignore)
+            SNPonly(bool): [only for .vcf and .bed] Load only SNPs 
+            regEx(string): Regular expression to filter sample ids. First capture group is kept. [only for .vcf and .bed]
+            
+        Returns:
+        
+            int: # of appended variants
+            
+        Note:
+        
+            The source has to hold the same samples (in the same order) as the imported chromosome, including samples added via add_samples. Otherwise, nothing is appended. Variants at already stored positions are skipped.
+        """
+        fn = self._refData+'.chr'+str(cr)
+        
+        if os.path.isfile(sourcefilename+'.chr'+str(cr)+'.tped.gz'):
+            cmd = 'tped'
+        elif os.path.isfile(sourcefilename+'.chr'+str(cr)+'.vcf.gz'):
+            cmd = 'vcf'
+        elif os.path.isfile(sourcefilename+'.chr'+str(cr)+'.bed'):
+            cmd = 'bed'
+        else:
+            print("ERROR: ", sourcefilename+".chr"+str(cr)+".(tped.gz|vcf.gz|bed)", "not found")
+            return 0
+        
+        # Import into a temporary storage (keeps .sampleIds.txt of the panel)
+        ref = self._refData
+        src = self._srcData
+        tmp = self._refData+'.append'+str(os.getpid())
+        
+        self._refData = tmp
+        self._srcData = sourcefilename
+        
+        try:
+            self._import_unit(cmd,[cr,None],keepfile,qualityT,SNPonly,regEx)
+        finally:
+            self._refData = ref
+            self._srcData = src
+        
+        try:
+            new = snpdb.db()
+            new.open(tmp+'.chr'+str(cr))
+            
+            db = snpdb.db()
+            db.open(fn)
+            
+            n = 0
+            if len(new._off) > 0:
+                m = len(new._read(0)[2])
+                M = len(db._read(0)[2]) if len(db._off) > 0 else m
+                
+                if m != M:
+                    print("ERROR: ", sourcefilename+".chr"+str(cr), "holds",m,"instead of",M,"samples -> no variants appended")
+                else:
+                    rpos = np.repeat(np.asarray(new._pos),np.diff(new._ptr))
+                    F = np.isin(rpos,np.asarray(db._pos))
+                    
+                    if np.any(F):
+                        print("[WARNING]:",int(np.sum(F)),"variants at already stored positions skipped")
+                    
+                    R = np.flatnonzero(~F)
+                    if len(R) > 0:
+                        db.insert_many(rpos[R].tolist(),[new._read(r) for r in R])
+                        db.commit()
+                        
+                    n = len(R)
+                    
+            db.close()
+            new.close()
+        finally:
+            for p in glob.glob(tmp+'.*'):
+                if os.path.isdir(p):
+                    shutil.rmtree(p)
+                else:
+                    os.remove(p)
+        
+        if n > 0:
+            self._invalidate(cr)
+            
+        return n
+    
+    def remove_variants(self,cr,snpids):
+        """
+        Removes variants from an imported chromosome. The data is only dropped from the index, compact frees the space.
         
+        Args:
+        
+            cr(int): Chromosome number
+            snpids(list): SNP ids of the variants to remove
+            
+        Returns:
+        
+            int: # of removed variants
+        """
+        db = snpdb.db()
+        db.open(self._refData+'.chr'+str(cr))
+        n = db.remove(snpids)
+        db.close()
+        
+        if n > 0:
+            self._invalidate(cr)
+            
+        return n
+    
+    def add_samples(self,cr,sourcefilename,keepfile=None,qualityT=100,SNPonly=False,regEx=None):
+        """
+        Adds the samples of a .vcf.gz file to an imported chromosome without re-importing the stored samples
+        
+        Args:
+        
+            cr(int): Chromosome number
+            sourcefilename(string): /path/filename (without .chr#. ending) of the .vcf.gz file with the new samples
+            keepfile(string): File with sample ids (one per line) to keep.  None to keep all.
+            qualityT(int): Quality threshold for variant to keep (None to ignore)
+            SNPonly(bool): Load only SNPs 
+            regEx(string): Regular expression to filter sample ids. First capture group is kept.
+            
+        Returns:
+        
+            int: # of stored variants found in the file
+            
+        Note:
+        
+            Stored variants not in the file are missing for the new samples (stored as genotype 0, see snpdb.db.add_samples). The sample ids are appended to .sampleIds.txt.
+        """
+        keep = set([])
+        if keepfile is not None:
+            with open(keepfile,'r') as f:
+                for line in f:
+                    keep.add(line.split("\t")[0])
+        
+        P = []
+        S = []
+        A = []
+        G = []
+        with gzip.open(sourcefilename+'.chr'+str(cr)+'.vcf.gz','rt') as f:
+            sampleMap = {}
+            for line in f:
+                if line[:2] == "#C":
+                    sampleMap = _sample_map(line,keepfile,keep,regEx)
+                    break
+                    
+            sampleKeys = np.array(list(sampleMap.keys()),dtype='int64')
+            
+            for n, lines in _batches(f,0,self._batchbytes):
+                for T in _parse_vcf_batch(lines,sampleKeys,qualityT,SNPonly):
+                    P.append(T[0])
+                    S.append(T[1][0])
+                    A.append(T[1][3])
+                    G.append(T[1][2])
+        
+        db = snpdb.db()
+        db.open(self._refData+'.chr'+str(cr))
+        n = db.add_samples(P,S,np.array(G,dtype='B').reshape((len(G),len(sampleKeys))),A)
+        db.close()
+        
+        # Store sample keys
+        with open(self._refData+'.sampleIds.txt','r') as g:
+            s = g.read().rstrip('\n')
+            
+        with open(self._refData+'.sampleIds.txt','wt') as g:
+            g.write("\t".join([s]+[str(sampleMap[j]) for j in sampleKeys])+'\n')
+        
+        self._invalidate(cr)
+        
+        return n
+    
+    def compact(self,cr):
+        """
+        Rewrites an updated chromosome with removed variants dropped and added samples merged into the records
+        
+        Args:
+        
+            cr(int): Chromosome number
+        """
+        snpdb.compact(self._refData+'.chr'+str(cr))
+        
+        self._invalidate(cr)
+    
+    def _invalidate(self,cr):
+        """
+        Removes the columnar storages derived from an updated chromosome
+        """
+        fn = self._refData+'.chr'+str(cr)
+        
+        for p in [fn+'.cdb'] + glob.glob(fn+'.keep*.cdb'):
+            if os.path.isdir(p):
+                print("[WARNING]:",p,"is outdated and has been removed")
+                shutil.rmtree(p)
+        
+        self._drop_snp_tables()
+        
+    def _drop_snp_tables(self):
+        """
+        Removes the allele table and the SNP id table (rebuilt on next use)
+        """
+        self._alleletable = None
+        self._snpids = None
+        
+        for x in ['.alleles.npz','.snpids.npy']:
+            if os.path.isfile(self._refData+x):
+                os.remove(self._refData+x)
         
     def getSNPtoChrMap(self):
         """
@@ -393,4 +1156,627 @@ class refpanel:
         db = self.load_snp_reference(cr)
        
         return db.getSNPKeys()
-       
\ No newline at end of file
+       
+
+
+class vcfdb:
+    """
+    Read-only storage serving queries straight from a bgzipped and tabix indexed (.tbi or .csi) .vcf.gz file without import. 
+    
+    Only the blocks overlapping a queried region are read. The parsed variants are kept per position tile in a LRU cache, such that overlapping gene windows are parsed only once. Lookups by SNP id build an index of all SNP ids by one pass over the file on first use. Records are as for an import of the .vcf.gz file.
+    
+    """
+    _packed = False
+    
+    def __init__(self,keepfile=None,qualityT=100,SNPonly=False,regEx=None,keep_idx=None,tilesize=2**16,cachesize=64):
+        """
+        Args:
+        
+            keepfile(string): File with sample ids (one per line) to keep. None to keep all.
+            qualityT(int): Quality threshold for variant to keep (None to ignore)
+            SNPonly(bool): Load only SNPs
+            regEx(string): Regular expression to filter sample ids. First capture group is kept.
+            keep_idx(ndarray): Indices of the kept samples to return (None for all)
+            tilesize(int): Size of the cached position tiles (bp)
+            cachesize(int): Max # of parsed tiles to keep in memory
+        """
+        self._keepfile = keepfile
+        self._qualityT = qualityT
+        self._SNPonly = SNPonly
+        self._regEx = regEx
+        self._keep = keep_idx
+        self._tilesize = tilesize
+        self._cachesize = cachesize
+        
+        pass
+    
+    def open(self,filename):
+        """
+        Opens the .vcf.gz file
+        
+        Args:
+        
+            filename(string): /path/filename of the .vcf.gz file
+        """
+        self._filename = filename
+        self._tbx = tabix.tabixfile(filename)
+        self._cache = OrderedDict()
+        self._all = None
+        
+        keep = set([])
+        if self._keepfile is not None:
+            with open(self._keepfile,'r') as f:
+                for line in f:
+                    keep.add(line.split("\t")[0])
+        
+        self._sampleMap = {}
+        for line in self._tbx.header():
+            if line[:2] == "#C":
+                self._sampleMap = _sample_map(line,self._keepfile,keep,self._regEx)
+        
+        self._sampleKeys = np.array(list(self._sampleMap.keys()),dtype='int64')
+        
+        # Sequence name of the chromosome (files hold one chromosome)
+        self._name = self._tbx.names[0] if len(self._tbx.names) > 0 else None
+        
+    def getSampleIds(self):
+        """
+        Returns the ids of the kept samples
+        """
+        return [self._sampleMap[j] for j in self._sampleKeys]
+    
+    def _tile(self,t):
+        """
+        Returns the parsed variants of position tile t as [positions, records]
+        """
+        if t in self._cache:
+            self._cache.move_to_end(t)
+            return self._cache[t]
+        
+        start = t*self._tilesize
+        end = start + self._tilesize
+        
+        lines = [line for line in self._tbx.fetch(self._name,start-1,end-1) if line[0] != '#' and start <= int(line.split("\t",2)[1]) < end]
+        
+        R = _parse_vcf_batch(lines,self._sampleKeys,self._qualityT,self._SNPonly)
+        
+        T = [np.array([x[0] for x in R],dtype='int64'),[x[1] for x in R]]
+        
+        self._cache[t] = T
+        if len(self._cache) > self._cachesize:
+            self._cache.popitem(last=False)
+            
+        return T
+    
+    def _records(self,start,end):
+        """
+        Returns the positions and records in the closed interval [start,end]
+        """
+        P = []
+        D = []
+        for t in range(max(0,start)//self._tilesize,max(0,end)//self._tilesize+1):
+            T = self._tile(t)
+            
+            for k in np.flatnonzero((T[0] >= start) & (T[0] <= end)):
+                P.append(T[0][k])
+                D.append(list(T[1][k]))
+                
+        return P, D
+    
+    def _select(self,X):
+        if self._keep is not None and len(X['gt']) > 0:
+            X['gt'] = X['gt'][:,self._keep]
+            
+        return X
+    
+    def get_range(self,start,end,maf_min=None,rsid_filter=None,unpack=True):
+        """
+        Returns all stored data for SNPs in a position range as arrays (see snpdb.db.get_range)
+        """
+        P, D = self._records(start,end)
+        
+        return self._select(snpdb._toarrays(P,D,maf_min,rsid_filter))
+    
+    def get_pos(self,pos,maf_min=None,rsid_filter=None,unpack=True):
+        """
+        Returns all stored data for a set of SNPs indexed via positions as arrays (see snpdb.db.get_range)
+        """
+        P = []
+        D = []
+        for p in np.asarray(pos,dtype='int64'):
+            A, B = self._records(p,p)
+            P.extend(A)
+            D.extend(B)
+            
+        return self._select(snpdb._toarrays(P,D,maf_min,rsid_filter))
+    
+    def get(self,pos):
+        """
+        Returns all stored data for a set of SNPs indexed via positions
+        """
+        E = []
+        for p in pos:
+            _, D = self._records(p,p)
+            
+            if len(D) > 0:
+                for x in D:
+                    if self._keep is not None:
+                        x[2] = x[2][self._keep]
+                        
+                    E.append(x)
+            else:
+                E.append(None)
+                
+        return E
+    
+    def getSNPatPos(self,pos):
+        """
+        Returns SNP id at position
+        """
+        return [x if x is None else x[0] for x in self.get(pos)]
+    
+    def getPosatSNPsBulk(self,snpids,last=False):
+        """
+        Returns the positions corresponding to a list of snpids as array (-1 for snpids not in the file)
+        
+        Note:
+        
+            The SNP id index is built by one pass over the file on the first call.
+        """
+        S = self._scan()
+        
+        return snpdb._lookup(S[2],S[3],snpids,last)
+    
+    def getPosatSNPs(self,snpids):
+        P = self.getPosatSNPsBulk(snpids)
+        
+        return P[P >= 0].tolist()
+    
+    def getSNPsPos(self,snpids):
+        P = self.getPosatSNPsBulk(snpids,last=True)
+        
+        return P[P >= 0].tolist()
+    
+    def getSNPs(self,snps):
+        """
+        Returns all stored data for a set of SNPs indexed via SNP ids
+        """
+        E = []
+        for s, p in zip(snps,self.getPosatSNPsBulk(snps)):
+            E.append(None)
+            
+            if p >= 0:
+                for x in self.get([p]):
+                    if x is not None and x[0] == s:
+                        E[-1] = x
+                        
+        return E
+    
+    def _variants(self):
+        """
+        Yields the fields of the data lines kept by the import filters (see _parse_vcf_batch) together with their kept alternate alleles (one pass over the file)
+        """
+        with gzip.open(self._filename,'rt') as f:
+            for line in f:
+                if line[0] == '#':
+                    continue
+                
+                data = line.split("\t",9)
+                
+                if ('GT' not in data[8].split(":")) or (data[2][:2] != 'rs') or (data[6] != 'PASS' and self._qualityT is not None and (int(data[5]) < self._qualityT)):
+                    continue
+                    
+                if self._SNPonly and (len(data[3]) > 1):
+                    continue
+                
+                A = [a for a in data[4].split(",") if not (self._SNPonly and len(a) > 1)]
+                
+                if len(A) > 0:
+                    yield data, A
+    
+    def _scan(self):
+        """
+        Reads positions and SNP ids of all variants (one pass over the file)
+        """
+        if self._all is None:
+            P = []
+            S = []
+            for data, _ in self._variants():
+                for s in data[2].split(";"):
+                    P.append(int(data[1]))
+                    S.append(s)
+            
+            P = np.array(P,dtype='int64')
+            tokens = np.array(S,dtype='S')
+            J = np.lexsort((np.arange(0,len(P)),tokens))
+            
+            self._all = [P,np.array(S),tokens[J],P[J]]
+            
+        return self._all
+    
+    def getAlleles(self):
+        """
+        Returns the alleles of all SNP ids in the file (requires one pass over the file, see snpdb.db.getAlleles)
+        """
+        S = []
+        alt = []
+        ref = []
+        for data, A in self._variants():
+            for a in A:
+                for s in data[2].split(";"):
+                    S.append(s)
+                    alt.append(a)
+                    ref.append(data[3])
+                        
+        return np.array(S,dtype='U'), np.array(alt,dtype='U'), np.array(ref,dtype='U')
+    
+    def getSNPKeys(self):
+        """
+        Returns the SNP ids in the file (requires one pass over the file)
+        """
+        return set(self._scan()[1].tolist())
+    
+    def getKeys(self):
+        """
+        Returns SNP positions in the file (requires one pass over the file)
+        """
+        return np.unique(self._scan()[0])
+    
+    def getSortedKeys(self):
+        """
+        Returns a sorted view of the SNP positions. Range queries read only the overlapping blocks.
+        """
+        return _vcfkeys(self)
+    
+    def getCheckpoint(self):
+        return None
+    
+    def close(self):
+        """
+        Closes the file
+        """
+        self._cache = OrderedDict()
+        self._tbx.close()
+        
+    def share(self):
+        """
+        Nothing to share (workers re-open the file)
+        """
+        return self
+    
+    def release(self):
+        self.close()
+        
+    def __getstate__(self):
+        S = dict(self.__dict__)
+        for k in ['_tbx','_cache']:
+            S.pop(k,None)
+            
+        return S
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.open(self._filename)
+        
+        # Keep the SNP id index of the parent
+        self._all = state.get('_all')
+        
+
+class _vcfkeys(snpdb.sortedkeys):
+    """
+    Sorted view on the SNP positions of a vcfdb. Range queries are served from the overlapping blocks, all other operations scan the file once.
+    """
+    def __init__(self,db):
+        self._db = db
+        
+    @property
+    def _keys(self):
+        return np.unique(self._db._scan()[0])
+    
+    def irange(self,minimum=None,maximum=None):
+        if minimum is None or maximum is None:
+            return super().irange(minimum,maximum)
+        
+        P, _ = self._db._records(minimum,maximum)
+        
+        return np.unique(np.array(P,dtype='int64')).tolist()
+    
+    def __contains__(self,pos):
+        P, _ = self._db._records(pos,pos)
+        
+        return len(P) > 0
+    
+
+def _source(fn,i,cmd):
+    """
+    Returns the source file of a chromosome (the .bed file for PLINK filesets)
+    """
+    if cmd == 'bed':
+        return fn+'.chr'+str(i)+'.bed'
+    
+    return fn+'.chr'+str(i)+'.'+cmd+'.gz'
+
+
+def _sample_map(line,keepfile,keep,regEx):
+    """
+    Returns the column index and name of the samples to keep from the #CHROM header line of a VCF file
+    """
+    data = line.split("\t")
+    tmp = data[9:]
+    
+    # RegEx processing of sample names
+    if regEx is not None:
+        for j in range(0,len(tmp)):
+            m = re.search(regEx,tmp[j])
+            try:
+                tmp[j] = m.group(1)
+            except:
+                continue
+    
+    sampleMap = {}
+    for j in range(0,len(tmp)):
+        if (keepfile is None) or (tmp[j] in keep):
+            sampleMap[j] = tmp[j]
+    
+    return sampleMap
+
+
+def _open_unit(filename,unit):
+    """
+    Opens the lines of a work unit of a .tped.gz or .vcf.gz file as text stream
+    """
+    if unit[1] is None and unit[2] is None:
+        return gzip.open(filename,'rt')
+    
+    return tabix.bgzf(filename).open(0 if unit[1] is None else unit[1],unit[2])
+    
+
+def _read_bim(filename):
+    """
+    Reads a PLINK .bim file
+    
+    Returns:
+    
+        SNP ids, positions (ndarray), A1 alleles and A2 alleles
+    """
+    rid = []
+    pos = []
+    A1 = []
+    A2 = []
+    
+    with open(filename,'r') as f:
+        for line in f:
+            L = line.split() # [chr,rid,cM,pos,A1,A2]
+            
+            if len(L) < 6:
+                continue
+            
+            rid.append(L[1])
+            pos.append(int(L[3]))
+            A1.append(L[4])
+            A2.append(L[5])
+            
+    return rid, np.array(pos,dtype='int64'), A1, A2
+
+
+def _batches(f,skip=0,size=2**24):
+    """
+    Yields batches of VCF (or tped) data lines (of about size characters) together with the number of data lines read so far. Header lines (#) are dropped, as well as the first skip data lines.
+    """
+    n = 0
+    B = []
+    b = 0
+    
+    for line in f:
+        if line[0] == '#':
+            continue
+        
+        n += 1
+        if n <= skip:
+            continue
+        
+        B.append(line)
+        b += len(line)
+        
+        if b >= size:
+            yield n, B
+            B = []
+            b = 0
+            
+    if len(B) > 0:
+        yield n, B
+        
+
+def _parse_tped_batch(lines):
+    """
+    Parses a batch of tped lines (alleles coded 1,2) into records [position,[SNP id,MAF,genotype]]
+    """
+    H = [line.split(None,4) for line in lines] # [chr,rid,irrelevant,pos,genotype]
+    H = [L for L in H if L[1][0:2] == 'rs']
+    
+    if len(H) == 0:
+        return []
+    
+    G = [L[4].rstrip() if len(L) > 4 else '' for L in H]
+    
+    # Vectorised for the lines of the most common length with single character alleles separated by single spaces
+    N = np.array([len(g) for g in G],dtype='int64')
+    n = np.bincount(N).argmax()
+    
+    V = np.flatnonzero(N == n) if n % 4 == 3 else np.zeros(0,dtype='int64')
+    
+    if len(V) > 0:
+        buf = np.frombuffer(''.join([G[k] for k in V]).encode(),dtype='B').reshape((len(V),n))
+        
+        F = np.all(buf[:,1::2] == 32,axis=1) & np.all((buf[:,0::2] >= 48) & (buf[:,0::2] <= 57),axis=1)
+        V = V[F]
+        
+        # Dephase
+        A = buf[F][:,0::2].astype('int64') - 49
+        S = [[V,A[:,0::2] + A[:,1::2]]]
+    else:
+        S = []
+        
+    # Generic per line parsing
+    F = np.ones(len(G),dtype='bool')
+    F[V] = False
+    
+    for k in np.flatnonzero(F):
+        dephased = (np.array(G[k].split(),dtype='b') - 1)
+        S.append([[k],np.atleast_2d(np.sum(dephased.reshape((int(len(dephased)/2),2)),axis=1))])
+    
+    R = []
+    for rows, D in S:
+        # PLINK uses 1 for minor allele -> Convert to minor allele count
+        genotype = D.copy()
+        genotype[D==2] = 0
+        genotype[D==0] = 2
+        genotype[D==-1] = 0
+        
+        m = np.mean(genotype,axis=1)
+        s = np.std(genotype,axis=1)
+        
+        # Compute MAF
+        MAF = m/2.
+        MAF = np.where(MAF > 0.5,1.0 - MAF,MAF)
+        MAF = np.round(MAF,3)
+        
+        for k in np.flatnonzero(s != 0):
+            L = H[rows[k]]
+            R.append([rows[k],[int(L[3]),[L[1],MAF[k],genotype[k]]]])
+    
+    # Keep the line order
+    R.sort(key=lambda x: x[0])
+    
+    return [x[1] for x in R]
+    
+
+def _parse_gt(samples,sampleKeys,GT):
+    """
+    Parses the genotype calls of the selected samples of a VCF data line
+    
+    Args:
+    
+        samples(string): Sample columns of the line
+        sampleKeys(ndarray): Indices of the samples to read
+        GT(int): Index of the GT sub-field
+        
+    Returns:
+    
+        Allele indices of both haplotypes and the mask of full calls
+    """
+    samples = samples.rstrip('\n')
+    
+    # Vectorised: locate the GT sub-field of each sample and read its first three bytes (e.g. 0|1)
+    buf = np.frombuffer(samples.encode(),dtype='B')
+    tabs = np.flatnonzero(buf == 9)
+    
+    starts = np.zeros(len(tabs)+1,dtype='int64')
+    starts[1:] = tabs+1
+    ends = np.full(len(tabs)+1,len(buf),dtype='int64')
+    ends[:-1] = tabs
+    
+    st = starts[sampleKeys]
+    en = ends[sampleKeys]
+    
+    if GT > 0:
+        colons = np.flatnonzero(buf == 58)
+        
+        if len(colons) > 0:
+            # The GT-th colon has to lie within the field of the sample (missing sub-fields -> generic parsing)
+            c = np.searchsorted(colons,st) + GT - 1
+            F = c < len(colons)
+            F[F] = colons[c[F]] < en[F]
+            
+            st = np.where(F,colons[np.minimum(c,len(colons)-1)] + 1,en)
+        else:
+            st = en
+            
+    if np.all(en-st >= 3):
+        a = buf[st].astype('int64') - 48
+        b = buf[st+2].astype('int64') - 48
+        
+        called = (a != -2) & (b != -2) # '.' 
+        
+        if np.all((a[called] >= 0) & (a[called] <= 9) & (b[called] >= 0) & (b[called] <= 9)):
+            return a, b, called
+    
+    # Generic per sample parsing
+    G = samples.split("\t")
+    
+    a = np.full(len(sampleKeys),-1,dtype='int64')
+    b = np.full(len(sampleKeys),-1,dtype='int64')
+    called = np.zeros(len(sampleKeys),dtype='bool')
+    
+    for j in range(0,len(sampleKeys)):
+        geno = G[sampleKeys[j]].split(":")
+        
+        # Trailing sub-fields may be dropped
+        if len(geno) <= GT:
+            continue
+        
+        geno = geno[GT]
+        
+        # Ignore half-calls
+        if geno[0] != "." and geno[2] != ".":
+            a[j] = int(geno[0])
+            b[j] = int(geno[2])
+            called[j] = True
+            
+    return a, b, called
+    
+
+def _parse_vcf_batch(lines,sampleKeys,qualityT,SNPonly):
+    """
+    Parses a batch of VCF data lines into records [position,[SNP id,MAF,genotype,alternate allele,reference allele]]
+    """
+    R = []
+    
+    for line in lines:
+        
+        # Data line
+        data = line.split("\t",9)
+
+        # Get GT pos
+        tmp = data[8].split(":")
+        GT = -1
+        for j in range(0,len(tmp)):
+            if tmp[j] == 'GT':
+                GT = j
+                break
+
+        # Checks
+        if (GT == -1) or (data[2][:2] != 'rs') or (data[6] != 'PASS' and qualityT is not None and (int(data[5]) < qualityT)):
+            continue
+
+        # Infer alternate alleles (pos 0: ref allele)
+        alleles = [data[3]]
+        alleles.extend(data[4].split(","))
+
+        if SNPonly and (len(data[3]) > 1):
+            continue
+        
+        a, b, called = _parse_gt(data[9],sampleKeys,GT)
+        
+        counter = np.bincount(np.concatenate([a[called],b[called]]),minlength=len(alleles))
+        
+        # Reference allele
+        refp = 0
+
+        SC = np.argsort(counter) # Sort alleles count
+        for p in SC:
+
+            if p != refp:
+                if SNPonly and len(alleles[p]) > 1:
+                    continue
+                
+                gd = ((a == p) & called).astype('B') + ((b == p) & called).astype('B')
+                
+                # Compute MAF
+                MAF = np.mean(gd)/2.
+                if (MAF > 0.5):
+                    MAF = 1.0 - MAF;
+                
+                R.append([int(data[1]),[data[2],MAF,gd,alleles[p],alleles[refp]]]) # Stores alt and ref allele
+                
+    return R
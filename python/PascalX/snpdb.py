@@ -22,100 +22,1726 @@ import zlib
 import gzip
 import os.path
 import pickle
-from sortedcontainers import SortedList
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+    
+try:
+    import lz4.frame as lz4
+except ModuleNotFoundError:
+    lz4 = None
+
+# Lookup tables for 2-bit packed genotypes (4 samples per byte, first sample in the lowest bits)
+_UNPACK = np.array([[(i >> (2*k)) & 3 for k in range(0,4)] for i in range(0,256)],dtype='B')
+_POPCOUNT = np.array([bin(i).count('1') for i in range(0,256)],dtype='B')
+
+
+def pack_genotypes(G):
+    """
+    Packs genotypes (0,1,2 minor allele counts) into 2-bit encoding with four samples per byte
+    
+    Args:
+        
+        G(ndarray): Genotype vector or matrix (SNPs x samples)
+        
+    Returns:
+    
+        ndarray: uint8 matrix (SNPs x ceil(samples/4))
+    """
+    G = np.atleast_2d(np.asarray(G,dtype='B'))
+    n, m = G.shape
+    w = (m+3)//4
+    
+    X = np.zeros((n,4*w),dtype='B')
+    X[:,:m] = G
+    X = X.reshape((n,w,4))
+    
+    return X[:,:,0] | (X[:,:,1] << 2) | (X[:,:,2] << 4) | (X[:,:,3] << 6)
+
+
+def unpack_genotypes(P,m):
+    """
+    Unpacks 2-bit encoded genotypes 
+    
+    Args:
+    
+        P(ndarray): Packed genotype vector or matrix
+        m(int): Number of samples
+        
+    """
+    P = np.asarray(P,dtype='B')
+    
+    return _UNPACK[P].reshape(P.shape[:-1]+(4*P.shape[-1],))[...,:m]
+
+
+def _popcount(X):
+    """
+    Returns the number of set bits in the last axis of the uint64 array X
+    """
+    if hasattr(np,'bitwise_count'):
+        return np.bitwise_count(X).sum(axis=-1,dtype='int64')
+    else:
+        return _POPCOUNT[X.view('B')].sum(axis=-1,dtype='int64')
+
+    
+def corrcoef_packed(P,m,blocksize=2**24):
+    """
+    Pearson correlation matrix of 2-bit packed genotypes, computed via popcounts on the packed data
+    
+    Args:
+    
+        P(ndarray): Packed genotype matrix (SNPs x ceil(samples/4))
+        m(int): Number of samples
+        blocksize(int): Approximate number of bytes to process at once
+        
+    Note:
+    
+        With the bit planes a (dosage >= 1) and b (dosage 2) of a packed byte the dosage is g = a + b. Placing a on the even and b on the odd bits (U) and vice versa (V), the scalar product of two genotype vectors is popcount(U & U') + popcount(U & V').
+        
+    """
+    P = np.atleast_2d(np.asarray(P,dtype='B'))
+    n, w = P.shape
+    
+    # Pad to 64bit words
+    W = (w+7)//8
+    X = np.zeros((n,8*W),dtype='B')
+    X[:,:w] = P
+    X = X.view('uint64')
+    
+    mask = np.uint64(0x5555555555555555)
+    lo = X & mask
+    hi = (X >> np.uint64(1)) & mask
+    
+    a = lo | hi
+    U = a | (hi << np.uint64(1))
+    V = hi | (a << np.uint64(1))
+    
+    s = _popcount(a) + _popcount(hi)
+    q = _popcount(a) + 3*_popcount(hi)
+    
+    # Upper triangle of scalar products
+    S = np.zeros((n,n),dtype='int64')
+    b = max(1,blocksize//max(1,8*W*n))
+    for i in range(0,n,b):
+        j = min(i+b,n)
+        
+        S[i:j,i:] = _popcount(U[i:j,None,:] & U[None,i:,:]) + _popcount(U[i:j,None,:] & V[None,i:,:])
+    
+    S = np.triu(S) + np.triu(S,1).T
+    
+    cov = m*S - np.outer(s,s)
+    var = m*q - s*s
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        C = cov/np.sqrt(np.outer(var,var))
+    
+    return C
+    
+
+def corrcoef_stats(G,mean,std):
+    """
+    Pearson correlation matrix of genotypes with precomputed per SNP mean and standard deviation (as stored in .cdb storages)
+    
+    Args:
+    
+        G(ndarray): Genotype matrix (SNPs x samples)
+        mean(ndarray): Mean dosage of each SNP
+        std(ndarray): Standard deviation of the dosage of each SNP
+        
+    Note:
+    
+        The correlation reduces to one matrix product of the raw dosages. The products of dosages (0,1,2) are integers, which float32 represents exactly for less than 2^22 samples.
+    """
+    G = np.atleast_2d(G)
+    m = G.shape[1]
+    
+    F = G.astype('float32' if m < 2**22 else 'float64')
+    S = F.dot(F.T).astype('float64')
+    
+    mean = np.asarray(mean,dtype='float64')
+    std = np.asarray(std,dtype='float64')
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        C = (S/m - np.outer(mean,mean))/np.outer(std,std)
+    
+    np.clip(C,-1,1,out=C)
+    
+    return C
+
+
+def _stats(G):
+    """
+    Returns mean and standard deviation of the rows of a genotype matrix
+    """
+    G = np.asarray(G,dtype='float64')
+    
+    return np.mean(G,axis=1), np.std(G,axis=1)
+
+
+class ldtiles:
+    """
+    Cache of SNP-SNP correlation tiles for genes visited in position order along a chromosome
+    
+    SNPs enter a rolling buffer in order of first use, as rows centred and normalised in float64 (such that the correlations equal np.corrcoef). The correlations between tiles of buffer slots are computed once and the correlation matrix of a gene is assembled from the cached tiles, such that overlapping gene windows share the work. Buffer tiles before the first SNP of the current gene are released. The tiles are kept up to maxbytes, least recently used tiles are dropped first.
+    
+    """
+    def __init__(self,tilesize=128,maxbytes=2**28):
+        """
+        Args:
+            
+            tilesize(int): Number of buffer slots per tile
+            maxbytes(int): Max size of the cached correlation tiles in bytes
+        """
+        self._tilesize = tilesize
+        self._maxbytes = maxbytes
+        
+        self.clear()
+    
+    def clear(self):
+        """
+        Empties the buffer
+        """
+        self._slot = {}
+        self._rows = {}
+        self._tiles = OrderedDict()
+        self._bytes = 0
+        self._next = 0
+    
+    def corrcoef(self,keys,G):
+        """
+        Returns the Pearson correlation matrix of a set of SNPs
+        
+        Args:
+            
+            keys(list): Unique keys of the SNPs (for instance position and SNP id)
+            G(ndarray): Genotype matrix (SNPs x samples)
+        """
+        ts = self._tilesize
+        
+        S = np.array([self._slot.get(k,-1) for k in keys],dtype='int64')
+        
+        # Add new SNPs to the buffer
+        N = np.flatnonzero(S < 0)
+        if len(N) > 0:
+            F = np.atleast_2d(np.asarray(G))[N].astype('float64')
+            F -= np.mean(F,axis=1,keepdims=True)
+            
+            with np.errstate(divide='ignore',invalid='ignore'):
+                F /= np.sqrt(np.sum(F*F,axis=1,keepdims=True))
+            
+            for i in range(0,len(N)):
+                s = self._next
+                self._next += 1
+                
+                t = s // ts
+                if t not in self._rows:
+                    self._rows[t] = [[],[],None]
+                
+                R = self._rows[t]
+                R[0].append(keys[N[i]])
+                R[1].append(F[i])
+                R[2] = None
+                
+                self._slot[keys[N[i]]] = s
+                S[N[i]] = s
+            
+        # Release the buffer before the gene
+        t0 = np.min(S) // ts
+        for t in [t for t in self._rows if t < t0]:
+            for k in self._rows[t][0]:
+                del self._slot[k]
+            
+            del self._rows[t]
+            
+            for k in [k for k in self._tiles if k[0] == t or k[1] == t]:
+                self._bytes -= self._tiles.pop(k).nbytes
+        
+        # Assemble the correlation matrix from the tiles of the gene
+        T = S // ts
+        U = np.unique(T)
+        
+        B = np.empty((len(U)*ts,len(U)*ts))
+        for a in range(0,len(U)):
+            for b in range(a,len(U)):
+                X = self._tile(U[a],U[b])
+                
+                B[a*ts:a*ts+X.shape[0],b*ts:b*ts+X.shape[1]] = X
+                if a != b:
+                    B[b*ts:b*ts+X.shape[1],a*ts:a*ts+X.shape[0]] = X.T
+        
+        I = np.searchsorted(U,T)*ts + S % ts
+        
+        if np.all(np.diff(I) == 1):
+            return B[I[0]:I[-1]+1,I[0]:I[-1]+1].copy()
+        
+        return B.take(I,axis=0).take(I,axis=1)
+    
+    def _block(self,t):
+        """
+        Returns the centred and normalised genotypes of a buffer tile
+        """
+        R = self._rows[t]
+        
+        if R[2] is None:
+            R[2] = np.array(R[1])
+            
+        return R[2]
+    
+    def _tile(self,a,b):
+        """
+        Returns the correlations between the SNPs of buffer tiles a and b (extended if the tiles have grown)
+        """
+        Fa = self._block(a)
+        Fb = self._block(b)
+        
+        C = self._tiles.get((a,b))
+        
+        if C is None:
+            C = _corrtile(Fa,Fb)
+        elif C.shape != (len(Fa),len(Fb)):
+            i, j = C.shape
+            
+            X = np.empty((len(Fa),len(Fb)))
+            X[:i,:j] = C
+            X[:i,j:] = _corrtile(Fa[:i],Fb[j:])
+            X[i:,:] = _corrtile(Fa[i:],Fb)
+            
+            self._bytes -= self._tiles.pop((a,b)).nbytes
+            C = X
+        else:
+            self._tiles.move_to_end((a,b))
+            return C
+        
+        self._tiles[(a,b)] = C
+        self._bytes += C.nbytes
+        
+        # Drop the least recently used tiles
+        while self._bytes > self._maxbytes and len(self._tiles) > 1:
+            self._bytes -= self._tiles.popitem(last=False)[1].nbytes
+        
+        return C
+
+
+def _corrtile(Fa,Fb):
+    """
+    Returns the correlations between two sets of centred and normalised SNP rows
+    """
+    C = Fa.dot(Fb.T)
+    
+    np.clip(C,-1,1,out=C)
+    
+    return C
+    
+
+class sortedkeys:
+    """
+    Read-only view on a sorted array of SNP positions. Mimics the parts of the SortedList interface used by the scorers.
+    
+    """
+    def __init__(self,keys):
+        self._keys = keys
+        
+    def irange(self,minimum=None,maximum=None):
+        """
+        Returns the unique positions in the closed interval [minimum,maximum]
+        
+        Args:
+            
+            minimum(int): Lower bound (None for no bound)
+            maximum(int): Upper bound (None for no bound)
+            
+        """
+        lo = 0 if minimum is None else np.searchsorted(self._keys,minimum,side='left')
+        hi = len(self._keys) if maximum is None else np.searchsorted(self._keys,maximum,side='right')
+        
+        return np.unique(self._keys[lo:hi]).tolist()
+    
+    def __contains__(self,pos):
+        i = np.searchsorted(self._keys,pos,side='left')
+        return i < len(self._keys) and self._keys[i] == pos
+    
+    def __iter__(self):
+        return iter(np.unique(self._keys).tolist())
+    
+    def __len__(self):
+        return len(np.unique(self._keys))
+    
+    
 
 class db:
     """
     Class for handling storage of the raw genotype data. The data is indexed and stored for each chromosome individually as zlib compressed pickle. The indexing allows fast random access via SNP ids or positions.
     
+    The index is stored as binary arrays (.idx/) which are memory mapped on open and searched via binary search.
+    
+    Writes are transactional: the index is swapped in atomically on commit and records the committed length of the data file. Bytes appended after the last commit (e.g. by an interrupted import) are discarded on the next write, and a stored checkpoint allows to resume the import.
+    
+    New records are written in position ordered blocks, each compressed as one unit. Decompressed blocks are kept in a LRU cache, such that overlapping gene windows do not re-read the same variants.
+    
+    The storage can be updated incrementally: variants are appended via insert, removed via remove (tombstones) and samples added as column blocks (.cols/) via add_samples. compact rewrites the storage with the changes folded in.
+    
     """
+    _packed = False
+    _shm = None
+    _shared = ['_pos','_ptr','_off','_sidx','_srow','_spos']
     
-    def __init__(self):
+    def __init__(self,blocksize=256,cachesize=64,codec=None):
+        """
+        Args:
+        
+            blocksize(int): Number of variants to compress jointly (None for one compressed record per variant)
+            cachesize(int): Max # of decompressed blocks to keep in memory
+            codec(string): Codec for new blocks ('zstd','lz4','zlib'). None to use the fastest available.
+        """
         self._modified = False;
-        self._idx = [{},{},{}]
+        self._buf = [[],[],[],[]]
+        
+        self._blocksize = blocksize
+        self._cachesize = cachesize
+        self._codec = _codec(codec)
     
         pass
         
     def open(self,filename):
         """
-        Opens storage file. A new file is created if not exists.
+        Opens storage file. A new file is created if not exists.
+        
+        Args:
+            
+            filename(string): Name to use for the storage file
+            
+        Note:
+        
+            An index in the former .idx.gz format is converted once into the binary .idx format.
+        """
+        # Load index
+        self._filename = filename
+        self._buf = [[],[],[],[]]
+        self._block = []
+        self._inserted = 0
+        self._cache = OrderedDict()
+        self._checkpoint = None
+        
+        # Finish an interrupted compaction
+        if os.path.isfile(filename+'.compact'):
+            _finish_compact(filename)
+        
+        # Recover from an index swap interrupted between the two renames
+        if not os.path.isfile(filename+'.idx/pos.npy') and os.path.isfile(filename+'.idx.old/pos.npy'):
+            os.rename(filename+'.idx.old',filename+'.idx')
+        
+        if os.path.isfile(filename+'.idx/pos.npy'):
+            self._load_index(filename+'.idx')
+            
+        elif os.path.isfile(filename+".idx.gz"):
+            fp = gzip.open(filename+'.idx.gz','rb')
+            idx = pickle.load(fp)
+            fp.close()
+            
+            self._set_index(*_convert_index(idx))
+            self._size = os.path.getsize(filename+'.db') if os.path.isfile(filename+'.db') else 0
+            
+            try:
+                self._save_index()
+            except OSError:
+                pass
+        else:
+            self._set_index(np.zeros(0,dtype='int64'),np.zeros((0,3),dtype='int64'),np.zeros(0,dtype='S1'),np.zeros(0,dtype='int64'))
+            self._size = 0
+        
+        self._load_cols()
+        
+        # open file
+        self._datafile = open(filename+".db","a+b")
+   
+    def _load_index(self,path):
+        self._pos = np.load(path+'/pos.npy',mmap_mode='r')
+        self._ptr = np.load(path+'/ptr.npy',mmap_mode='r')
+        self._off = _offsets(np.load(path+'/off.npy',mmap_mode='r'))
+        self._sidx = np.load(path+'/sidx.npy',mmap_mode='r')
+        self._srow = np.load(path+'/srow.npy',mmap_mode='r')
+        
+        if os.path.isfile(path+'/spos.npy'):
+            self._spos = np.load(path+'/spos.npy',mmap_mode='r')
+        else:
+            self._spos = _rowPositions(self._pos,self._ptr,self._srow)
+        
+        # Committed length of the data file and import checkpoint
+        if os.path.isfile(path+'/meta.json'):
+            with open(path+'/meta.json','r') as fp:
+                meta = json.load(fp)
+                
+            self._size = meta['size']
+            self._checkpoint = meta['checkpoint']
+        else:
+            self._size = os.path.getsize(self._filename+'.db') if os.path.isfile(self._filename+'.db') else 0
+    
+    def _load_cols(self):
+        """
+        Loads the sample column blocks (.cols/)
+        """
+        self._cols = []
+        
+        path = self._filename+'.cols'
+        if os.path.isfile(path+'/meta.json'):
+            with open(path+'/meta.json','r') as fp:
+                meta = json.load(fp)
+            
+            for B in meta['blocks']:
+                C = dict(B)
+                for k in ['key','gt','maf','sum','miss']:
+                    C[k] = np.load(path+'/'+B['name']+'.'+k+'.npy',mmap_mode='r') if os.path.isfile(path+'/'+B['name']+'.'+k+'.npy') else None
+                    
+                self._cols.append(C)
+    
+    def _set_index(self,rpos,off,tokens,trow):
+        """
+        Builds the index arrays from per record positions, byte ranges (start,end,index in block) and the SNP id tokens of the records. Tokens have to be given in insertion order, the index keeps this order for records sharing a SNP id.
+        """
+        off = _offsets(off)
+        I = np.argsort(rpos,kind='stable')
+        
+        # Position index (CSR layout)
+        self._pos, cnt = np.unique(rpos[I],return_counts=True)
+        self._ptr = np.zeros(len(cnt)+1,dtype='int64')
+        self._ptr[1:] = np.cumsum(cnt)
+        self._off = off[I]
+        
+        # SNP id index
+        R = np.empty(len(I),dtype='int64')
+        R[I] = np.arange(0,len(I))
+        
+        trow = R[trow]
+        J = np.argsort(tokens,kind='stable')
+        self._sidx = tokens[J]
+        self._srow = trow[J]
+        
+        # Reverse index (position of each SNP id entry)
+        self._spos = _rowPositions(self._pos,self._ptr,self._srow)
+        
+    def _save_index(self):
+        path = self._filename+'.idx'
+        
+        if os.path.isdir(path+'.tmp'):
+            shutil.rmtree(path+'.tmp')
+            
+        os.makedirs(path+'.tmp')
+        np.save(path+'.tmp/pos.npy',self._pos)
+        np.save(path+'.tmp/ptr.npy',self._ptr)
+        np.save(path+'.tmp/off.npy',self._off)
+        np.save(path+'.tmp/sidx.npy',self._sidx)
+        np.save(path+'.tmp/srow.npy',self._srow)
+        np.save(path+'.tmp/spos.npy',self._spos)
+        
+        with open(path+'.tmp/meta.json','w') as fp:
+            json.dump({'size':self._size,'checkpoint':self._checkpoint},fp)
+        
+        # Swap in the new index (the previous index stays valid until the new one is in place)
+        if os.path.isdir(path):
+            if os.path.isdir(path+'.old'):
+                shutil.rmtree(path+'.old')
+                
+            os.rename(path,path+'.old')
+        
+        os.rename(path+'.tmp',path)
+        
+        if os.path.isdir(path+'.old'):
+            shutil.rmtree(path+'.old')
+        
+    def insert(self,data):
+        """
+        Stores set of rows into the file storage
+        
+        Args:
+            
+            data(dict): First storage key is the key in the dictionary. Second storage key is the first element of the inner list.
+            
+        Warning:
+            If all insert calls are done, the close function has to be called once to make the index persistent.
+            
+        Note:
+            Blocks are sorted by position internally. For good cache locality, data should be inserted in position order. Inserted rows are returned by the get functions before they are committed.
+        """
+        self.insert_many(list(data.keys()),list(data.values()))
+        
+    def insert_many(self,pos,records):
+        """
+        Stores a batch of rows into the file storage (see insert). Unlike for insert, positions may repeat.
+        
+        Args:
+        
+            pos(list): Positions of the rows
+            records(list): Rows [SNP id, ...] to store
+        """
+        if not self._modified:
+            # Discard data not covered by the last commit
+            self._datafile.truncate(self._size)
+            
+        self._modified = True;
+        
+        if self._blocksize is None:
+            self._datafile.seek(0,2)
+            
+            for k in range(0,len(pos)):
+                I = [0,0,-1]
+                I[0] = self._datafile.tell()
+                self._datafile.write(zlib.compress(pickle.dumps(records[k],protocol=pickle.HIGHEST_PROTOCOL)))
+                I[1] = self._datafile.tell()
+
+                self._buf[0].append(pos[k])
+                self._buf[1].append(I)
+                self._buf[2].append(records[k][0])
+                self._buf[3].append(len(self._buf[3]))
+        else:
+            for k in range(0,len(pos)):
+                self._block.append([pos[k],records[k],self._inserted])
+                self._inserted += 1
+                
+                if len(self._block) >= self._blocksize:
+                    self._flush()
+    
+    def _flush(self):
+        """
+        Writes the buffered records as one position ordered compressed block
+        """
+        if len(self._block) == 0:
+            return
+        
+        self._block.sort(key=lambda x: x[0])
+        
+        self._datafile.seek(0,2)
+        
+        start = self._datafile.tell()
+        self._datafile.write(_compress(pickle.dumps([x[1] for x in self._block],protocol=pickle.HIGHEST_PROTOCOL),self._codec))
+        end = self._datafile.tell()
+        
+        for k in range(0,len(self._block)):
+            self._buf[0].append(self._block[k][0])
+            self._buf[1].append([start,end,k])
+            self._buf[2].append(self._block[k][1][0])
+            self._buf[3].append(self._block[k][2])
+        
+        self._block = []
+    
+    def _merge(self):
+        """
+        Merges the records inserted since the last commit into the in-memory index (such that reads return them before the commit). The index is only written by commit.
+        """
+        if len(self._block) == 0 and len(self._buf[0]) == 0:
+            return
+        
+        self._flush()
+        self._datafile.flush()
+        
+        # Merge stored with inserted records
+        rpos = np.concatenate([np.repeat(np.asarray(self._pos),np.diff(self._ptr)),np.array(self._buf[0],dtype='int64')])
+        off = np.concatenate([_offsets(self._off),np.array(self._buf[1],dtype='int64').reshape((-1,3))])
+        
+        # SNP id entries of the new records in insertion order
+        S = np.argsort(np.array(self._buf[3],dtype='int64'),kind='stable')
+        tokens, trow = _tokenize([self._buf[2][k] for k in S])
+        trow = S[trow] + len(self._off)
+        tokens = np.concatenate([np.asarray(self._sidx),tokens])
+        trow = np.concatenate([np.asarray(self._srow),trow])
+        
+        self._set_index(rpos,off,tokens,trow)
+        self._buf = [[],[],[],[]]
+        
+    def _read(self,r):
+        """
+        Reads record r of the index (with the genotypes of added samples)
+        """
+        D = self._record(r)
+        
+        if len(self._cols) > 0:
+            # Column blocks added after the record was written
+            key = _recordkey(self._off[r:r+1])[0]
+            L = len(D[2])
+            
+            G = [np.asarray(D[2])]
+            for C in self._cols:
+                if C['start'] < L:
+                    continue
+                    
+                i = np.searchsorted(C['key'],key)
+                if i < len(C['key']) and C['key'][i] == key:
+                    G.append(C['gt'][i])
+                    D[1] = float(C['maf'][i])
+                else:
+                    G.append(np.zeros(C['n'],dtype='B'))
+            
+            if len(G) > 1:
+                D[2] = np.concatenate(G)
+        
+        return D
+    
+    def _record(self,r):
+        """
+        Reads record r of the data file
+        """
+        start = int(self._off[r,0])
+        end = int(self._off[r,1])
+        k = int(self._off[r,2])
+        
+        if k < 0:
+            self._datafile.seek(start)
+            data = self._datafile.read(end-start)
+            
+            return pickle.loads(zlib.decompress(data))
+        
+        # Block storage
+        if start in self._cache:
+            self._cache.move_to_end(start)
+            B = self._cache[start]
+        else:
+            self._datafile.seek(start)
+            B = pickle.loads(_decompress(self._datafile.read(end-start)))
+            
+            self._cache[start] = B
+            if len(self._cache) > self._cachesize:
+                self._cache.popitem(last=False)
+        
+        return list(B[k])
+    
+    def _findPos(self,pos):
+        """
+        Returns the range of records at position 
+        """
+        i = np.searchsorted(self._pos,pos,side='left')
+        
+        if i < len(self._pos) and self._pos[i] == pos:
+            return self._ptr[i],self._ptr[i+1]
+        else:
+            return 0,0
+        
+    def _find(self,snpid):
+        """
+        Returns the records storing the SNP id
+        """
+        key = snpid.encode()
+        i = np.searchsorted(self._sidx,key,side='left')
+        j = np.searchsorted(self._sidx,key,side='right')
+        
+        return self._srow[i:j]
+    
+    def get(self,pos):
+        """
+        Returns all stored data for a set of SNPs indexed via positions
+        
+        Args:
+            
+            pos(list): Positions of SNPs to retrieve 
+            
+        """
+        self._merge()
+        
+        E = []
+        for R in pos:
+            i,j = self._findPos(R)
+            
+            if j > i:
+                for r in range(i,j):
+                    E.append( self._read(r) )
+            else:
+                #print("Error:",R,"not found in index")
+                E.append(None)
+        
+        return E
+    
+    def getSNPatPos(self,pos):
+        """
+        Returns SNP id at position
+        
+        Args:
+            
+            pos(list): Positions of SNPs to retrieve 
+            
+        """
+        self._merge()
+        
+        E = []
+        for R in pos:
+            i,j = self._findPos(R)
+            
+            if j > i:
+                for r in range(i,j):
+                    E.append( self._read(r)[0] )
+            else:
+                #print("Error:",R,"not found in index")
+                E.append(None)
+        
+        return E
+        
+    def getPosatSNPs(self,snpids):
+        """
+        Returns the position corresponding to a snpid
+        """
+        P = self.getPosatSNPsBulk(snpids)
+                            
+        return P[P >= 0].tolist()
+        
+    def getSNPsPos(self,snpids):
+        """
+        Returns the positions corresponding to a list of snpids (of the last inserted record for SNP ids stored multiple times)
+        """
+        P = self.getPosatSNPsBulk(snpids,last=True)
+        
+        return P[P >= 0].tolist()
+    
+    def getPosatSNPsBulk(self,snpids,last=False):
+        """
+        Returns the positions corresponding to a list of snpids as array (-1 for snpids not in storage)
+        
+        Args:
+        
+            snpids(list): SNP ids to look up
+            last(bool): Use the last inserted record for SNP ids stored multiple times (first inserted otherwise)
+        """
+        self._merge()
+        
+        return _lookup(self._sidx,self._spos,snpids,last)
+
+    def getSNPs(self,snps):
+        """
+        Returns all stored data for a set of SNPs indexed via SNP ids
+        
+        Args:
+            
+            snp(list): ids of SNPs to retrieve 
+            
+        """
+        self._merge()
+        
+        E = []
+        for R in snps:
+            rows = self._find(R)
+            if len(rows) > 0:
+                for r in rows:
+                    E.append( self._read(r) )
+            else:
+                #print("Error:",R,"not found in index")
+                E.append(None)
+        
+        return E
+    
+    
+    def get_range(self,start,end,maf_min=None,rsid_filter=None,unpack=True):
+        """
+        Returns all stored data for SNPs in a position range as arrays
+        
+        Args:
+        
+            start(int): First position (inclusive)
+            end(int): Last position (inclusive)
+            maf_min(float): Only return SNPs with MAF > maf_min (None for no filter)
+            rsid_filter(set|dict): Only return SNPs with id in rsid_filter (None for no filter)
+            unpack(bool): Only relevant for packed storages
+            
+        Returns:
+        
+            dict: Position ordered arrays 'pos', 'rsid', 'maf', 'alt', 'ref' (None if no alleles stored), 'mean', 'std' (None if no statistics stored) and the genotype matrix 'gt' (SNPs x samples)
+        """
+        self._merge()
+        
+        i = np.searchsorted(self._pos,start,side='left')
+        j = np.searchsorted(self._pos,end,side='right')
+        
+        rows = np.arange(self._ptr[i],self._ptr[j])
+        
+        return self._arrays(rows,maf_min,rsid_filter)
+    
+    def get_pos(self,pos,maf_min=None,rsid_filter=None,unpack=True):
+        """
+        Returns all stored data for a set of SNPs indexed via positions as arrays (see get_range)
+        
+        Args:
+        
+            pos(list): Positions of SNPs to retrieve
+            maf_min(float): Only return SNPs with MAF > maf_min (None for no filter)
+            rsid_filter(set|dict): Only return SNPs with id in rsid_filter (None for no filter)
+            unpack(bool): Only relevant for packed storages
+        """
+        self._merge()
+        
+        return self._arrays(_rowsAtPos(self._pos,self._ptr,pos),maf_min,rsid_filter)
+        
+    def _arrays(self,rows,maf_min,rsid_filter):
+        rpos = _rowPositions(self._pos,self._ptr,rows)
+        
+        return _toarrays(rpos,[self._read(r) for r in rows],maf_min,rsid_filter)
+    
+    def getAlleles(self):
+        """
+        Returns the alleles of all stored SNP ids (one entry per SNP id and record)
+        
+        Returns:
+        
+            SNP ids, alternate alleles and reference alleles as arrays (alleles None if not stored)
+        """
+        self._merge()
+        
+        n = len(self._off)
+        
+        alt = np.empty(n,dtype='object')
+        ref = np.empty(n,dtype='object')
+        
+        for r in range(0,n):
+            D = self._record(r)
+            
+            if len(D) < 4:
+                return np.char.decode(np.asarray(self._sidx)), None, None
+            
+            alt[r] = D[3]
+            ref[r] = D[4]
+        
+        R = np.asarray(self._srow)
+        
+        return np.char.decode(np.asarray(self._sidx)), alt[R].astype('U'), ref[R].astype('U')
+    
+    def getSNPKeys(self):
+        """
+        Returns the SNP ids in storage 
+        """
+        self._merge()
+        
+        return set(np.char.decode(np.unique(self._sidx)).tolist())
+   
+    def getKeys(self):
+        """
+        Returns SNP positions in storage
+        """
+        self._merge()
+        
+        return self._pos
+   
+    def getSortedKeys(self):
+        """
+        Returns a sorted view of the SNP positions in storage
+        """
+        self._merge()
+        
+        return sortedkeys(self._pos)
+        
+    def commit(self,checkpoint=None):
+        """
+        Makes all inserts done so far persistent
+        
+        Args:
+        
+            checkpoint(dict): JSON serializable state of an unfinished import (see getCheckpoint). None marks the storage as complete.
+        """
+        if self._modified:
+            self._merge()
+            os.fsync(self._datafile.fileno())
+            
+            self._datafile.seek(0,2)
+            self._size = self._datafile.tell()
+        
+        elif checkpoint == self._checkpoint:
+            return
+        
+        self._checkpoint = checkpoint
+        self._save_index()
+            
+        self._modified = False
+    
+    def getCheckpoint(self):
+        """
+        Returns the checkpoint stored with the last commit (None if the storage is complete or empty)
+        """
+        return self._checkpoint
+    
+    def remove(self,snpids=None,pos=None):
+        """
+        Removes variants from the storage. Only the index is rewritten, the data stays in the storage file until compact.
+        
+        Args:
+        
+            snpids(list): SNP ids of the variants to remove
+            pos(list): Positions of the variants to remove
+            
+        Returns:
+        
+            int: # of removed records
+        """
+        if self._modified:
+            self.commit(self._checkpoint)
+        
+        D = np.zeros(len(self._off),dtype='bool')
+        
+        if snpids is not None:
+            for s in snpids:
+                D[self._find(s)] = True
+                
+        if pos is not None:
+            D[_rowsAtPos(self._pos,self._ptr,pos)] = True
+        
+        n = int(np.sum(D))
+        if n == 0:
+            return 0
+        
+        K = ~D
+        R = np.cumsum(K) - 1
+        F = K[self._srow]
+        
+        self._set_index(np.repeat(np.asarray(self._pos),np.diff(self._ptr))[K],_offsets(self._off)[K],np.asarray(self._sidx)[F],R[np.asarray(self._srow)[F]])
+        self._save_index()
+        
+        self._cache = OrderedDict()
+        
+        return n
+    
+    def add_samples(self,pos,rsids,G,alt=None):
+        """
+        Adds the genotypes of new samples as column block (.cols/) without rewriting the stored records
+        
+        Args:
+        
+            pos(list): Positions of the variants
+            rsids(list): SNP ids of the variants
+            G(ndarray): Genotypes of the new samples (variants x samples)
+            alt(list): Alternate alleles of the variants to distinguish multi-allelic sites (None to match via position and SNP id only)
+            
+        Returns:
+        
+            int: # of matched records
+            
+        Note:
+        
+            Stored variants not listed are missing for the new samples. As for missing calls in the importers, they are stored as genotype 0 and counted in the MAF, which is updated over all samples. In addition, the column block keeps a mask of these variants (bN.miss.npy, see getMissing) until compact. Variants inserted afterwards have to carry the genotypes of all samples.
+        """
+        if self._modified:
+            self.commit(self._checkpoint)
+            
+        G = np.atleast_2d(np.asarray(G,dtype='B'))
+        
+        n = len(self._off)
+        k = G.shape[1]
+        
+        rpos = np.repeat(np.asarray(self._pos),np.diff(self._ptr))
+        
+        H = np.zeros((n,k),dtype='B')
+        M = np.zeros(n,dtype='bool')
+        
+        for j in range(0,len(pos)):
+            rows = self._find(rsids[j])
+            rows = rows[rpos[rows] == pos[j]]
+            
+            if alt is not None:
+                rows = [x for x in rows if len(self._record(x)) < 4 or self._record(x)[3] == alt[j]]
+            
+            H[rows] = G[j]
+            M[rows] = True
+        
+        key = _recordkey(self._off)
+        
+        # Allele counts over the samples so far (kept with the last column block, read from the records otherwise)
+        S = np.zeros(n,dtype='float64')
+        F = np.zeros(n,dtype='bool')
+        
+        if len(self._cols) > 0:
+            C = self._cols[-1]
+            T = C['start'] + C['n']
+            
+            i = np.minimum(np.searchsorted(C['key'],key),len(C['key'])-1)
+            F = np.asarray(C['key'])[i] == key
+            S[F] = np.asarray(C['sum'])[i[F]]
+        else:
+            T = len(self._record(0)[2]) if n > 0 else 0
+        
+        for x in np.flatnonzero(~F):
+            S[x] = np.sum(self._read(x)[2])
+        
+        S += np.sum(H,axis=1)
+        
+        MAF = S/(2.*(T+k))
+        MAF = np.where(MAF > 0.5,1.0 - MAF,MAF)
+        
+        # Write block sorted by record key
+        I = np.argsort(key)
+        
+        path = self._filename+'.cols'
+        name = 'b'+str(len(self._cols))
+        
+        os.makedirs(path,exist_ok=True)
+        np.save(path+'/'+name+'.key.npy',key[I])
+        np.save(path+'/'+name+'.gt.npy',H[I])
+        np.save(path+'/'+name+'.maf.npy',MAF[I])
+        np.save(path+'/'+name+'.sum.npy',S[I])
+        np.save(path+'/'+name+'.miss.npy',~M[I])
+        
+        blocks = [{'name':C['name'],'start':C['start'],'n':C['n']} for C in self._cols]
+        blocks.append({'name':name,'start':int(T),'n':int(k)})
+        
+        with open(path+'/meta.json.tmp','w') as fp:
+            json.dump({'blocks':blocks},fp)
+            
+        os.replace(path+'/meta.json.tmp',path+'/meta.json')
+        
+        self._load_cols()
+        
+        return int(np.sum(M))
+    
+    def getMissing(self,pos):
+        """
+        Returns the samples missing for the variants at position (added via add_samples for variants not in the added file)
+        
+        Args:
+        
+            pos(int): Position
+            
+        Returns:
+        
+            list: Boolean array over the samples for each record at the position
+        """
+        if self._modified:
+            self.commit(self._checkpoint)
+            
+        i,j = self._findPos(pos)
+        if j <= i:
+            return []
+        
+        R = []
+        for r in range(i,j):
+            key = _recordkey(self._off[r:r+1])[0]
+            L = len(self._record(r)[2])
+            
+            F = [np.zeros(L,dtype='bool')]
+            for C in self._cols:
+                if C['start'] < L:
+                    continue
+                
+                i = np.searchsorted(C['key'],key)
+                if i < len(C['key']) and C['key'][i] == key:
+                    F.append(np.full(C['n'],C['miss'] is not None and bool(C['miss'][i])))
+                else:
+                    F.append(np.ones(C['n'],dtype='bool'))
+                    
+            R.append(np.concatenate(F))
+            
+        return R
+    
+    def close(self):
+        """
+        Closes open storage file. 
+        
+        Warning:
+            After all inserts are done this function has to be called once to re-generate the index and close the storage file.
+        """
+        if self._modified:
+            self.commit()
+        
+        self._buf = [[],[],[],[]]
+        self._cache = OrderedDict()
+        
+        # close 
+        self._datafile.close()
+        
+    def share(self):
+        """
+        Moves the index into shared memory. Pickled copies of the storage (as passed to multiprocessing workers) attach to the shared blocks by name instead of loading their own copy.
+        
+        Note:
+        
+            The creating process has to call release() once all workers are done.
+        """
+        _share(self)
+        
+        return self
+    
+    def release(self):
+        """
+        Closes the storage and frees its shared memory blocks (see share)
+        """
+        self.close()
+        _release(self)
+        
+    def __getstate__(self):
+        return _getstate(self)
+    
+    def __setstate__(self,state):
+        if _setstate(self,state):
+            self._buf = [[],[],[],[]]
+            self._block = []
+            self._cache = OrderedDict()
+            self._load_cols()
+            self._datafile = open(self._filename+".db","rb")
+        else:
+            self.open(self._filename)
+        
+
+class db_subset(db):
+    """
+    Class for handling storage of the raw genotype data. The data is indexed and stored for each chromosome individually as zlib compressed pickle. The indexing allows fast random access via SNP ids or positions.
+    
+    Allows to set indices for samples to keep
+    
+    """
+    def __init__(self,keep_idx,blocksize=256,cachesize=64,codec=None):
+        super().__init__(blocksize,cachesize,codec)
+    
+        self._keep = keep_idx
+        
+        pass
+    
+    def _read(self,r):
+        D = super()._read(r)
+        D[2] = D[2][self._keep]
+        
+        return D
+    
+    def _arrays(self,rows,maf_min,rsid_filter):
+        # Select the samples once on the stacked block instead of per record
+        rpos = _rowPositions(self._pos,self._ptr,rows)
+        
+        X = _toarrays(rpos,[db._read(self,r) for r in rows],maf_min,rsid_filter)
+        
+        if len(X['gt']) > 0:
+            X['gt'] = X['gt'][:,self._keep]
+        
+        return X
+    
+
+def _share(db):
+    """
+    Copies the read-only arrays of an opened storage into shared memory blocks
+    """
+    if db._shm is not None:
+        return
+    
+    if db._modified:
+        raise RuntimeError("Storage with pending inserts can not be shared")
+    
+    db._shm = {}
+    for k in db._shared:
+        A = getattr(db,k,None)
+        if A is None:
+            continue
+            
+        A = np.asarray(A)
+        shm = shared_memory.SharedMemory(create=True,size=max(1,A.nbytes))
+        S = np.ndarray(A.shape,dtype=A.dtype,buffer=shm.buf)
+        S[...] = A
+        S.flags.writeable = False
+        
+        db._shm[k] = shm
+        setattr(db,k,S)
+        
+    db._owner = True
+        
+
+def _release(db):
+    """
+    Frees the shared memory blocks of a storage (only unlinked by the creating process)
+    """
+    if db._shm is None:
+        return
+    
+    for k in db._shm:
+        setattr(db,k,None)
+        db._shm[k].close()
+        
+        if db._owner:
+            db._shm[k].unlink()
+            
+    db._shm = None
+        
+
+def _getstate(db):
+    """
+    Returns the picklable state of a storage. Shared arrays are passed by name, memory mapped and index arrays are re-loaded from disk, other arrays (e.g. the samples to keep of subsets) are passed by value.
+    """
+    if db._modified:
+        raise RuntimeError("Storage with pending inserts can not be pickled")
+    
+    S = {}
+    for k, v in db.__dict__.items():
+        if k in ['_datafile','_cache','_buf','_block','_shm','_owner','_cols']:
+            continue
+        
+        if db._shm is not None and k in db._shm:
+            S[k] = ('shm',db._shm[k].name,v.shape,v.dtype.str)
+        elif not isinstance(v,np.ndarray) or not (k in db._shared or isinstance(v,np.memmap)):
+            S[k] = v
+    
+    S['_shared_state'] = db._shm is not None
+    
+    return S
+
+
+def _setstate(db,state):
+    """
+    Restores a pickled storage. Returns False if the storage has to be re-opened from disk.
+    """
+    shared = state.pop('_shared_state')
+    
+    db._shm = {} if shared else None
+    db._owner = False
+    
+    for k, v in state.items():
+        if isinstance(v,tuple) and len(v) == 4 and v[0] == 'shm':
+            shm = shared_memory.SharedMemory(name=v[1])
+            db._shm[k] = shm
+            A = np.ndarray(v[2],dtype=np.dtype(v[3]),buffer=shm.buf)
+            A.flags.writeable = False
+            setattr(db,k,A)
+        else:
+            setattr(db,k,v)
+            
+    return shared
+
+
+def _tokenize(rsids,offset=0):
+    """
+    Splits the SNP ids of records (multiple ids separated by ;) into tokens
+    
+    Returns:
+    
+        Array of tokens and array of corresponding record indices (shifted by offset)
+    """
+    tokens = []
+    rows = []
+    for k in range(0,len(rsids)):
+        for r in rsids[k].split(";"):
+            tokens.append(r)
+            rows.append(k+offset)
+    
+    return np.array(tokens,dtype='S'),np.array(rows,dtype='int64')
+
+
+def _rowsAtPos(pos,ptr,P):
+    """
+    Returns the record rows stored at the positions P 
+    """
+    P = np.asarray(P,dtype='int64')
+    
+    i = np.searchsorted(pos,P,side='left')
+    F = i < len(pos)
+    F[F] = pos[i[F]] == P[F]
+    i = i[F]
+    
+    return np.concatenate([np.arange(0,0)]+[np.arange(ptr[k],ptr[k+1]) for k in i])
+
+
+def _recordkey(off):
+    """
+    Returns keys identifying records independent of their row in the index (data offset and index in block)
+    """
+    off = _offsets(off)
+    
+    return (off[:,0] << 16) | (off[:,2] & 0xffff)
+
+
+def _rowPositions(pos,ptr,rows):
+    """
+    Returns the positions of record rows
+    """
+    return np.asarray(pos)[np.searchsorted(ptr,rows,side='right')-1]
+
+
+def _lookup(sidx,spos,snpids,last=False):
+    """
+    Returns the positions of SNP ids via binary search in the sorted SNP id index (-1 if not found)
+    """
+    P = np.full(len(snpids),-1,dtype='int64')
+    
+    if len(snpids) == 0 or len(sidx) == 0:
+        return P
+    
+    K = np.char.encode(np.asarray(snpids,dtype='U'))
+    
+    i = np.searchsorted(sidx,K,side='left')
+    j = np.searchsorted(sidx,K,side='right')
+    
+    F = j > i
+    if last:
+        P[F] = spos[j[F]-1]
+    else:
+        P[F] = spos[i[F]]
+        
+    return P
+
+
+def _mask(X,maf_min,rsid_filter):
+    """
+    Returns the selection mask for MAF and SNP id filters (None if no filter set)
+    """
+    F = None
+    
+    if maf_min is not None:
+        F = X['maf'] > maf_min
+        
+    if rsid_filter is not None:
+        R = np.fromiter((r in rsid_filter for r in X['rsid']),dtype='bool',count=len(X['rsid']))
+        
+        if F is None:
+            F = R
+        else:
+            F &= R
+    
+    return F
+
+
+def _toarrays(rpos,DATA,maf_min=None,rsid_filter=None):
+    """
+    Converts a list of records into arrays (see db.get_range)
+    """
+    X = {}
+    X['pos'] = np.asarray(rpos,dtype='int64')
+    X['rsid'] = np.array([D[0] for D in DATA],dtype='U')
+    X['maf'] = np.array([D[1] for D in DATA],dtype='float64')
+    
+    if len(DATA) > 0 and len(DATA[0]) > 3:
+        X['alt'] = np.array([D[3] for D in DATA],dtype='U')
+        X['ref'] = np.array([D[4] for D in DATA],dtype='U')
+    else:
+        X['alt'] = None
+        X['ref'] = None
+    
+    X['mean'] = None
+    X['std'] = None
+    
+    F = _mask(X,maf_min,rsid_filter)
+    
+    if F is not None:
+        for k in X:
+            if X[k] is not None:
+                X[k] = X[k][F]
+                
+        DATA = [DATA[k] for k in np.flatnonzero(F)]
+    
+    if len(DATA) > 0:
+        X['gt'] = np.array([D[2] for D in DATA])
+    else:
+        X['gt'] = np.zeros((0,0),dtype='B')
+        
+    return X
+
+
+def take(X,rows):
+    """
+    Returns the selected rows of the arrays returned by get_range
+    
+    Args:
+    
+        X(dict): Return of get_range
+        rows(ndarray): Indices or boolean mask of rows to keep
+    """
+    Y = {}
+    for k in X:
+        if X[k] is None:
+            Y[k] = None
+        else:
+            Y[k] = X[k][rows]
+            
+    return Y
+
+
+def merge(X,Y):
+    """
+    Merges two returns of get_range into one position ordered set of arrays
+    """
+    if len(Y['pos']) == 0:
+        return X
+    
+    if len(X['pos']) == 0:
+        return Y
+    
+    Z = {}
+    for k in X:
+        if X[k] is None or Y[k] is None:
+            Z[k] = None
+        else:
+            Z[k] = np.concatenate([X[k],Y[k]])
+    
+    return take(Z,np.argsort(Z['pos'],kind='stable'))
+
+
+def select_unique(X):
+    """
+    Selects for each SNP id the variant with lowest MAF (first one on ties). The order of first occurrence of the SNP ids is kept.
+    
+    Args:
+    
+        X(dict): Return of get_range
+    """
+    if len(X['rsid']) < 2:
+        return X
+    
+    return take(X,_unique_rows(X))
+
+
+def _unique_rows(X):
+    """
+    Returns the indices of the rows selected by select_unique
+    """
+    n = len(X['rsid'])
+    
+    if n < 2:
+        return np.arange(0,n)
+    
+    I = np.lexsort((np.arange(0,n),X['maf'],X['rsid']))
+    R = X['rsid'][I]
+    
+    S = np.ones(n,dtype='bool')
+    S[1:] = R[1:] != R[:-1]
+    
+    _, first = np.unique(X['rsid'],return_index=True)
+    
+    return I[S][np.argsort(first)]
+
+
+def _codec(codec=None):
+    """
+    Returns the codec to use for compression of blocks
+    """
+    if codec is None:
+        if zstandard is not None:
+            return 'zstd'
+        elif lz4 is not None:
+            return 'lz4'
+        else:
+            return 'zlib'
+    
+    if (codec == 'zstd' and zstandard is None) or (codec == 'lz4' and lz4 is None):
+        print("[WARNING]: Codec",codec,"not available -> using zlib")
+        return 'zlib'
+    
+    return codec
+
+
+def _compress(data,codec):
+    """
+    Compresses a block. The first byte encodes the codec.
+    """
+    if codec == 'zstd':
+        return b's'+zstandard.ZstdCompressor().compress(data)
+    elif codec == 'lz4':
+        return b'l'+lz4.compress(data)
+    else:
+        return b'z'+zlib.compress(data)
+    
+
+def _decompress(data):
+    if data[:1] == b's':
+        return zstandard.ZstdDecompressor().decompress(data[1:])
+    elif data[:1] == b'l':
+        return lz4.decompress(data[1:])
+    else:
+        return zlib.decompress(data[1:])
+    
+
+def _offsets(off):
+    """
+    Returns byte ranges with index in block (-1 for single record storage)
+    """
+    if off.shape[1] == 2:
+        off = np.concatenate([off,-np.ones((len(off),1),dtype='int64')],axis=1)
+    
+    return off
+    
+
+def _convert_index(idx):
+    """
+    Converts an index in the former [pos->offsets, snp->offsets, snp->pos] dict format to arrays
+    """
+    rpos = []
+    off = []
+    R = {}
+    for pos in idx[0]:
+        for p in idx[0][pos]:
+            R[tuple(p)] = len(rpos)
+            rpos.append(pos)
+            off.append(p)
+    
+    tokens = []
+    trow = []
+    for snp in idx[1]:
+        for p in idx[1][snp]:
+            tokens.append(snp)
+            trow.append(R[tuple(p)])
+    
+    return np.array(rpos,dtype='int64'),np.array(off,dtype='int64').reshape((-1,2)),np.array(tokens,dtype='S'),np.array(trow,dtype='int64')
+
+
+class cdb:
+    """
+    Class for handling columnar storage of the raw genotype data. The genotypes of a chromosome are stored as one uint8 matrix (SNPs x samples) sorted by position, which is accessed via np.memmap. Positions, MAF, SNP ids and alleles are stored in sidecar arrays. Window queries are zero-copy slices of the memory mapped matrix.
+    
+    The mean and standard deviation of each SNP are computed once when the storage is written, such that correlations do not have to re-estimate them for every gene window.
+    
+    """
+    
+    _shm = None
+    _shared = ['_pos','_maf','_rsid','_sidx','_srow','_spos','_alt','_ref','_mean','_std']
+    
+    def __init__(self,packed=False):
+        """
+        Args:
+        
+            packed(bool): Store new genotypes 2-bit packed (four samples per byte)
+        """
+        self._modified = False
+        self._meta = None
+        self._packed = packed
+        
+        pass
+    
+    def open(self,filename):
+        """
+        Opens storage directory. A new storage is created if not exists.
         
         Args:
             
-            filename(string): Name to use for the storage file
+            filename(string): Name to use for the storage (without .cdb ending)
+            
+        Note:
+        
+            Existing storages are opened read-only.
         """
-        # Load index
         self._filename = filename
+        self._path = filename+'.cdb'
         
-        if os.path.isfile(filename+".idx.gz"):
-            fp = gzip.open(filename+'.idx.gz','rb')
-            self._idx = pickle.load(fp)
-            fp.close()
+        if os.path.isfile(self._path+'/meta.json'):
+            with open(self._path+'/meta.json','r') as fp:
+                self._meta = json.load(fp)
+            
+            self._packed = self._meta['packed']
+            self._nsamples = self._meta['nsamples']
+            
+            self._pos = np.load(self._path+'/pos.npy',mmap_mode='r')
+            self._maf = np.load(self._path+'/maf.npy',mmap_mode='r')
+            self._rsid = np.load(self._path+'/rsid.npy',mmap_mode='r')
+            self._sidx = np.load(self._path+'/sidx.npy',mmap_mode='r')
+            self._srow = np.load(self._path+'/srow.npy',mmap_mode='r')
+            
+            if os.path.isfile(self._path+'/spos.npy'):
+                self._spos = np.load(self._path+'/spos.npy',mmap_mode='r')
+            else:
+                self._spos = self._pos[self._srow]
+            
+            if self._meta['alleles']:
+                self._alt = np.load(self._path+'/alt.npy',mmap_mode='r')
+                self._ref = np.load(self._path+'/ref.npy',mmap_mode='r')
+            
+            # Genotype statistics (not present in storages written by older versions)
+            if os.path.isfile(self._path+'/std.npy'):
+                self._mean = np.load(self._path+'/mean.npy',mmap_mode='r')
+                self._std = np.load(self._path+'/std.npy',mmap_mode='r')
+            else:
+                self._mean = None
+                self._std = None
+            
+            self._open_gt()
         else:
-            self._idx = [{},{},{}]
-        
-        # open file
-        self._datafile = open(filename+".db","a+b")
-   
+            os.makedirs(self._path,exist_ok=True)
+            
+            self._datafile = open(self._path+'/gt.bin.tmp','wb')
+            self._buf = [[],[],[],[],[]]
+            self._width = 0
+            self._nsamples = 0
     
+    def _open_gt(self):
+        """
+        Memory maps the genotype matrix
+        """
+        if self._meta['nsnps'] > 0:
+            self._gt = np.memmap(self._path+'/gt.bin',dtype='B',mode='r',shape=(self._meta['nsnps'],self._meta['width']))
+        else:
+            self._gt = np.zeros((0,self._meta['width']),dtype='B')
+            
     def insert(self,data):
         """
-        Stores set of rows into the file storage
+        Stores set of rows into the storage
         
         Args:
             
-            data(dict): First storage key is the key in the dictionary. Second storage key is the first element of the inner list.
+            data(dict): Position is the key in the dictionary. The value is the record [SNP id, MAF, genotype (, alternate allele, reference allele)].
             
         Warning:
-            If all insert calls are done, the close function has to be called once to make the index persistent.
+            If all insert calls are done, the close function has to be called once to make the storage persistent.
         """
-        self._modified = True;
+        if self._meta is not None:
+            raise IOError(self._path+" is read-only")
         
-        self._datafile.seek(0,2)
+        self._modified = True
         
         for D in data:
-            I = [0,0]
-            I[0] = self._datafile.tell()
-            self._datafile.write(zlib.compress(pickle.dumps(data[D],protocol=pickle.HIGHEST_PROTOCOL)))
-            I[1] = self._datafile.tell()
-            
-            # Pos based index
-            if D not in self._idx[0]:
-                self._idx[0][D] = [ I ]
+            T = data[D]
+            
+            if self._packed:
+                G = pack_genotypes(T[2])[0]
             else:
-                self._idx[0][D].append( I )
+                G = np.asarray(T[2],dtype='B')
+                
+            self._datafile.write(G.tobytes())
             
-            # Snp based index
-            rid = data[D][0].split(";")
-            for r in rid:
-                if r not in self._idx[1]:
-                    self._idx[1][r] = [ I ]
-                else:
-                    self._idx[1][r].append( I )
+            self._buf[0].append(D)
+            self._buf[1].append(T[1])
+            self._buf[2].append(T[0])
             
-                # Snp to pos mapping
-                self._idx[2][r] = D
+            if len(T) > 3:
+                self._buf[3].append(T[3])
+                self._buf[4].append(T[4])
                 
-            
-    def get(self,pos):
+            self._width = len(G)
+            self._nsamples = len(T[2])
+    
+    def _rows(self,i,j,unpack=True):
+        """
+        Returns the records stored in rows i to j
+        """
+        E = []
+        for k in range(i,j):
+            if self._meta['alleles']:
+                E.append([self._rsid[k].decode(),float(self._maf[k]),self._genotype(k,unpack),self._alt[k].decode(),self._ref[k].decode()])
+            else:
+                E.append([self._rsid[k].decode(),float(self._maf[k]),self._genotype(k,unpack)])
+        
+        return E
+    
+    def _genotype(self,k,unpack=True):
+        if self._packed and unpack:
+            return unpack_genotypes(self._gt[k],self._nsamples)
+        else:
+            return self._gt[k]
+    
+    def _find(self,snpid):
+        """
+        Returns the rows storing the SNP id
+        """
+        key = snpid.encode()
+        i = np.searchsorted(self._sidx,key,side='left')
+        j = np.searchsorted(self._sidx,key,side='right')
+        
+        return self._srow[i:j]
+        
+    def get(self,pos,unpack=True):
         """
         Returns all stored data for a set of SNPs indexed via positions
         
         Args:
             
             pos(list): Positions of SNPs to retrieve 
+            unpack(bool): Return packed storages with unpacked genotypes
             
         """
         E = []
         for R in pos:
-            if R in self._idx[0]:
-                for p in self._idx[0][R]:
-                    self._datafile.seek(p[0])
-                    data = self._datafile.read(p[1]-p[0])
-
-                    E.append( pickle.loads(zlib.decompress(data) ) )
+            i = np.searchsorted(self._pos,R,side='left')
+            j = np.searchsorted(self._pos,R,side='right')
+            
+            if j > i:
+                E.extend(self._rows(i,j,unpack))
             else:
-                #print("Error:",R,"not found in index")
                 E.append(None)
         
         return E
@@ -131,177 +1757,560 @@ class db:
         """
         E = []
         for R in pos:
-            if R in self._idx[0]:
-                for p in self._idx[0][R]:
-                    self._datafile.seek(p[0])
-                    data = self._datafile.read(p[1]-p[0])
-
-                    E.append( pickle.loads(zlib.decompress(data) )[0] )
+            i = np.searchsorted(self._pos,R,side='left')
+            j = np.searchsorted(self._pos,R,side='right')
+            
+            if j > i:
+                for k in range(i,j):
+                    E.append(self._rsid[k].decode())
             else:
-                #print("Error:",R,"not found in index")
                 E.append(None)
         
         return E
-        
+    
     def getPosatSNPs(self,snpids):
         """
         Returns the position corresponding to a snpid
-        WARNING: Inefficient
-        """
-        positions = []
-        for snpid in snpids:
-            stop = False
-            if snpid in self._idx[1]:
-                fseek = self._idx[1][snpid]
-        
-                for pos, fs in self._idx[0].items(): 
-                    for i in range(0,len(fs)):
-                        for j in range(0,len(fseek)):
-                            if fseek[j] == fs[i]:
-                                positions.append(pos)
-                                stop = True
-                                break
-                        if stop:
-                            break
-                    if stop:
-                        break
-                            
-        return positions
-        
+        """
+        P = self.getPosatSNPsBulk(snpids)
+                
+        return P[P >= 0].tolist()
+    
     def getSNPsPos(self,snpids):
-        positions = []
-        for snpid in snpids:
-            if snpid in self._idx[2]:
-                positions.append(self._idx[2][snpid])
-            #else:
-                #positions.append(None)
+        """
+        Returns the positions corresponding to a list of snpids (of the last inserted record for SNP ids stored multiple times)
+        """
+        P = self.getPosatSNPsBulk(snpids,last=True)
         
-        return positions
-
-    def getSNPs(self,snps):
+        return P[P >= 0].tolist()
+    
+    def getPosatSNPsBulk(self,snpids,last=False):
+        """
+        Returns the positions corresponding to a list of snpids as array (-1 for snpids not in storage)
+        
+        Args:
+        
+            snpids(list): SNP ids to look up
+            last(bool): Use the last inserted row for SNP ids stored multiple times (first inserted otherwise)
+        """
+        return _lookup(self._sidx,self._spos,snpids,last)
+    
+    def getSNPs(self,snps,unpack=True):
         """
         Returns all stored data for a set of SNPs indexed via SNP ids
         
         Args:
             
             snp(list): ids of SNPs to retrieve 
+            unpack(bool): Return packed storages with unpacked genotypes
             
         """
         E = []
         for R in snps:
-            if R in self._idx[1]:
-                for p in self._idx[1][R]:
-                    self._datafile.seek(p[0])
-                    data = self._datafile.read(p[1]-p[0])
-
-                    E.append( pickle.loads(zlib.decompress(data) ) )
+            rows = self._find(R)
+            if len(rows) > 0:
+                for k in rows:
+                    E.extend(self._rows(k,k+1,unpack))
             else:
-                #print("Error:",R,"not found in index")
                 E.append(None)
         
         return E
     
+    def get_range(self,start,end,maf_min=None,rsid_filter=None,unpack=True):
+        """
+        Returns all stored data for SNPs in a position range as arrays
+        
+        Args:
+        
+            start(int): First position (inclusive)
+            end(int): Last position (inclusive)
+            maf_min(float): Only return SNPs with MAF > maf_min (None for no filter)
+            rsid_filter(set|dict): Only return SNPs with id in rsid_filter (None for no filter)
+            unpack(bool): Return packed storages with unpacked genotypes
+            
+        Returns:
+        
+            dict: Position ordered arrays 'pos', 'rsid', 'maf', 'alt', 'ref' (None if no alleles stored), 'mean', 'std' (None if no statistics stored) and the genotype matrix 'gt' (SNPs x samples)
+            
+        Note:
+        
+            Without filters, the genotype matrix is a zero-copy view of the memory mapped storage.
+        """
+        i = np.searchsorted(self._pos,start,side='left')
+        j = np.searchsorted(self._pos,end,side='right')
+        
+        return self._arrays(slice(i,j),maf_min,rsid_filter,unpack)
+    
+    def get_pos(self,pos,maf_min=None,rsid_filter=None,unpack=True):
+        """
+        Returns all stored data for a set of SNPs indexed via positions as arrays (see get_range)
+        
+        Args:
+        
+            pos(list): Positions of SNPs to retrieve
+            maf_min(float): Only return SNPs with MAF > maf_min (None for no filter)
+            rsid_filter(set|dict): Only return SNPs with id in rsid_filter (None for no filter)
+            unpack(bool): Return packed storages with unpacked genotypes
+        """
+        lo = np.searchsorted(self._pos,pos,side='left')
+        hi = np.searchsorted(self._pos,pos,side='right')
+        
+        rows = np.concatenate([np.arange(0,0)]+[np.arange(lo[k],hi[k]) for k in range(0,len(lo))])
+        
+        return self._arrays(rows,maf_min,rsid_filter,unpack)
+    
+    def _arrays(self,rows,maf_min,rsid_filter,unpack):
+        X = {}
+        X['pos'] = self._pos[rows]
+        X['maf'] = self._maf[rows]
+        X['rsid'] = np.char.decode(self._rsid[rows])
+        
+        if self._meta['alleles']:
+            X['alt'] = np.char.decode(self._alt[rows])
+            X['ref'] = np.char.decode(self._ref[rows])
+        else:
+            X['alt'] = None
+            X['ref'] = None
+        
+        if self._std is not None:
+            X['mean'] = self._mean[rows]
+            X['std'] = self._std[rows]
+        else:
+            X['mean'] = None
+            X['std'] = None
+        
+        F = _mask(X,maf_min,rsid_filter)
+        
+        if F is not None:
+            if isinstance(rows,slice):
+                rows = np.arange(rows.start,rows.stop)
+                
+            rows = rows[F]
+            for k in X:
+                if X[k] is not None:
+                    X[k] = X[k][F]
+            
+        X['gt'] = self._block(rows,unpack)
+        
+        return X
+    
+    def _block(self,rows,unpack=True):
+        if self._packed and unpack:
+            return unpack_genotypes(self._gt[rows],self._nsamples)
+        else:
+            return self._gt[rows]
+    
+    def getAlleles(self):
+        """
+        Returns the alleles of all stored SNP ids (one entry per SNP id and row)
+        
+        Returns:
+        
+            SNP ids, alternate alleles and reference alleles as arrays (alleles None if not stored)
+        """
+        S = np.char.decode(np.asarray(self._sidx))
+        
+        if not self._meta['alleles']:
+            return S, None, None
+        
+        R = np.asarray(self._srow)
+        
+        return S, np.char.decode(self._alt[R]), np.char.decode(self._ref[R])
     
     def getSNPKeys(self):
         """
         Returns the SNP ids in storage 
         """
-        return self._idx[1].keys()
+        return set(np.char.decode(np.unique(self._sidx)).tolist())
    
     def getKeys(self):
         """
         Returns SNP positions in storage
         """
-        return self._idx[0].keys()
+        return np.unique(self._pos).tolist()
    
     def getSortedKeys(self):
         """
-        Returns a sorted list of SNP positions in storage
+        Returns a sorted view of the SNP positions in storage
         """
-        return SortedList(self._idx[0].keys())
-        
+        return sortedkeys(self._pos)
+    
     def close(self):
         """
-        Closes open storage file. 
+        Closes the storage. 
         
         Warning:
-            After all inserts are done this function has to be called once to re-generate the index and close the storage file.
+            After all inserts are done this function has to be called once to sort the data by position and write the sidecar arrays.
         """
         if self._modified:
-            fp = gzip.open(self._filename+'.idx.gz','wb')
-            pickle.dump(self._idx, fp, protocol=pickle.HIGHEST_PROTOCOL)
-            fp.close()
+            self._datafile.close()
+            
+            pos = np.array(self._buf[0],dtype='int64')
+            I = np.argsort(pos,kind='stable')
+            n = len(pos)
+            
+            # Sort genotype matrix by position and compute per SNP statistics
+            gt = np.memmap(self._path+'/gt.bin.tmp',dtype='B',mode='r',shape=(n,self._width))
+            out = np.memmap(self._path+'/gt.bin',dtype='B',mode='w+',shape=(n,self._width))
+            mean = np.zeros(n,dtype='float64')
+            std = np.zeros(n,dtype='float64')
+            for k in range(0,n,65536):
+                out[k:k+65536] = gt[I[k:k+65536]]
+                
+                if self._packed:
+                    mean[k:k+65536], std[k:k+65536] = _stats(unpack_genotypes(out[k:k+65536],self._nsamples))
+                else:
+                    mean[k:k+65536], std[k:k+65536] = _stats(out[k:k+65536])
+            
+            out.flush()
+            del out
+            del gt
+            os.remove(self._path+'/gt.bin.tmp')
+            
+            rsid = np.array(self._buf[2],dtype='S')[I]
+            
+            np.save(self._path+'/pos.npy',pos[I])
+            np.save(self._path+'/maf.npy',np.array(self._buf[1],dtype='float64')[I])
+            np.save(self._path+'/mean.npy',mean)
+            np.save(self._path+'/std.npy',std)
+            np.save(self._path+'/rsid.npy',rsid)
+            
+            # SNP id index (multiple ids per row are separated by ;), in insertion order for ids stored multiple times
+            R = np.empty(n,dtype='int64')
+            R[I] = np.arange(0,n)
+            
+            sidx, srow = _tokenize(self._buf[2])
+            srow = R[srow]
+            J = np.argsort(sidx,kind='stable')
+            
+            np.save(self._path+'/sidx.npy',sidx[J])
+            np.save(self._path+'/srow.npy',srow[J])
+            np.save(self._path+'/spos.npy',pos[I][srow[J]])
+            
+            alleles = len(self._buf[3]) == n and n > 0
+            if alleles:
+                np.save(self._path+'/alt.npy',np.array(self._buf[3],dtype='S')[I])
+                np.save(self._path+'/ref.npy',np.array(self._buf[4],dtype='S')[I])
+            
+            # meta.json marks the storage as complete
+            with open(self._path+'/meta.json.tmp','w') as fp:
+                json.dump({'nsnps':n,'width':self._width,'nsamples':self._nsamples,'packed':self._packed,'alleles':alleles},fp)
+            
+            os.replace(self._path+'/meta.json.tmp',self._path+'/meta.json')
+            
+            self._buf = None
+            self._modified = False
         
-        self._idx = [{},{},{}]
+        elif self._meta is None:
+            self._datafile.close()
+            
+        self._meta = None
+        self._gt = None
         
-        # close 
-        self._datafile.close()
+    def share(self):
+        """
+        Moves the sidecar arrays into shared memory. Pickled copies of the storage (as passed to multiprocessing workers) attach to the shared blocks by name instead of loading their own copy. The genotype matrix stays memory mapped, its pages are shared between the processes via the page cache.
+        
+        Note:
+        
+            The creating process has to call release() once all workers are done.
+        """
+        _share(self)
+        
+        return self
+    
+    def release(self):
+        """
+        Closes the storage and frees its shared memory blocks (see share)
+        """
+        self.close()
+        _release(self)
         
+    def __getstate__(self):
+        return _getstate(self)
+    
+    def __setstate__(self,state):
+        if _setstate(self,state):
+            self._open_gt()
+        else:
+            self.open(self._filename)
 
-class db_subset(db):
+
+class cdb_subset(cdb):
     """
-    Class for handling storage of the raw genotype data. The data is indexed and stored for each chromosome individually as zlib compressed pickle. The indexing allows fast random access via SNP ids or positions.
+    Class for handling columnar storage of the raw genotype data. 
     
     Allows to set indices for samples to keep
     
     """
     def __init__(self,keep_idx):
-        self._modified = False;
-        self._idx = [{},{},{}]
+        self._modified = False
+        self._meta = None
+        self._packed = False
     
         self._keep = keep_idx
         
         pass
     
-    
-    def get(self,pos):
-        """
-        Returns all stored data for a set of SNPs indexed via positions
+    def open(self,filename):
+        super().open(filename)
         
-        Args:
+        if self._meta is not None:
+            self._nsamples = len(self._keep)
             
-            pos(list): Positions of SNPs to retrieve 
+            # Stored statistics refer to all samples
+            self._mean = None
+            self._std = None
+    
+    def _genotype(self,k,unpack=True):
+        if self._packed:
+            G = unpack_genotypes(self._gt[k],self._meta['nsamples'])[self._keep]
             
-        """
-        E = []
-        for R in pos:
-            if R in self._idx[0]:
-                for p in self._idx[0][R]:
-                    self._datafile.seek(p[0])
-                    data = self._datafile.read(p[1]-p[0])
-
-                    D = pickle.loads(zlib.decompress(data))
-                    D[2] = D[2][self._keep]
-                    E.append( D ) 
+            if unpack:
+                return G
             else:
-                #print("Error:",R,"not found in index")
-                E.append(None)
+                return pack_genotypes(G)[0]
+        else:
+            return self._gt[k][self._keep]
         
-        return E
+    def _block(self,rows,unpack=True):
+        if self._packed:
+            G = unpack_genotypes(self._gt[rows],self._meta['nsamples'])[:,self._keep]
+            
+            if unpack:
+                return G
+            else:
+                return pack_genotypes(G)
+        else:
+            return self._gt[rows][:,self._keep]
     
+
+def convert(filename,packed=False):
+    """
+    Converts a storage from .db/.idx.gz format into columnar .cdb format
     
-    def getSNPs(self,snps):
-        """
-        Returns all stored data for a set of SNPs indexed via SNP ids
+    Args:
         
-        Args:
+        filename(string): Name of the storage (without .db ending)
+        packed(bool): Store genotypes 2-bit packed
+        
+    """
+    src = db()
+    src.open(filename)
+    
+    dst = cdb(packed)
+    dst.open(filename)
+    
+    for pos in src.getKeys():
+        for D in src.get([pos]):
+            dst.insert({pos:D})
+    
+    dst.close()
+    src.close()
+    
+    
+def concat(parts,filename):
+    """
+    Concatenates storages into one storage. The data files are appended as they are and the indices merged.
+    
+    Args:
+    
+        parts(list): Names of the storages to concatenate
+        filename(string): Name of the storage to write (replaced if exists)
+    """
+    # Drop the previous index of the target first (it refers to the old data file)
+    for p in ['.idx','.idx.old','.idx.tmp']:
+        if os.path.isdir(filename+p):
+            shutil.rmtree(filename+p)
             
-            snp(list): ids of SNPs to retrieve 
+    if os.path.isfile(filename+'.idx.gz'):
+        os.remove(filename+'.idx.gz')
+    
+    rpos = []
+    off = []
+    tokens = []
+    trow = []
+    
+    size = 0
+    rows = 0
+    
+    with open(filename+'.db','wb') as out:
+        for p in parts:
+            src = db()
+            src.open(p)
             
-        """
-        E = []
-        for R in snps:
-            if R in self._idx[1]:
-                for p in self._idx[1][R]:
-                    self._datafile.seek(p[0])
-                    data = self._datafile.read(p[1]-p[0])
-
-                    D = pickle.loads(zlib.decompress(data))
-                    D[2] = D[2][self._keep]
-                    E.append( D ) 
-            else:
-                #print("Error:",R,"not found in index")
-                E.append(None)
+            O = _offsets(src._off).copy()
+            O[:,0:2] += size
+            
+            rpos.append(np.repeat(np.asarray(src._pos),np.diff(src._ptr)))
+            off.append(O)
+            tokens.append(np.asarray(src._sidx))
+            trow.append(np.asarray(src._srow) + rows)
+            
+            # Copy the committed part of the data file
+            src._datafile.seek(0)
+            n = src._size
+            while n > 0:
+                B = src._datafile.read(min(n,2**24))
+                out.write(B)
+                n -= len(B)
+                
+            size += src._size
+            rows += len(O)
+            
+            src.close()
+            
+        out.flush()
+        os.fsync(out.fileno())
+    
+    dst = db()
+    dst.open(filename)
+    dst._set_index(np.concatenate([np.zeros(0,dtype='int64')]+rpos),np.concatenate([np.zeros((0,3),dtype='int64')]+off),np.concatenate([np.zeros(0,dtype='S1')]+tokens),np.concatenate([np.zeros(0,dtype='int64')]+trow))
+    dst._size = size
+    dst._save_index()
+    dst.close()
+    
+
+def compact(filename):
+    """
+    Rewrites a storage without the data of removed variants and with the added sample columns merged into the records
+    
+    Args:
+    
+        filename(string): Name of the storage
         
-        return E
+    Note:
+    
+        The compacted storage is written to temporary files first. A marker file (.compact) naming them is written before the swap, such that an interrupted swap is completed on the next open.
+    """
+    src = db()
+    src.open(filename)
+    
+    if src.getCheckpoint() is not None:
+        src.close()
+        raise IOError(filename+" is not completely imported")
+    
+    tmp = filename+'.compact'+str(os.getpid())
+    
+    dst = db(src._blocksize,src._cachesize)
+    dst.open(tmp)
+    
+    rpos = np.repeat(np.asarray(src._pos),np.diff(src._ptr))
+    for i in range(0,len(rpos),4096):
+        dst.insert_many(rpos[i:i+4096].tolist(),[src._read(r) for r in range(i,min(i+4096,len(rpos)))])
+        
+    dst.commit()
+    dst.close()
+    src.close()
+    
+    # Write the marker atomically
+    with open(filename+'.compact.tmp','w') as fp:
+        json.dump({'tmp':tmp},fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+        
+    os.replace(filename+'.compact.tmp',filename+'.compact')
+    
+    _finish_compact(filename)
+    
+    
+def _finish_compact(filename):
+    """
+    Swaps in the storage written by compact (as named in the .compact marker). Each step can be repeated, such that an interrupted swap is rolled forward.
+    """
+    with open(filename+'.compact','r') as fp:
+        tmp = json.load(fp)['tmp']
+    
+    if os.path.isfile(tmp+'.db'):
+        os.replace(tmp+'.db',filename+'.db')
+    
+    if os.path.isdir(tmp+'.idx'):
+        if os.path.isdir(filename+'.idx'):
+            if os.path.isdir(filename+'.idx.old'):
+                shutil.rmtree(filename+'.idx.old')
+            
+            os.rename(filename+'.idx',filename+'.idx.old')
+        
+        os.rename(tmp+'.idx',filename+'.idx')
+    
+    for p in ['.idx.old','.idx.tmp','.cols']:
+        if os.path.isdir(filename+p):
+            shutil.rmtree(filename+p)
+            
+    if os.path.isfile(filename+'.idx.gz'):
+        os.remove(filename+'.idx.gz')
+        
+    os.remove(filename+'.compact')
+    
+
+def subset_name(filename,keep_idx):
+    """
+    Returns the name of the derived storage for a sample subset (keyed by a hash of keep_idx)
+    
+    Args:
+    
+        filename(string): Name of the storage
+        keep_idx(list): Indices of samples to keep
+    """
+    h = hashlib.sha1(np.asarray(keep_idx,dtype='int64').tobytes()).hexdigest()[:16]
+    
+    return filename+'.keep'+h
+
+
+def subset(filename,keep_idx,packed=None):
+    """
+    Materialises a sample subset of a storage once as columnar .cdb storage (see subset_name)
+    
+    Args:
     
+        filename(string): Name of the storage (.cdb is used if present, .db otherwise)
+        keep_idx(list): Indices of samples to keep
+        packed(bool): Store genotypes 2-bit packed (None to use the same as the source)
+        
+    Returns:
+    
+        string: Name of the derived storage
+        
+    Note:
+    
+        The storage is written under a temporary name and renamed when complete, such that concurrent processes can materialise the same subset.
+    """
+    name = subset_name(filename,keep_idx)
+    
+    if os.path.isfile(name+'.cdb/meta.json'):
+        return name
+    
+    if os.path.isfile(filename+'.cdb/meta.json'):
+        src = cdb_subset(keep_idx)
+    else:
+        src = db_subset(keep_idx)
+        
+    src.open(filename)
+    
+    if packed is None:
+        packed = src._packed
+    
+    tmp = name+'.'+str(os.getpid())
+    dst = cdb(packed)
+    dst.open(tmp)
+    
+    keys = np.asarray(src.getKeys())
+    for i in range(0,len(keys),4096):
+        X = src.get_range(keys[i],keys[min(i+4096,len(keys))-1])
+        
+        for k in range(0,len(X['pos'])):
+            if X['alt'] is None:
+                dst.insert({int(X['pos'][k]):[X['rsid'][k],X['maf'][k],X['gt'][k]]})
+            else:
+                dst.insert({int(X['pos'][k]):[X['rsid'][k],X['maf'][k],X['gt'][k],X['alt'][k],X['ref'][k]]})
+    
+    dst.close()
+    src.close()
+    
+    try:
+        os.rename(tmp+'.cdb',name+'.cdb')
+    except OSError:
+        # Materialised concurrently
+        shutil.rmtree(tmp+'.cdb')
+        
+    return name
@@ -0,0 +1,460 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os.path
+import struct
+import gzip
+import zlib
+import io
+
+
+class bgzf:
+    """
+    Random access reader for BGZF (bgzip) compressed files via virtual file offsets
+    
+    """
+    def __init__(self,filename):
+        self._file = open(filename,'rb')
+    
+    def _header(self,coff):
+        """
+        Reads the header of the block at compressed offset coff
+        
+        Returns:
+        
+            Header length and total block size (0,0 at the end of the file)
+        """
+        self._file.seek(coff)
+        H = self._file.read(12)
+        
+        if len(H) < 12:
+            return 0, 0
+        
+        if H[0:2] != b'\x1f\x8b' or not (H[3] & 4):
+            raise IOError("Not a BGZF file")
+        
+        xlen = struct.unpack('<H',H[10:12])[0]
+        extra = self._file.read(xlen)
+        
+        # BSIZE (total block size - 1) is stored in the BC subfield
+        bsize = None
+        k = 0
+        while k + 4 <= len(extra):
+            slen = struct.unpack('<H',extra[k+2:k+4])[0]
+            if extra[k:k+2] == b'BC':
+                bsize = struct.unpack('<H',extra[k+4:k+6])[0]
+            
+            k += 4 + slen
+        
+        if bsize is None:
+            raise IOError("Not a BGZF file")
+        
+        return 12 + xlen, bsize + 1
+    
+    def _block(self,coff):
+        """
+        Returns the decompressed data of the block at compressed offset coff and the offset of the next block
+        """
+        h, n = self._header(coff)
+        
+        if n == 0:
+            return b'', coff
+        
+        data = self._file.read(n - h)
+        
+        return zlib.decompress(data[:-8],-15), coff + n
+    
+    def blocks(self,vbeg=0,vend=None):
+        """
+        Yields the decompressed data in the virtual offset range [vbeg,vend) block by block
+        
+        Args:
+            
+            vbeg(int): Virtual start offset
+            vend(int): Virtual end offset (None for the end of the file)
+        """
+        coff = vbeg >> 16
+        start = vbeg & 0xffff
+        
+        while vend is None or coff <= (vend >> 16):
+            D, nxt = self._block(coff)
+            
+            if vend is not None and coff == (vend >> 16):
+                D = D[:vend & 0xffff]
+            
+            if len(D) > start:
+                yield D[start:]
+            
+            if nxt == coff:
+                break
+            
+            start = 0
+            coff = nxt
+    
+    def open(self,vbeg=0,vend=None):
+        """
+        Returns the virtual offset range [vbeg,vend) as text stream
+        
+        Args:
+            
+            vbeg(int): Virtual start offset
+            vend(int): Virtual end offset (None for the end of the file)
+        """
+        return io.TextIOWrapper(io.BufferedReader(_stream(self.blocks(vbeg,vend)),2**20))
+    
+    def split(self,k):
+        """
+        Splits the file at line starts into k ranges of similar compressed size. Only the block headers and one block per split point are read.
+        
+        Returns:
+        
+            list: Virtual offsets of the split points (fewer than k-1 for small files)
+        """
+        size = os.path.getsize(self._file.name)
+        
+        V = []
+        coff = 0
+        for j in range(1,k):
+            # First block at or after the target offset
+            while coff < j*size//k:
+                h, n = self._header(coff)
+                if n == 0:
+                    break
+                
+                coff += n
+            
+            # First line starting in the block (or in a following block for long lines)
+            c = coff
+            while True:
+                D, nxt = self._block(c)
+                if nxt == c or len(D) == 0:
+                    c = None
+                    break
+                
+                e = D.find(b'\n')
+                if e >= 0 and e + 1 < len(D):
+                    v = (c << 16) | (e + 1)
+                    break
+                elif e >= 0:
+                    v = nxt << 16
+                    break
+                
+                c = nxt
+            
+            if c is None:
+                break
+            
+            if len(V) == 0 or v > V[-1]:
+                V.append(v)
+            
+            coff = max(coff,v >> 16)
+        
+        # Drop split points at the end of the file
+        while len(V) > 0:
+            D, nxt = self._block(V[-1] >> 16)
+            if len(D) > (V[-1] & 0xffff):
+                break
+            
+            V.pop()
+        
+        return V
+    
+    def read(self,vbeg,vend):
+        """
+        Returns the lines starting in the virtual offset range [vbeg,vend)
+        
+        Args:
+            
+            vbeg(int): Virtual offset of the first line
+            vend(int): Virtual end offset
+        """
+        coff = vbeg >> 16
+        cend = vend >> 16
+        
+        buf = bytearray()
+        stop = None
+        
+        while True:
+            D, nxt = self._block(coff)
+            
+            if coff == cend:
+                stop = len(buf) + (vend & 0xffff)
+                
+                if stop <= (vbeg & 0xffff):
+                    return b''
+            
+            buf += D
+            
+            # Complete the last line starting before the end offset
+            if stop is not None:
+                e = buf.find(b'\n',stop-1)
+                if e >= 0:
+                    break
+            
+            if len(D) == 0:
+                e = len(buf)-1
+                break
+            
+            coff = nxt
+        
+        return bytes(buf[vbeg & 0xffff : e+1])
+        
+    def readheader(self,prefix=b'#'):
+        """
+        Returns the leading lines starting with prefix
+        """
+        H = []
+        with gzip.open(self._file.name,'rb') as f:
+            for line in f:
+                if not line.startswith(prefix):
+                    break
+                
+                H.append(line)
+        
+        return H
+    
+    def close(self):
+        self._file.close()
+
+
+class _stream(io.RawIOBase):
+    """
+    Raw stream over an iterator of byte chunks
+    """
+    def __init__(self,chunks):
+        self._chunks = chunks
+        self._buf = memoryview(b'')
+    
+    def readable(self):
+        return True
+    
+    def readinto(self,b):
+        while len(self._buf) == 0:
+            D = next(self._chunks,None)
+            if D is None:
+                return 0
+            
+            self._buf = memoryview(D)
+        
+        n = min(len(b),len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        
+        return n
+
+
+def isbgzf(filename):
+    """
+    Checks if a file is BGZF (bgzip) compressed
+    """
+    with open(filename,'rb') as f:
+        H = f.read(16)
+    
+    return len(H) == 16 and H[0:2] == b'\x1f\x8b' and (H[3] & 4) != 0 and H[12:14] == b'BC'
+
+
+class index:
+    """
+    Tabix (.tbi) or coordinate sorted (.csi) index of a BGZF compressed file
+    
+    """
+    def __init__(self,filename):
+        """
+        Args:
+            
+            filename(string): Name of the indexed file. The index is loaded from filename.tbi or filename.csi.
+        """
+        if os.path.isfile(filename+'.tbi'):
+            self._load(filename+'.tbi')
+        elif os.path.isfile(filename+'.csi'):
+            self._load(filename+'.csi')
+        else:
+            raise IOError("No .tbi or .csi index found for "+filename)
+    
+    def _load(self,filename):
+        with gzip.open(filename,'rb') as f:
+            data = f.read()
+        
+        p = 0
+        def unpack(fmt):
+            nonlocal p
+            V = struct.unpack_from(fmt,data,p)
+            p += struct.calcsize(fmt)
+            return V
+        
+        magic = data[0:4]
+        p = 4
+        
+        if magic == b'TBI\x01':
+            self._min_shift = 14
+            self._depth = 5
+            
+            n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = unpack('<8i')
+            names = data[p:p+l_nm]
+            p += l_nm
+            
+            csi = False
+        elif magic == b'CSI\x01':
+            self._min_shift, self._depth, l_aux = unpack('<3i')
+            aux = data[p:p+l_aux]
+            p += l_aux
+            
+            names = aux[28:] if l_aux >= 28 else b''
+            
+            n_ref = unpack('<i')[0]
+            
+            csi = True
+        else:
+            raise IOError(filename+" is not a tabix index")
+        
+        self.names = [x.decode() for x in names.split(b'\x00') if len(x) > 0]
+        
+        self._bins = []
+        self._linear = []
+        
+        for r in range(0,n_ref):
+            n_bin = unpack('<i')[0]
+            
+            B = {}
+            for b in range(0,n_bin):
+                if csi:
+                    bin, loffset, n_chunk = unpack('<IQi')
+                else:
+                    bin, n_chunk = unpack('<Ii')
+                
+                B[bin] = list(struct.iter_unpack('<QQ',data[p:p+16*n_chunk]))
+                p += 16*n_chunk
+            
+            self._bins.append(B)
+            
+            if csi:
+                self._linear.append([])
+            else:
+                n_intv = unpack('<i')[0]
+                self._linear.append(struct.unpack_from('<'+str(n_intv)+'Q',data,p))
+                p += 8*n_intv
+    
+    def chunks(self,name,beg,end):
+        """
+        Returns the merged virtual offset ranges of blocks which may hold records overlapping a region
+        
+        Args:
+            
+            name(string): Sequence name
+            beg(int): Start of the region (0-based, inclusive)
+            end(int): End of the region (0-based, exclusive)
+        """
+        if name not in self.names:
+            return []
+        
+        r = self.names.index(name)
+        
+        beg = max(0,beg)
+        if end <= beg:
+            return []
+        
+        # Smallest offset of records overlapping beg (linear index)
+        L = self._linear[r]
+        i = beg >> self._min_shift
+        minoff = L[i] if i < len(L) else (L[-1] if len(L) > 0 else 0)
+        
+        C = []
+        for b in _reg2bins(beg,end,self._min_shift,self._depth):
+            if b in self._bins[r]:
+                for c in self._bins[r][b]:
+                    if c[1] > minoff:
+                        C.append([max(c[0],minoff),c[1]])
+        
+        C.sort()
+        
+        # Merge overlapping ranges
+        M = []
+        for c in C:
+            if len(M) > 0 and c[0] <= M[-1][1]:
+                M[-1][1] = max(M[-1][1],c[1])
+            else:
+                M.append(c)
+        
+        return M
+
+
+def _reg2bins(beg,end,min_shift,depth):
+    """
+    Returns the bins overlapping the region [beg,end) (binning scheme of the SAM specification)
+    """
+    B = []
+    end -= 1
+    
+    s = min_shift + 3*depth
+    t = 0
+    for l in range(0,depth+1):
+        B.extend(range(t + (beg >> s),t + (end >> s) + 1))
+        
+        s -= 3
+        t += 1 << (3*l)
+    
+    return B
+
+
+class tabixfile:
+    """
+    Region queries on a bgzipped and tabix indexed text file
+    
+    """
+    def __init__(self,filename):
+        """
+        Args:
+            
+            filename(string): /path/filename of the bgzipped file (index in filename.tbi or filename.csi)
+        """
+        self._filename = filename
+        self._index = index(filename)
+        self._bgzf = bgzf(filename)
+    
+    @property
+    def names(self):
+        """
+        Sequence names in the index
+        """
+        return self._index.names
+    
+    def header(self):
+        """
+        Returns the header lines (starting with #)
+        """
+        return [x.decode() for x in self._bgzf.readheader()]
+    
+    def fetch(self,name,beg,end):
+        """
+        Returns the data lines of the blocks overlapping a region. Lines outside of the region are not removed.
+        
+        Args:
+            
+            name(string): Sequence name
+            beg(int): Start of the region (0-based, inclusive)
+            end(int): End of the region (0-based, exclusive)
+        """
+        L = []
+        for c in self._index.chunks(name,beg,end):
+            L.extend(self._bgzf.read(c[0],c[1]).decode().splitlines(True))
+        
+        return L
+    
+    def close(self):
+        self._bgzf.close()
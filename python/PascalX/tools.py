@@ -41,15 +41,59 @@ def normalInversionUpperTailApprox(p):
         a1=a;
 
     return a
+
+def normalInversionUpperTailApproxArray(p):
+    """
+    Element-wise normalInversionUpperTailApprox 
+    
+    Args:
+    
+        p(ndarray): Upper tail probabilities
+    """
+    lp = np.log(p)
+    a1 = np.ones(lp.shape)
+    
+    # Iterate each element until its own fixed point is reached
+    A = np.ones(lp.shape,dtype='bool')
+    while np.any(A):
+        a = np.sqrt((-lp[A]-np.log(np.sqrt(2*np.pi))-np.log(a1[A]))*2)
+        diff = np.abs(a-a1[A])
+        a1[A] = a
+        
+        A[A] = diff > 0.001
+        
+    return a1
     
 def chiSquared1dfInverseCumulativeProbabilityUpperTail(p):
-    p2=p/2.;
-    if p2 < 1e-14:
-        upper = normalInversionUpperTailApprox(p2);
-        return upper**2;
+    """
+    Inverse upper tail cdf of the chi2 distribution with one degree of freedom
+    
+    Args:
+    
+        p(float|ndarray): Upper tail probabilities
+        
+    Returns:
+    
+        float|ndarray: chi2 quantiles (same shape as p)
+    """
+    if np.ndim(p) == 0:
+        p2=p/2.;
+        if p2 < 1e-14:
+            upper = normalInversionUpperTailApprox(p2);
+            return upper**2;
 
-    else:
-        return chi2.ppf(1-p,1)
+        else:
+            return chi2.ppf(1-p,1)
+    
+    p = np.asarray(p,dtype='float64')
+    X = np.empty(p.shape)
+    
+    # Normal approximation in the far tail, where 1-p is not resolved 
+    T = p/2. < 1e-14
+    X[T] = normalInversionUpperTailApproxArray(p[T]/2.)**2
+    X[~T] = chi2.ppf(1-p[~T],1)
+    
+    return X
 
     
 # Note: Its slow. Better to do via C lib
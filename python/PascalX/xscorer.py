@@ -17,7 +17,7 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from PascalX import  wchissum,tools,refpanel,hpstats,genome
+from PascalX import  wchissum,tools,refpanel,hpstats,genome,snpdb,gwas
 from PascalX.mapper import mapper
 
 import numpy as np
@@ -51,7 +51,22 @@ except ModuleNotFoundError:
     cp = None
     
 
+def _match(X,Y):
+    """
+    Joins two lists of SNP ids by one sort of their (string) SNP ids. SNPs not in the reference panel are joined as well.
+    
+    Returns:
     
+        ndarray: Index of each SNP of X in Y (-1 if not in Y)
+    """
+    U, inv = np.unique(np.concatenate([np.array(X,dtype='U'),np.array(Y,dtype='U')]),return_inverse=True)
+    inv = inv.reshape(-1)
+    
+    J = np.full(len(U),-1,dtype='int64')
+    J[inv[len(X):]] = np.arange(0,len(Y))
+    
+    return J[inv[:len(X)]]
+
     
 class crosscorer(ABC):
     # Note: GWAS and MAP data is stored statically (same for all instances)
@@ -66,7 +81,7 @@ class crosscorer(ABC):
     def __init__(self):
         pass
     
-    def load_refpanel(self, filename, parallel=1,keepfile=None,qualityT=100,SNPonly=False,chrlist=None):
+    def load_refpanel(self, filename, parallel=1,keepfile=None,qualityT=100,SNPonly=False,chrlist=None,columnar=False,subsetcache=False,membudget=None,lazy=False):
         """
         Sets the reference panel to use
         
@@ -75,18 +90,22 @@ class crosscorer(ABC):
             filename(string): /path/filename (without .chr#.db ending)
             parallel(int): Number of cores to use for parallel import of reference panel
             
-            keepfile: File with sample ids (one per line) to keep (only for .vcf) 
+            keepfile: File with sample ids (one per line) to keep (only for .vcf and .bed) 
             qualityT: Quality threshold for variant to keep (only for .vcf)
-            SNPonly : Import only SNPs (only for .vcf)
+            SNPonly : Import only SNPs (only for .vcf and .bed)
             chrlist(list): List of chromosomes to import. (None to import 1-22)
+            columnar(bool|string): Convert the reference panel into memory mapped columnar storage (.chr#.cdb). Set to 'packed' for 2-bit packed genotypes.
+            subsetcache(bool): Materialise sample subsets (keep_idx) once as columnar storages on disk, keyed by a hash of keep_idx
+            membudget(int): Memory budget (bytes) for importing the reference panel (None for no limit)
+            lazy(bool): Read not imported chromosomes on demand from bgzipped and tabix indexed .chr#.vcf.gz files instead of importing them
             
         Note:
         
-            One file per chromosome with ending .chr#.db required (#: 1-22). If imported reference panel is not present, PascalX will automatically try to import from .chr#.tped.gz or .chr#.vcf.gz files.
+            One file per chromosome with ending .chr#.db required (#: 1-22). If imported reference panel is not present, PascalX will automatically try to import from .chr#.tped.gz, .chr#.vcf.gz or PLINK .chr#.bed/.bim/.fam files.
                
         """
         self._ref = refpanel.refpanel()
-        self._ref.set_refpanel(filename=filename, parallel=parallel,keepfile=keepfile,qualityT=qualityT,SNPonly=SNPonly,chrlist=chrlist)
+        self._ref.set_refpanel(filename=filename, parallel=parallel,keepfile=keepfile,qualityT=qualityT,SNPonly=SNPonly,chrlist=chrlist,columnar=columnar,subsetcache=subsetcache,membudget=membudget,lazy=lazy)
 
         
     def load_genome(self,file,ccol=1,cid=0,csymb=5,cstx=2,cetx=3,cs=4,cb=None,chrStart=0,splitchr='\t',NAgeneid='n/a',useNAgenes=False,header=False):
@@ -162,14 +181,17 @@ class crosscorer(ABC):
 
         minp = 1
 
-        if file[-3:] == '.gz':
-            f = gzip.open(file,'rt')
-        else:
-            f = open(file,'rt')
-
-        if header:
-            f.readline()
-
+        T = gwas.gwas()
+        T.load_gwas(file,rscol,pcol,bcol,a1col,a2col,idcol,delimiter=delimiter,header=header,NAid=NAid,NAcols=[bcol,pcol])
+        
+        if log10p:
+            T.p = 10**(-T.p)
+            
+        T = T.take((T.p > 0) & (T.p < 1) & (T.p < threshold))
+        
+        if len(T) > 0:
+            minp = min(minp,float(np.min(T.p)))
+            
         if idcol is None:
             nid = name
                     
@@ -179,49 +201,36 @@ class crosscorer(ABC):
             if a1col is not None and a2col is not None:
                 crosscorer._ENTITIES_a[nid] = {}    
             
-        for line in f:
-            if delimiter is None:
-                L = line.split()
-            else:
-                L = line.split(delimiter)
-
-            if L[bcol] != NAid and L[pcol] != NAid:
-                b = float(L[bcol])
-                p = float(L[pcol])
-               
-                if log10p:
-                    p = 10**(-p)
-                    
-                if p > 0 and p < 1 and p < threshold:
-
-                    if p < minp:
-                        minp = p
+            G = [nid]
+        else:
+            _, first = np.unique(T.group,return_index=True)
+            G = T.group[np.sort(first)].tolist()
+            
+            if len(T) > 0:
+                nid = T.group[-1]
+        
+        for x in G:
+            S = T if idcol is None else T.take(T.group == x)
+            
+            if not x in crosscorer._ENTITIES_p:
+                crosscorer._ENTITIES_p[x] = {}
+                crosscorer._ENTITIES_b[x] = {}
 
-                    if not idcol is None:
-                        nid = L[idcol]
+                if a1col is not None and a2col is not None:
+                    crosscorer._ENTITIES_a[x] = {}
                     
-                        if not nid in crosscorer._ENTITIES_p:
-                            crosscorer._ENTITIES_p[nid] = {}
-                            crosscorer._ENTITIES_b[nid] = {}
-
-                            if a1col is not None and a2col is not None:
-                                crosscorer._ENTITIES_a[nid] = {}
-                        
-                    #if L[rscol] in self._ENTITIES_p[nid]:
-                    #    c_test += 1
-
-                    if a1col is not None and a2col is not None:
-                        
-                        if ( len(L[a1col])==1 and len(L[a2col])==1) or (not SNPonly):
-                            crosscorer._ENTITIES_p[nid][L[rscol]] = max(p,mincutoff)
-                            crosscorer._ENTITIES_b[nid][L[rscol]] = b
-                            crosscorer._ENTITIES_a[nid][L[rscol]] = [L[a1col].upper(),L[a2col].upper()]
-                            
-                    else:
-                        crosscorer._ENTITIES_p[nid][L[rscol]] = max(p,mincutoff)
-                        crosscorer._ENTITIES_b[nid][L[rscol]] = b  
-                       
-        f.close()
+            if S.alleles is not None and SNPonly:
+                S = S.take((np.char.str_len(S.alleles[:,0]) == 1) & (np.char.str_len(S.alleles[:,1]) == 1))
+                
+            S = S.unique()
+            
+            rsid = S.rsid.tolist()
+            
+            crosscorer._ENTITIES_p[x].update(zip(rsid,np.maximum(S.p,mincutoff).tolist()))
+            crosscorer._ENTITIES_b[x].update(zip(rsid,S.beta.tolist()))
+            
+            if S.alleles is not None:
+                crosscorer._ENTITIES_a[x].update(zip(rsid,S.alleles.tolist()))
 
         # Rank
         if rank:
@@ -278,84 +287,29 @@ class crosscorer(ABC):
 
     def _calcSNPcorr(self,g,SNPs,REF,MAF=0.05):
         
+        X = REF[0].get_range(self._GENEID[g][1]-self._window,self._GENEID[g][2]+self._window,MAF,SNPs)
         
-        P = list(REF[1].irange(self._GENEID[g][1]-self._window,self._GENEID[g][2]+self._window))
-        
-        DATA = REF[0].get(list(P))     
-        
-        filtered = {}
-        #use = []
-        #RID = []
-       
         # ToDo: Check ref panel for ;
-    
-        # Sort out
-        for D in DATA:
-            # Select
-            if D is not None and D[1] > MAF and (D[0] not in filtered or D[1] < filtered[D[0]][0]) and D[0] in SNPs:
-                    filtered[D[0]] = [D[1],D[2]]
-                    #use.append(D[2])
-                    #RID.append(D[0])
-
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
-            
-        use = np.array(use)
+        X = snpdb.select_unique(X)
         
-        if len(use) > 1:
-            if self._useGPU:
-                C = cp.asnumpy(cp.corrcoef(cp.asarray(use)))
-            else:
-                C = np.corrcoef(use)
-        else:
-            C = np.ones((1,1))
-            
-        return C,np.array(RID)
+        return self._corr(X['gt']),X['rsid']
 
     def _calcSNPcorr_wAlleles(self,g,SNPs,E_A,D,MAF=0.05):
         
-        P = list(D[1].irange(self._GENEID[g][1]-self._window,self._GENEID[g][2]+self._window))
+        X = D[0].get_range(self._GENEID[g][1]-self._window,self._GENEID[g][2]+self._window,MAF,SNPs)
         
-        DATA = D[0].get(P)     
+        # Allele filter
+        if X['alt'] is None:
+            M = np.zeros(len(X['rsid']),dtype='bool')
+        else:
+            A = self._ENTITIES_a[E_A]
+            M = np.array([A[X['rsid'][i]] == [X['alt'][i],X['ref'][i]] for i in range(0,len(X['rsid']))],dtype='bool')
         
-        filtered = {}
-         
-        # Sort out
-        for D in DATA:
-            # Select
-            if D is not None and D[1] > MAF and D[0] in SNPs: # MAF filter
-                # Allele filter
-                A = self._ENTITIES_a[E_A][D[0]]
-                
-                if A[0] == D[3] and A[1] == D[4] and (D[0] not in filtered or D[1] < filtered[D[0]][0]):
-                        filtered[D[0]] = [D[1],D[2]]
-                        #use.append(D[2])
-                        #RID.append(D[0])
-                        #print(D[0],D[3],D[4],"|",A,"(match)")
-                        continue
-
-                #if A[1] == D[3] and A[0] == D[4]:
-                #    # Flip 
-                #    D[2][D[2]==0]=3
-                #    D[2][D[2]==2]=0
-                #    D[2][D[2]==3]=2
-                #    use.append(D[2])
-                #    RID.append(D[0])
-                #    Nf += 1 
-                #    #print(D[0],D[3],D[4],"|",A,"(flip)")
-                #    continue
-                
-            
-        # Calc corr
-        RID = list(filtered.keys())
-        use = []
-        for i in range(0,len(RID)):
-            use.append(filtered[RID[i]][1])
-            
-        use = np.array(use)
+        X = snpdb.select_unique(snpdb.take(X,M))
+        
+        return self._corr(X['gt']),X['rsid']
+    
+    def _corr(self,use):
         
         if len(use) > 1:
             if self._useGPU:
@@ -364,8 +318,8 @@ class crosscorer(ABC):
                 C = np.corrcoef(use)
         else:
             C = np.ones((1,1))
-        
-        return C,np.array(RID)
+            
+        return C
     
     def _calcSNPcorr_wAlleles_out(self,SNPs,E_A,D,MAF=0.05,wAlleles=True):
         DATA = D.getSNPs(SNPs)
@@ -434,9 +388,9 @@ class crosscorer(ABC):
         print(round(Na/len(DATA)*100,2),"% MAF filtered |",round(Nk/N*100,2),"% matching alleles")
 
         return C,np.array(RID),ALLELES
-    
-    
-    def matchAlleles(self,E_A,E_B,matchRefPanel=False):
+
+
+    def matchAlleles(self,E_A,E_B,matchRefPanel=False,parallel=1):
         """
         Matches alleles between two GWAS 
         (SNPs with non matching alleles are removed)
@@ -446,83 +400,46 @@ class crosscorer(ABC):
             E_A(str) : Identifier of first GWAS
             E_B(str) : Identifier of second GWAS
             matchRefPanel(bool) : Match also alleles to reference panel
-            
-        Note:
-        
-            Currently, matchRefPanel=True requires sufficient memory to load all reference panel indices into memory.
+            parallel(int) : Number of cores to use for building the allele table of the reference panel (only once per panel)
             
         """
-        
-        if matchRefPanel:
-            db = {}
-            for i in range(1,23):
-                db[i] = self._ref.load_snp_reference(i)
-        
         if len(self._ENTITIES_a[E_A]) > 0 and len(self._ENTITIES_a[E_B]) > 0:
-            Ne = 0
-            #Nf = 0
-            N = 0
-            Nr = 0
-           
-            todel = []
-            #toflip = []
-            for x in self._ENTITIES_a[E_A]:
-                if x in self._ENTITIES_a[E_B]:
-                    if self._ENTITIES_a[E_A][x] == self._ENTITIES_a[E_B][x]:
-                        # If alleles match, check if match with ref panel
-                        if matchRefPanel:
-                            found = False
-                            for c in db:
-                                snp = db[c].getSNPs([x])
-                                if len(snp) > 0:
-                                    for s in snp:
-                                        if s is not None and [s[3],s[4]] == self._ENTITIES_a[E_A][x]: 
-                                            found = True
-                                            break
-
-                                if found:
-                                    break
-
-                            if not found:
-                                # Remove if alles do not match to ref panel
-                                Nr += 1
-                                todel.append(x)
-                            
-                    else:
-                    # FLIPPING is problematic with multi-alleles
-                    #    if self._ENTITIES_a[E_A][x] == self._ENTITIES_a[E_B][x][::-1] and flip:   
-                    #        # If minor and ref/major match, flip 
-                    #        toflip.append(x)
-                    #        Nf += 1
-                    #    else:
-                    
-                        # Else delete
-                        Ne += 1
-                        todel.append(x)
-                        
-                    N +=1
-                    
-                else:
-                    # Delete if not a common
-                    todel.append(x)
+            X = list(self._ENTITIES_a[E_A].keys())
+            Y = list(self._ENTITIES_a[E_B].keys())
+            
+            J = _match(X,Y)
+            C = J >= 0
+            
+            # Alleles of the common SNPs
+            A = np.array([self._ENTITIES_a[E_A][X[k]] for k in np.flatnonzero(C)],dtype='U').reshape((-1,2))
+            B = np.array([self._ENTITIES_a[E_B][Y[k]] for k in J[C]],dtype='U').reshape((-1,2))
+            
+            E = C.copy()
+            E[C] = np.all(A == B,axis=1)
+            
+            # If alleles match, check if match with ref panel
+            R = E.copy()
+            if matchRefPanel:
+                R[E] = self._ref.matchAlleles([X[k] for k in np.flatnonzero(E)],A[E[C]],parallel)
+            
+            N = int(np.sum(C))
+            Ne = N - int(np.sum(E))
+            Nr = int(np.sum(E)) - int(np.sum(R))
+            
+            # Delete non-common SNPs, non-matching alleles (FLIPPING is problematic with multi-alleles) and SNPs not matching the ref panel
+            for k in np.flatnonzero(~R):
+                x = X[k]
                 
-            for x in todel:
-                if x in self._ENTITIES_a[E_A]:
-                    del self._ENTITIES_a[E_A][x]
-                    del self._ENTITIES_b[E_A][x]
-                    del self._ENTITIES_p[E_A][x]
+                del self._ENTITIES_a[E_A][x]
+                del self._ENTITIES_b[E_A][x]
+                del self._ENTITIES_p[E_A][x]
                 
                 if x in self._ENTITIES_a[E_B]:
                     del self._ENTITIES_a[E_B][x]
                     del self._ENTITIES_b[E_B][x]
                     del self._ENTITIES_p[E_B][x]
             
-            #for x in toflip:  
-            #    self._ENTITIES_b[E_B][x] = -self._ENTITIES_b[E_B][x]
-            #    self._ENTITIES_a[E_B][x] = self._ENTITIES_a[E_B][x][::-1]
-            
             print(N,"common SNPs")
-            #print(round(Nf/N*100,2),"% matching flipped alleles -> ", Nf,"SNPs flipped")
             print(round(Ne/N*100,2),"% non-matching alleles        -> ",Ne,"SNPs removed")     
             
             if matchRefPanel:
@@ -536,11 +453,8 @@ class crosscorer(ABC):
         else:
             print("ERROR: Allele information missing !")
     
-        if matchRefPanel:
-            del db
     
-    
-    def matchAlleles_mapper(self,E_A,E_B,matchRefPanel=False):
+    def matchAlleles_mapper(self,E_A,E_B,matchRefPanel=False,parallel=1):
         """
         Matches alleles between GWAS and Mapper loaded data 
         (SNPs with non matching alleles are removed)
@@ -549,96 +463,52 @@ class crosscorer(ABC):
             E_A(str)            : Identifier of GWAS
             E_B(str)            : Identifier of MAP
             matchRefPanel(bool) : Match also with reference panel alleles
+            parallel(int)       : Number of cores to use for building the allele table of the reference panel (only once per panel)
         """
-        
-        if matchRefPanel:
-            db = {}
-            for i in range(1,23):
-                db[i] = self._ref.load_snp_reference(i)
-        
         if len(self._ENTITIES_a[E_A]) > 0 and len(self._iMAP[E_B]) > 0:
-            Ne = 0
-            #Nf = 0
-            N = 0
-            Nr = 0
-           
-            todel = []
-            #toflip = []
-            for x in self._ENTITIES_a[E_A]:
-                if x in self._iMAP[E_B]:             
-                    # Find SNP
-                    T = self._MAP[E_B][self._iMAP[E_B][x][0]].keys()
-
-                    if x in T:
-                        L = self._MAP[E_B][self._iMAP[E_B][x][0]][x]
-                        if self._ENTITIES_a[E_A][x] == [L[1],L[2]]:
-                            # If alleles match, check if match with ref panel
-                            if matchRefPanel:
-                                found = False
-                                for c in db:
-                                    snp = db[c].getSNPs([x])
-                                    if len(snp) > 0:
-                                        for s in snp:
-                                            if s is not None and [s[3],s[4]] == self._ENTITIES_a[E_A][x]: 
-                                                found = True
-                                                break
-
-                                    if found:
-                                        break
-
-                                if not found:
-                                    # Remove if alles do not match to ref panel
-                                    Nr += 1
-                                    todel.append(x)
-
-                        else:
-                        # FLIPPING is problematic with multi-alleles
-                        #    if self._ENTITIES_a[E_A][x] == self._ENTITIES_a[E_B][x][::-1] and flip:   
-                        #        # If minor and ref/major match, flip 
-                        #        toflip.append(x)
-                        #        Nf += 1
-                        #    else:
-
-                            # Else delete
-                            Ne += 1
-                            todel.append(x)
-
-                    N +=1
-                    
-                else:
-                    # Delete if not a common
-                    todel.append(x)
+            X = list(self._ENTITIES_a[E_A].keys())
+            Y = list(self._iMAP[E_B].keys())
+            
+            J = _match(X,Y)
+            C = J >= 0
+            
+            # Mapped alleles of the common SNPs (at their first gene)
+            E = C.copy()
+            for k in np.flatnonzero(C):
+                L = self._MAP[E_B][self._iMAP[E_B][Y[J[k]]][0]].get(X[k])
+                E[k] = L is None or self._ENTITIES_a[E_A][X[k]] == [L[1],L[2]]
+            
+            # If alleles match, check if match with ref panel
+            R = E.copy()
+            if matchRefPanel:
+                I = np.flatnonzero(E)
+                R[I] = self._ref.matchAlleles([X[k] for k in I],[self._ENTITIES_a[E_A][X[k]] for k in I],parallel)
+            
+            N = int(np.sum(C))
+            Ne = N - int(np.sum(E))
+            Nr = int(np.sum(E)) - int(np.sum(R))
+            
+            # Delete non-common SNPs, non-matching alleles (FLIPPING is problematic with multi-alleles) and SNPs not matching the ref panel
+            for k in np.flatnonzero(~R):
+                x = X[k]
                 
-            for x in todel:
-                if x in self._ENTITIES_a[E_A]:
-                    del self._ENTITIES_a[E_A][x]
-                    del self._ENTITIES_b[E_A][x]
-                    del self._ENTITIES_p[E_A][x]
+                del self._ENTITIES_a[E_A][x]
+                del self._ENTITIES_b[E_A][x]
+                del self._ENTITIES_p[E_A][x]
                 
                 if x in self._iMAP[E_B]:
-                    G = self._iMAP[E_B][x]
-                    for g in G:
-                        T = self._MAP[E_B][g].keys()
-                        
-                        if x in T:
+                    for g in self._iMAP[E_B][x]:
+                        if x in self._MAP[E_B][g]:
                             del self._MAP[E_B][g][x]
                             
                     del self._iMAP[E_B][x]  
             
-            #for x in toflip:  
-            #    self._ENTITIES_b[E_B][x] = -self._ENTITIES_b[E_B][x]
-            #    self._ENTITIES_a[E_B][x] = self._ENTITIES_a[E_B][x][::-1]
-            
             print(N,"common SNPs")
-            #print(round(Nf/N*100,2),"% matching flipped alleles -> ", Nf,"SNPs flipped")
             print(round(Ne/N*100,2),"% non-matching alleles        -> ",Ne,"SNPs removed")       
             print(round(Nr/N*100,2),"% non-matching with ref panel -> ",Nr,"SNPs removed")       
             
         else:
             print("ERROR: Allele information missing !")
-    
-        if matchRefPanel:
-            del db
       
     
     def jointlyRank(self,E_A,E_B):
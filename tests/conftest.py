@@ -0,0 +1,137 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import struct
+import zlib
+
+import pytest
+
+# Python tests run against the sources in python/ (no install needed)
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','python'))
+
+
+def _bgzf_block(D):
+    C = zlib.compressobj(6,zlib.DEFLATED,-15)
+    C = C.compress(D) + C.flush()
+    
+    # gzip header with BC extra subfield holding the total block size - 1
+    return b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + struct.pack('<HccHH',6,b'B',b'C',2,len(C)+25) + C + struct.pack('<II',zlib.crc32(D),len(D))
+
+
+@pytest.fixture
+def bgzip():
+    """
+    Returns a function writing text as BGZF (bgzip) compressed file with blocks of blocksize bytes
+    """
+    def write(filename,text,blocksize=65280):
+        D = text.encode()
+        
+        with open(filename,'wb') as f:
+            for k in range(0,len(D),blocksize):
+                f.write(_bgzf_block(D[k:k+blocksize]))
+            
+            f.write(_bgzf_block(b''))
+    
+    return write
+
+
+def _reg2bin(beg,end):
+    # Smallest bin of the SAM binning scheme containing [beg,end)
+    end -= 1
+    for s,t in [(14,4681),(17,585),(20,73),(23,9),(26,1)]:
+        if beg >> s == end >> s:
+            return t + (beg >> s)
+    
+    return 0
+
+
+@pytest.fixture
+def tbi():
+    """
+    Returns a function writing a tabix index (.tbi) of a BGZF compressed VCF file
+    """
+    def write(filename):
+        with open(filename,'rb') as f:
+            data = f.read()
+        
+        # Uncompressed data and virtual offset of each uncompressed byte
+        U = []
+        V = []
+        c = 0
+        while c < len(data):
+            n = struct.unpack_from('<H',data,c+16)[0] + 1
+            D = zlib.decompress(data[c+18:c+n-8],-15)
+            
+            U.append(D)
+            V.extend((c << 16) | k for k in range(0,len(D)))
+            c += n
+        
+        V.append(c << 16)
+        U = b''.join(U)
+        
+        names = []
+        bins = []
+        linear = []
+        
+        g = 0
+        for line in U.splitlines(True):
+            beg = V[g]
+            g += len(line)
+            
+            if line[:1] == b'#':
+                continue
+            
+            L = line.split(b'\t')
+            if L[0] not in names:
+                names.append(L[0])
+                bins.append({})
+                linear.append([])
+            
+            r = names.index(L[0])
+            a = int(L[1]) - 1
+            b = a + len(L[3])
+            
+            C = bins[r].setdefault(_reg2bin(a,b),[])
+            if len(C) > 0 and C[-1][1] == beg:
+                C[-1][1] = V[g]
+            else:
+                C.append([beg,V[g]])
+            
+            for w in range(a >> 14,((b-1) >> 14)+1):
+                while len(linear[r]) <= w:
+                    linear[r].append(0)
+                if linear[r][w] == 0:
+                    linear[r][w] = beg
+        
+        nm = b''.join(x+b'\x00' for x in names)
+        I = b'TBI\x01' + struct.pack('<8i',len(names),2,1,2,0,ord('#'),0,len(nm)) + nm
+        
+        for r in range(0,len(names)):
+            I += struct.pack('<i',len(bins[r]))
+            for k in bins[r]:
+                I += struct.pack('<Ii',k,len(bins[r][k])) + b''.join(struct.pack('<QQ',*x) for x in bins[r][k])
+            
+            I += struct.pack('<i',len(linear[r])) + b''.join(struct.pack('<Q',x) for x in linear[r])
+        
+        with open(filename+'.tbi','wb') as f:
+            f.write(_bgzf_block(I)+_bgzf_block(b''))
+    
+    return write
@@ -0,0 +1,442 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+
+import numpy as np
+import pytest
+
+# Requires the compiled cores
+genescorer = pytest.importorskip('PascalX.genescorer')
+
+
+NSNPS = 240
+NSAMPLES = 60
+
+
+def _haplotypes(rng,n,m,founders=6):
+    """
+    Haplotypes copied piecewise from a few founders (gives LD between neighbouring SNPs)
+    """
+    F = rng.integers(0,2,size=(founders,n))
+    H = np.zeros((m,n),dtype='int64')
+    for i in range(0,m):
+        f = rng.integers(0,founders)
+        for k in range(0,n):
+            if rng.random() < 0.05:
+                f = rng.integers(0,founders)
+            H[i,k] = F[f,k] if rng.random() > 0.02 else 1 - F[f,k]
+    
+    return H
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    """
+    Reference panel (2 chromosomes, tped), gene annotation and two GWAS
+    """
+    path = tmp_path_factory.mktemp('scorer')
+    rng = np.random.default_rng(7)
+    
+    genes = []
+    gwas = [[],[]]
+    for c in [1,2]:
+        H = _haplotypes(rng,NSNPS,2*NSAMPLES)
+        
+        with gzip.open(str(path/('ref.chr'+str(c)+'.tped.gz')),'wt') as f:
+            for k in range(0,NSNPS):
+                f.write(str(c)+' rs'+str(c)+'_'+str(k)+' 0 '+str(1000+100*k)+' '+' '.join(str(x+1) for x in H[:,k])+'\n')
+        
+        for g in range(0,6):
+            genes.append(['ENSG'+str(c)+str(g),str(c),str(3000+3500*g),str(3800+3500*g),'+','G'+str(c)+'_'+str(g)])
+        
+        for k in range(0,NSNPS):
+            gwas[0].append(['rs'+str(c)+'_'+str(k),rng.uniform(1e-4,1)])
+            if k % 3 != 0:
+                gwas[1].append(['rs'+str(c)+'_'+str(k),rng.uniform(1e-4,1)])
+    
+    with open(str(path/'genome.txt'),'w') as f:
+        for g in genes:
+            f.write('\t'.join(g)+'\n')
+    
+    for i in range(0,2):
+        with open(str(path/('gwas'+str(i)+'.txt')),'w') as f:
+            for r in gwas[i]:
+                f.write(r[0]+'\t'+repr(r[1])+'\n')
+    
+    # Import once
+    S = genescorer.chi2sum(window=500,MAF=0.01)
+    S.load_refpanel(str(path/'ref'),chrlist=[1,2])
+    
+    return path
+
+
+def _scorer(files,gwas=0,**kwargs):
+    S = genescorer.chi2sum(window=500,MAF=0.01,**kwargs)
+    S.load_refpanel(str(files/'ref'),chrlist=[1,2])
+    S.load_genome(str(files/'genome.txt'))
+    S.load_GWAS(str(files/('gwas'+str(gwas)+'.txt')))
+    
+    return S
+
+
+def _genes():
+    return ['G'+str(c)+'_'+str(g) for c in [1,2] for g in range(0,6)]
+
+
+def test_shared_parallel_with_keep_idx(files):
+    keep = np.arange(0,NSAMPLES,2)
+    
+    S = _scorer(files)
+    R = S.score(_genes(),parallel=1,nobar=True,keep_idx=keep)
+    
+    S = _scorer(files)
+    P = S.score(_genes(),parallel=2,nobar=True,keep_idx=keep,shared=True)
+    
+    # Workers have exited before the shared blocks were released
+    assert genescorer.mp.active_children() == []
+    
+    assert len(R[0]) == len(_genes())
+    assert sorted(R[0]) == sorted(P[0])
+
+
+def test_ldcache_matches_direct_correlation(files):
+    S = _scorer(files)
+    R = dict((x[0],x[1]) for x in S.score(_genes(),nobar=True)[0])
+    
+    S = _scorer(files)
+    S.set_ldcache(2**16)
+    L = dict((x[0],x[1]) for x in S.score(_genes(),nobar=True)[0])
+    
+    assert len(R) == len(_genes())
+    assert L == pytest.approx(R,rel=1e-9)
+
+
+def test_evcache_selects_gene_snps_once(files,tmp_path,monkeypatch):
+    S = _scorer(files)
+    R = S.score(_genes(),nobar=True)[0]
+    
+    calls = []
+    select = genescorer.chi2sum._getGeneSNPs
+    monkeypatch.setattr(genescorer.chi2sum,'_getGeneSNPs',lambda self,*a,**k: calls.append(a[1]) or select(self,*a,**k))
+    
+    # Cache misses, then hits
+    for k in range(0,2):
+        S = _scorer(files)
+        S.set_evcache(str(tmp_path/'ev'))
+        
+        calls.clear()
+        assert S.score(_genes(),nobar=True)[0] == R
+        assert sorted(calls) == sorted(set(calls)) and len(calls) == len(_genes())
+
+
+def _multiallelic(path):
+    """
+    Reference panel of multi-allelic sites with different genotypes for the two alternate alleles, two genes and a GWAS per alternate allele
+    """
+    from test_refpanel import write_vcf
+    
+    rng = np.random.default_rng(5)
+    
+    L = []
+    for k in range(0,40):
+        L.append('1\t'+str(1000+100*k)+'\trs'+str(k)+'\tA\tC,G\t100\tPASS\t.\tGT\t'+'\t'.join(str(x)+'|'+str(y) for x,y in rng.integers(0,3,size=(6,2))))
+    write_vcf(str(path/'ref.chr1.vcf.gz'),L)
+    
+    with open(str(path/'genome.txt'),'w') as f:
+        f.write('ENSG0\t1\t1500\t2500\t+\tG0\nENSG1\t1\t3000\t4500\t+\tG1\n')
+    
+    p = rng.uniform(1e-4,1,size=40).tolist()
+    for a in ['C','G']:
+        with open(str(path/('gwas'+a+'.txt')),'w') as f:
+            for k in range(0,40):
+                f.write('rs'+str(k)+'\t'+repr(p[k])+'\t'+a+'\tA\n')
+
+
+def _allele_scorer(path,a=None):
+    # Scorer with the GWAS of alternate allele a (None to ignore the alleles)
+    S = genescorer.chi2sum(window=500,MAF=0.01)
+    S.load_refpanel(str(path/'ref'),chrlist=[1])
+    S.load_genome(str(path/'genome.txt'))
+    
+    if a is None:
+        S.load_GWAS(str(path/'gwasC.txt'))
+    else:
+        S.load_GWAS(str(path/('gwas'+a+'.txt')),a1col=2,a2col=3)
+        S.matchAlleles()
+    
+    return S
+
+
+def test_evcache_keys_the_variants_matching_the_gwas_alleles(tmp_path):
+    _multiallelic(tmp_path)
+    
+    def run(a,cache=None):
+        S = _allele_scorer(tmp_path,a)
+        
+        if cache is not None:
+            S.set_evcache(cache)
+            
+        return S.score(['G0','G1'],nobar=True)[0]
+    
+    E = {a: run(a) for a in ['C','G']}
+    assert E['C'] != E['G']
+    
+    # Same SNP ids, different variants
+    for a in ['C','G']:
+        assert run(a,str(tmp_path/'ev')) == E[a]
+    
+    assert len(list((tmp_path/'ev').rglob('*.npy'))) == 4
+
+
+def _assert_scores(R,E):
+    assert sorted((x[0],x[2]) for x in R) == sorted((x[0],x[2]) for x in E)
+    assert dict((x[0],x[1]) for x in R) == pytest.approx(dict((x[0],x[1]) for x in E),rel=1e-12)
+
+
+def test_score_multi_matches_score(files,tmp_path,monkeypatch):
+    E = {}
+    for k in [0,1]:
+        S = _scorer(files,gwas=k)
+        E[k] = S.score(_genes(),nobar=True)[0]
+    
+    S = _scorer(files,gwas=0)
+    S.set_evcache(str(tmp_path/'ev'))
+    T = _scorer(files,gwas=1)._GWAS
+    
+    P = S._GWAS
+    R = S.score_multi({0:P,1:T},_genes(),nobar=True)
+    
+    assert S._GWAS is P
+    for k in [0,1]:
+        _assert_scores(R[k][0],E[k])
+    
+    # The correlation matrix of a gene is only computed on a cache miss
+    calls = []
+    corr = genescorer.chi2sum._geneCorr
+    monkeypatch.setattr(genescorer.chi2sum,'_geneCorr',lambda self,*a: calls.append(a[1]) or corr(self,*a))
+    
+    R = S.score_multi({0:P,1:T},_genes(),nobar=True)
+    
+    assert calls == []
+    for k in [0,1]:
+        _assert_scores(R[k][0],E[k])
+
+
+@pytest.mark.parametrize('parallel,shared',[(1,False),(2,False),(2,True)])
+def test_score_multi_matches_score_with_gwas_alleles(tmp_path,parallel,shared):
+    _multiallelic(tmp_path)
+    
+    E = {}
+    T = {}
+    for a in ['C','G',None]:
+        S = _allele_scorer(tmp_path,a)
+        E[a] = S.score(['G0','G1'],nobar=True)[0]
+        T[a] = S._GWAS if a is None else S._GWAS_table
+    
+    assert len(E['C']) == 2 and E['C'] != E['G'] != E[None]
+    
+    # Alleles of the GWAS tables, none for p-value dicts
+    R = S.score_multi(T,['G0','G1'],parallel=parallel,shared=shared,nobar=True)
+    
+    for a in ['C','G',None]:
+        _assert_scores(R[a][0],E[a])
+
+
+def _lowrank(n=1000,r=3,seed=11):
+    rng = np.random.default_rng(seed)
+    G = rng.normal(size=(r,300))
+    X = rng.normal(size=(n,r)).dot(G) + 0.1*rng.normal(size=(n,300))
+    
+    return np.corrcoef(X)
+
+
+def test_lanczos_matches_dense():
+    C = _lowrank()
+    
+    S = genescorer.chi2sum(varcutoff=0.95)
+    D = S._calcAndFilterEV(C)
+    
+    S.set_evsolver('auto',mindim=100)
+    L, T = S._leadingEV(C)
+    assert L is not None and T == pytest.approx(np.trace(C))
+    
+    A = S._calcAndFilterEV(C)
+    assert len(A) == len(D)
+    np.testing.assert_allclose(A,D,rtol=1e-8)
+
+
+def test_dense_total_variance_is_sum_of_positive_ev():
+    # Indefinite matrix, the negative eigenvalue is not part of the total variance
+    C = np.diag([4.,3.,2.,1.,-3.])
+    
+    # (the trace 7 would only keep the leading eigenvalue)
+    S = genescorer.chi2sum(varcutoff=0.8)
+    assert S._calcAndFilterEV(C) == [4.,3.]
+
+
+def test_lanczos_failure_falls_back_to_dense(monkeypatch):
+    C = _lowrank()
+    
+    S = genescorer.chi2sum(varcutoff=0.95)
+    D = S._calcAndFilterEV(C)
+    
+    def fail(*args,**kwargs):
+        raise genescorer.ArpackNoConvergence('no convergence',[],[])
+    
+    monkeypatch.setattr(genescorer,'eigsh',fail)
+    S.set_evsolver('auto',mindim=100)
+    
+    assert S._calcAndFilterEV(C) == D
+
+
+@pytest.mark.parametrize('joint',[False,True])
+def test_lazy_panel_with_mapping_matches_import(tmp_path,bgzip,tbi,joint):
+    from test_refpanel import VCF_HEADER
+    
+    rng = np.random.default_rng(3)
+    H = _haplotypes(rng,300,12)
+    
+    L = []
+    for k in range(0,300):
+        L.append('1\t'+str(1000+400*k)+'\trs'+str(k)+'\tA\tC\t100\tPASS\t.\tGT\t'+'\t'.join(str(H[2*j,k])+'|'+str(H[2*j+1,k]) for j in range(0,6)))
+    
+    for x in ['imp','src']:
+        bgzip(str(tmp_path/(x+'.chr1.vcf.gz')),'\n'.join(VCF_HEADER+L)+'\n',2000)
+    tbi(str(tmp_path/'src.chr1.vcf.gz'))
+    
+    with open(str(tmp_path/'genome.txt'),'w') as f:
+        f.write('ENSG0\t1\t5000\t6000\t+\tG0\nENSG1\t1\t15000\t16000\t+\tG1\n')
+    
+    # Mapped SNPs outside of the gene windows (mostly in position tiles not read before)
+    with open(str(tmp_path/'map.txt'),'w') as f:
+        f.write('ENSG0\trs200\nENSG0\trs210\nENSG0\trs250\nENSG1\trs5\nENSG1\trs290\n')
+    
+    with open(str(tmp_path/'gwas.txt'),'w') as f:
+        for k in range(0,300):
+            f.write('rs'+str(k)+'\t'+repr(rng.uniform(1e-4,1))+'\n')
+    
+    R = []
+    for x,lazy in [('imp',False),('src',True)]:
+        S = genescorer.chi2sum(window=500,MAF=0.01)
+        S.load_refpanel(str(tmp_path/x),chrlist=[1],lazy=lazy)
+        S.load_genome(str(tmp_path/'genome.txt'))
+        S.load_GWAS(str(tmp_path/'gwas.txt'))
+        S.load_mapping(str(tmp_path/'map.txt'),joint=joint)
+        
+        R.append(S.score(['G0','G1'],nobar=True))
+    
+    assert not (tmp_path/'src.chr1.db').exists()
+    assert R[1][2] == []
+    assert sorted(R[0][0]) == sorted(R[1][0])
+    
+    if not joint:
+        assert sorted(x[2] for x in R[1][0]) == [2,3]
+
+
+@pytest.mark.parametrize('table',[True,False])
+@pytest.mark.parametrize('SNPonly',[False,True])
+def test_match_alleles_matches_baseline(tmp_path,capsys,table,SNPonly):
+    from test_refpanel import VCF_LINES, write_vcf
+    
+    write_vcf(str(tmp_path/'ref.chr1.vcf.gz'),VCF_LINES)
+    
+    # rs5 has the alleles of the ref panel swapped, rs8 is stored as rs7;rs8 and rs10 is not in the ref panel
+    with open(str(tmp_path/'gwas.txt'),'w') as f:
+        f.write('rs1 0.1 0.5 c a\nrs2 0.2 0.5 g a\nrs3 0.3 0.5 C AT\nrs5 0.4 0.5 A G\nrs8 0.5 0.5 G A\nrs9 0.6 0.5 T A\nrs10 0.7 0.5 C A\nrs6 0.8 0.5 G A\n')
+    
+    S = genescorer.chi2sum(window=500,MAF=0.01)
+    S.load_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    S.load_GWAS(str(tmp_path/'gwas.txt'),bcol=2,a1col=3,a2col=4)
+    
+    if not table:
+        S._GWAS_table = None
+    
+    capsys.readouterr()
+    S.matchAlleles(SNPonly=SNPonly)
+    
+    # Baseline results
+    E = ['rs1','rs2','rs8','rs9','rs6'] if SNPonly else ['rs1','rs2','rs3','rs8','rs9','rs6']
+    
+    assert list(S._GWAS) == list(S._GWAS_beta) == list(S._GWAS_alleles) == E
+    assert S._GWAS_alleles['rs1'] == ['C','A']
+    
+    if table:
+        assert S._GWAS_table.rsid.tolist() == E
+    
+    out = capsys.readouterr().out
+    assert '8 GWAS SNPs' in out
+    if SNPonly:
+        assert '1 Non-SNPs removed' in out and '42.86 % non-matching with ref panel ->  3 SNPs removed' in out
+    else:
+        assert '25.0 % non-matching with ref panel ->  2 SNPs removed' in out
+
+
+def test_load_gwas_matches_baseline(tmp_path,capsys):
+    from test_gwas import ROWS, HEADER
+    
+    with open(str(tmp_path/'gwas.txt'),'w') as f:
+        f.write('\n'.join(' '.join(r) for r in [HEADER]+ROWS))
+    
+    S = genescorer.chi2sum(window=500,MAF=0.01)
+    S.load_GWAS(str(tmp_path/'gwas.txt'),0,1,2,3,4,header=True)
+    
+    # Baseline results
+    assert S._GWAS == {'rs1':0.25,'rs3':1e-300,'rs5':1e-300,'rs7':0.01,'rs8':0.7} and list(S._GWAS) == ['rs1','rs3','rs5','rs7','rs8']
+    assert S._GWAS_beta == {'rs1':0.4,'rs3':-0.3,'rs5':0.1,'rs7':0.5,'rs8':0.6}
+    assert S._GWAS_alleles == {'rs1':['C','T'],'rs3':['C','T'],'rs5':['A','C'],'rs7':['AT','G'],'rs8':['T','C']}
+    
+    out = capsys.readouterr().out
+    assert '2 SNPs cutoff to 1e-300' in out and '5 SNPs loaded' in out
+    
+    with gzip.open(str(tmp_path/'gwas.txt.gz'),'wt') as f:
+        f.write('rs1 0.30103\nrs2 2\nrs3 400\nrs4 0\nrs1 1\n')
+    
+    S.load_GWAS(str(tmp_path/'gwas.txt.gz'),log10p=True)
+    assert S._GWAS == pytest.approx({'rs1':0.1,'rs2':0.01},rel=1e-12) and list(S._GWAS) == ['rs1','rs2']
+    assert S._GWAS_beta == {} and S._GWAS_alleles == {}
+    
+    out = capsys.readouterr().out
+    assert '1 SNPs cutoff to 1e-300' in out and '2 SNPs loaded' in out
+
+
+def test_chi2_sum_matches_scalar_transform(files):
+    from PascalX import tools
+    
+    S = _scorer(files)
+    
+    def baseline(RIDs):
+        return np.sum([tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(S._GWAS[x]) for x in RIDs])
+    
+    RIDs = list(S._GWAS)[::7]
+    assert S._getChi2Sum(RIDs) == pytest.approx(baseline(RIDs),rel=1e-12)
+    
+    S.rank()
+    assert S._getChi2Sum(RIDs) == pytest.approx(baseline(RIDs),rel=1e-12)
+    
+    # p-values edited in place or replaced after loading are transformed on the fly
+    S._GWAS[RIDs[0]] = 1e-30
+    S._GWAS[RIDs[1]] = 0.5
+    del S._GWAS[RIDs[2]]
+    
+    RIDs = RIDs[:2]+RIDs[3:]
+    assert S._getChi2Sum(RIDs) == pytest.approx(baseline(RIDs),rel=1e-12)
+    
+    S._GWAS = dict((x,1e-20) for x in S._GWAS)
+    assert S._getChi2Sum(RIDs) == pytest.approx(baseline(RIDs),rel=1e-12)
@@ -0,0 +1,132 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import gzip
+
+import numpy as np
+import pytest
+
+from PascalX import gwas
+
+
+HEADER = ['SNP','P','BETA','A1','A2']
+
+# NA in the p-value and SNP id columns, p-values outside of (0,1), non-rs ids, lower case alleles and a repeated SNP id
+ROWS = [
+    ['rs1','0.5','0.1','a','g'],
+    ['rs2','NA','0.2','A','G'],
+    ['NA','0.3','0.1','A','G'],
+    ['rs3','1e-320','-0.3','C','T'],
+    ['rs4','1','0.1','A','C'],
+    ['rs5','0','0.1','A','C'],
+    ['snp6','0.2','0.1','A','C'],
+    ['rs1','0.25','0.4','c','t'],
+    ['rs7','0.01','0.5','AT','G'],
+    ['rs9','2','0.5','A','G'],
+    ['rs8','0.7','0.6','T','C'],
+]
+
+LOADED = [0,3,4,5,6,7,8,9,10]
+
+
+def _write(path,rows,sep='\t',end='\n',header=True):
+    text = end.join(sep.join(r) for r in ([HEADER] if header else [])+rows)
+    
+    if path[-3:] == '.gz':
+        with gzip.open(path,'wt') as f:
+            f.write(text)
+    else:
+        with open(path,'w',newline='') as f:
+            f.write(text)
+
+
+@pytest.mark.parametrize('sep,delimiter',[('\t','\t'),('\t',None),(' ',None),(', ',', '),(',',',')])
+@pytest.mark.parametrize('gz',[False,True])
+@pytest.mark.parametrize('chunksize',[7,2**24])
+def test_load_gwas_columns(tmp_path,sep,delimiter,gz,chunksize):
+    fn = str(tmp_path/('gwas.txt'+('.gz' if gz else '')))
+    _write(fn,ROWS,sep)
+    
+    T = gwas.gwas()
+    T.load_gwas(fn,0,1,2,3,4,delimiter=delimiter,header=True,chunksize=chunksize)
+    
+    assert len(T) == len(LOADED)
+    assert T.rsid.tolist() == [ROWS[k][0] for k in LOADED]
+    assert T.p.tolist() == [float(ROWS[k][1]) for k in LOADED]
+    assert T.beta.tolist() == [float(ROWS[k][2]) for k in LOADED]
+    assert T.alleles.tolist() == [[ROWS[k][3].upper(),ROWS[k][4].upper()] for k in LOADED]
+    assert T.group is None and T.sid is None
+
+
+def test_load_gwas_irregular_lines(tmp_path):
+    # CRLF line ends, blank lines and additional columns in some lines
+    rows = [r+(['x'] if k % 3 == 0 else []) for k,r in enumerate(ROWS)]
+    _write(str(tmp_path/'gwas.txt'),rows,' ','\r\n',header=False)
+    
+    with open(str(tmp_path/'gwas.txt'),'a') as f:
+        f.write('\n\n')
+    
+    for chunksize in [5,2**24]:
+        T = gwas.gwas()
+        T.load_gwas(str(tmp_path/'gwas.txt'),0,1,a1col=3,a2col=4,chunksize=chunksize)
+        
+        assert T.rsid.tolist() == [ROWS[k][0] for k in LOADED]
+        assert T.alleles[:,1].tolist() == [ROWS[k][4].upper() for k in LOADED]
+        assert T.beta is None
+
+
+def test_load_gwas_na_in_other_columns(tmp_path):
+    rows = [['rs1','0.1','NA','g1'],['rs2','0.2','0.5','g2'],['rs3','NA','0.3','g1']]
+    _write(str(tmp_path/'gwas.txt'),rows,header=False)
+    
+    T = gwas.gwas()
+    T.load_gwas(str(tmp_path/'gwas.txt'),0,1,bcol=2,idcol=3)
+    assert T.rsid.tolist() == ['rs1','rs2'] and T.group.tolist() == ['g1','g2']
+    assert np.isnan(T.beta[0]) and T.beta[1] == 0.5
+    
+    T.load_gwas(str(tmp_path/'gwas.txt'),0,1,bcol=2,NAcols=[0,1,2])
+    assert T.rsid.tolist() == ['rs2']
+    
+    _write(str(tmp_path/'gwas.txt'),[['rs1','.','0.2'],['rs2','0.3','.']],header=False)
+    
+    T.load_gwas(str(tmp_path/'gwas.txt'),0,1,bcol=2,NAid='.')
+    assert T.rsid.tolist() == ['rs2'] and np.isnan(T.beta[0])
+
+
+def test_unique_take_and_ids(tmp_path):
+    _write(str(tmp_path/'gwas.txt'),ROWS)
+    
+    T = gwas.gwas()
+    T.load_gwas(str(tmp_path/'gwas.txt'),0,1,2,3,4,header=True)
+    
+    # As for repeated dict insertion: data of the last row at the position of the first one
+    U = T.unique()
+    D = {}
+    for k in LOADED:
+        D[ROWS[k][0]] = float(ROWS[k][1])
+    
+    assert U.rsid.tolist() == list(D) and U.p.tolist() == list(D.values())
+    assert U.beta[0] == 0.4 and U.alleles[0].tolist() == ['C','T']
+    
+    assert U.ids(['rs7','rs10','rs1','']).tolist() == [5,-1,0,-1]
+    assert gwas.gwas().ids(['rs1']).tolist() == [-1]
+    
+    S = U.take(U.p < 0.5)
+    assert S.rsid.tolist() == ['rs1','rs3','rs5','snp6','rs7'] and S.ids(['rs7']).tolist() == [4]
@@ -0,0 +1,483 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+
+import numpy as np
+import pytest
+
+from PascalX import refpanel
+
+
+VCF_HEADER = ['##fileformat=VCFv4.2','#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS0\tS1\tS2\tS3\tS4\tS5']
+
+# Multi-allelic sites, GT not first, uncalled and half-calls, unphased calls, non-rs ids and quality filter
+VCF_LINES = [
+    '1\t100\trs1\tA\tC\t100\tPASS\t.\tGT\t0|1\t1|1\t0|0\t0|0\t1|0\t0|0',
+    '1\t150\trs2\tA\tC,G\t100\tPASS\t.\tGT\t0|1\t2|2\t0|2\t0|0\t1|0\t.|.',
+    '1\t200\trs3\tAT\tC\t100\tPASS\t.\tDS:GT\t0.1:0|1\t0.2:1|1\t0.1:0|0\t0.3:1/1\t0:.|0\t0.5:0|1',
+    '1\t250\t.\tA\tC\t100\tPASS\t.\tGT\t0|1\t1|1\t0|0\t0|0\t1|0\t0|0',
+    '1\t300\trs4\tA\tG\t10\tq10\t.\tGT\t0|1\t1|1\t0|0\t0|0\t1|0\t0|0',
+    '1\t350\trs5\tA\tG\t10\tPASS\t.\tGT\t1|1\t1|1\t0|1\t0|0\t1|0\t0|0',
+    '1\t400\trs6\tA\tG\t100\tPASS\t.\tGT\t0|0\t0|0\t0|0\t0|0\t0|0\t0|0',
+    '1\t450\trs7;rs8\tA\tG\t100\tPASS\t.\tGT:DS\t1|0:1\t0|1:1\t1|1:2\t0|0:0\t0/0:0\t0|0:0',
+    '1\t450\trs9\tA\tT\t100\tPASS\t.\tGT\t1|0\t0|0\t0|0\t0|0\t0|0\t0|1',
+]
+
+# Records [position, SNP id, MAF, genotype, alt, ref] of the baseline importer for VCF_LINES
+VCF_RECORDS = [
+    [100,'rs1',1/3,[1,2,0,0,1,0],'C','A'],
+    [150,'rs2',1/6,[1,0,0,0,1,0],'C','A'],
+    [150,'rs2',0.25,[0,2,1,0,0,0],'G','A'],
+    [200,'rs3',0.5,[1,2,0,2,0,1],'C','AT'],
+    [350,'rs5',0.5,[2,2,1,0,1,0],'G','A'],
+    [400,'rs6',0.0,[0,0,0,0,0,0],'G','A'],
+    [450,'rs7;rs8',1/3,[1,1,2,0,0,0],'G','A'],
+    [450,'rs9',1/6,[1,0,0,0,0,1],'T','A'],
+]
+
+# Non-rs ids, monomorphic SNPs, a position stored twice, MAF > 0.5 and irregular separators
+TPED_LINES = [
+    '1 rs1 0 100 1 2 2 2 1 1 2 2 2 2 1 2',
+    '1 rs2 0 200 1 1 1 1 1 2 1 1 1 1 2 2',
+    '1 snp3 0 300 1 2 2 2 1 1 2 2 2 2 1 2',
+    '1 rs4 0 400 2 2 2 2 2 2 2 2 2 2 2 2',
+    '1\trs5\t0\t500\t1\t2\t1\t2\t2\t2\t2\t1\t1\t1\t2\t2',
+    '1 rs6 0 100 2 1 2 2 2 2 2 2 2 2 2 2',
+    '1 rs7  0 700 1 1  2 2 2 1 1 2 2 1 1 2',
+    '1 rs8 0 50 1 1 1 1 1 1 1 1 1 1 1 2',
+]
+
+# Records [position, SNP id, MAF, genotype] of the baseline importer for TPED_LINES
+TPED_RECORDS = [
+    [50,'rs8',0.083,[2,2,2,2,2,1]],
+    [100,'rs1',0.333,[1,0,2,0,0,1]],
+    [100,'rs6',0.083,[1,0,0,0,0,0]],
+    [200,'rs2',0.25,[2,2,1,2,2,0]],
+    [500,'rs5',0.417,[1,1,0,1,2,0]],
+    [700,'rs7',0.5,[2,0,1,1,1,1]],
+]
+
+
+def write_vcf(filename,lines,header=VCF_HEADER):
+    with gzip.open(filename,'wt') as f:
+        f.write('\n'.join(header+lines)+'\n')
+
+
+def records(R,cr=1):
+    """
+    Returns all records of an imported chromosome in position order
+    """
+    D = R.load_snp_reference(cr)
+    
+    E = []
+    for p in D.getSortedKeys():
+        for r in D.get([p]):
+            E.append([p,r[0],r[1],np.asarray(r[2]).tolist()]+list(r[3:]))
+    
+    D.close()
+    
+    return E
+
+
+def assert_records(E,F):
+    assert len(E) == len(F)
+    for e,f in zip(E,F):
+        assert e[0:2] == f[0:2] and e[3:] == f[3:]
+        assert e[2] == pytest.approx(f[2])
+
+
+def test_vcf_import_matches_baseline(tmp_path):
+    write_vcf(str(tmp_path/'ref.chr1.vcf.gz'),VCF_LINES)
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    assert_records(records(R),VCF_RECORDS)
+    
+    with open(str(tmp_path/'ref.sampleIds.txt')) as f:
+        assert f.read().split() == ['S0','S1','S2','S3','S4','S5']
+    
+
+def test_vcf_import_snponly(tmp_path):
+    write_vcf(str(tmp_path/'ref.chr1.vcf.gz'),VCF_LINES)
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1],SNPonly=True)
+    
+    assert_records(records(R),[x for x in VCF_RECORDS if x[1] != 'rs3'])
+
+
+def test_vcf_gt_subfield_within_sample(tmp_path):
+    # Trailing sub-fields dropped for S1 (GT is the second sub-field): S1 is not called
+    write_vcf(str(tmp_path/'ref.chr1.vcf.gz'),['1\t500\trs10\tA\tG\t100\tPASS\t.\tDS:GT\t0.1:0|1\t.\t0.1:1|1\t0.2:0|0\t0.3:0|1\t0.4:0|0'])
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    assert_records(records(R),[[500,'rs10',1/3,[1,0,2,0,1,0],'G','A']])
+
+
+def _tped_lines(n=600,m=20,seed=3):
+    rng = np.random.default_rng(seed)
+    
+    L = []
+    for k in range(0,n):
+        A = rng.integers(1,3,size=2*m)
+        L.append('1 rs'+str(k)+' 0 '+str(1000+10*(k//2))+' '+' '.join(str(x) for x in A)+'\n')
+    
+    return L
+
+
+@pytest.mark.parametrize('fmt',['tped','vcf'])
+def test_units_of_bgzip_source_match_single_unit(tmp_path,bgzip,fmt):
+    if fmt == 'tped':
+        text = ''.join(_tped_lines())
+    else:
+        rng = np.random.default_rng(4)
+        L = ['1\t'+str(1000+10*(k//2))+'\trs'+str(k)+'\tA\tC,G\t100\tPASS\t.\tGT\t'+'\t'.join(str(rng.integers(0,3))+'|'+str(rng.integers(0,3)) for j in range(0,6)) for k in range(0,600)]
+        text = '\n'.join(VCF_HEADER+L)+'\n'
+    
+    bgzip(str(tmp_path/('src.chr1.'+fmt+'.gz')),text,2000)
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'one'),chrlist=[1],sourcefilename=str(tmp_path/'src'))
+    
+    P = refpanel.refpanel()
+    P._refData = str(tmp_path/'units')
+    assert len(P._plan_units([1],str(tmp_path/'src'),fmt,3)) > 1
+    
+    P.set_refpanel(str(tmp_path/'units'),chrlist=[1],sourcefilename=str(tmp_path/'src'),parallel=3)
+    
+    assert_records(records(P),records(R))
+
+
+def test_plain_gzip_source_is_one_unit(tmp_path,capsys):
+    with gzip.open(str(tmp_path/'src.chr1.tped.gz'),'wt') as f:
+        f.write(''.join(_tped_lines()))
+    
+    R = refpanel.refpanel()
+    R._refData = str(tmp_path/'ref')
+    U = R._plan_units([1],str(tmp_path/'src'),'tped',3)
+    
+    assert len(U) == 1 and U[0][1][1:] == [None,None]
+    assert 'not bgzip compressed' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('fmt',['tped','vcf'])
+def test_worker_memory_bounds_import_peak(tmp_path,fmt):
+    import tracemalloc
+    
+    rng = np.random.default_rng(5)
+    if fmt == 'tped':
+        text = ''.join(_tped_lines(n=4000,m=100))
+    else:
+        L = ['1\t'+str(1000+10*k)+'\trs'+str(k)+'\tA\tC\t100\tPASS\t.\tGT\t'+'\t'.join(str(x)+'|'+str(y) for x,y in rng.integers(0,2,size=(100,2))) for k in range(0,4000)]
+        text = '\n'.join(VCF_HEADER[:1]+['\t'.join(VCF_HEADER[1].split('\t')[:9]+['S'+str(j) for j in range(0,100)])]+L)+'\n'
+    
+    src = str(tmp_path/('src.chr1.'+fmt+'.gz'))
+    with gzip.open(src,'wt') as f:
+        f.write(text)
+    
+    R = refpanel.refpanel()
+    R._refData = str(tmp_path/'ref')
+    R._srcData = str(tmp_path/'src')
+    R._batchbytes = 2**16
+    R._commitlines = 500
+    
+    tracemalloc.start()
+    try:
+        U = R._plan_units([1],str(tmp_path/'src'),fmt,1)[0]
+        R._import_unit(fmt,U,None,None,False,None)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    
+    # Excluding the interpreter
+    assert peak <= R._worker_memory(src,fmt) - 2**26
+
+
+def test_memory_model_terms_are_overridable(tmp_path,capsys):
+    src = str(tmp_path/'src.chr1.tped.gz')
+    with gzip.open(src,'wt') as f:
+        f.write(''.join(_tped_lines(n=400,m=100)))
+    
+    R = refpanel.refpanel()
+    M = R._worker_memory(src,'tped')
+    
+    R.set_memory_model(margin=2.5)
+    assert R._worker_memory(src,'tped') - 2**26 == pytest.approx(2*(M - 2**26),rel=1e-6)
+    
+    R.set_memory_model(base=0,margin=1)
+    R.set_memory_model(tped=0,block=0,buffered=0,stored=1,typo=1)
+    assert 'No term typo' in capsys.readouterr().out
+    assert R._worker_memory(src,'tped') == pytest.approx((M - 2**26)/1.25,rel=1e-6)
+    
+    R.set_memory_model(tped=0,block=0,buffered=0,stored=1)
+    assert R._worker_memory(src,'tped') == 400
+
+
+def test_append_variants_checks_positions_and_samples(tmp_path,capsys):
+    with gzip.open(str(tmp_path/'src.chr1.tped.gz'),'wt') as f:
+        f.write(''.join(_tped_lines(n=40,m=6)))
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1],sourcefilename=str(tmp_path/'src'))
+    
+    # Positions 1000,...,1190 are stored
+    L = ['1 rs900'+str(k)+' 0 '+str(p)+' 1 2 2 1 1 1 2 2 1 2 2 2\n' for k,p in enumerate([1100,1195,2000,2000])]
+    
+    with gzip.open(str(tmp_path/'add.chr1.tped.gz'),'wt') as f:
+        f.write(''.join(L))
+        
+    with gzip.open(str(tmp_path/'bad.chr1.tped.gz'),'wt') as f:
+        f.write(''.join(_tped_lines(n=2,m=5,seed=9)).replace(' 0 1000 ',' 0 3000 '))
+    
+    n = len(records(R))
+    
+    assert R.append_variants(1,str(tmp_path/'bad')) == 0
+    assert 'instead of' in capsys.readouterr().out
+    assert len(records(R)) == n
+    
+    assert R.append_variants(1,str(tmp_path/'add')) == 3
+    assert 'skipped' in capsys.readouterr().out
+    
+    S = records(R)
+    assert len(S) == n + 3
+    assert sorted(x[1] for x in S if x[1].startswith('rs900')) == ['rs9001','rs9002','rs9003']
+    
+    # No leftovers of the temporary import
+    assert not any('.append' in x.name for x in tmp_path.iterdir())
+
+
+def test_snpids_of_panel_without_alleles(tmp_path):
+    with gzip.open(str(tmp_path/'ref.chr1.tped.gz'),'wt') as f:
+        f.write(''.join(_tped_lines(n=20,m=6)))
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    E = sorted(set(x[1] for x in records(R)))
+    assert len(E) > 0
+    assert np.char.decode(np.asarray(R.load_snpids())).tolist() == E
+    
+    I = R.intern([E[3],'rs-1',E[0]])
+    assert I.dtype == np.int32 and I.tolist() == [3,-1,0]
+    assert R.snpnames(I[I >= 0]).tolist() == [E[3],E[0]]
+
+
+def test_match_alleles_joins_on_ids(tmp_path):
+    write_vcf(str(tmp_path/'ref.chr1.vcf.gz'),VCF_LINES)
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    X = ['rs2','rs2','rs2','rs7','rs8','rs3','rs1','rs10']
+    A = [['C','A'],['G','A'],['T','A'],['G','A'],['G','A'],['C','AT'],['A','C'],['C','A']]
+    E = [True,True,False,True,True,True,False,False]
+    
+    assert R.matchAlleles(X,A).tolist() == E
+    assert R.matchAlleles(X,A,sid=R.intern(X)).tolist() == E
+    assert R.matchAlleles([],[]).tolist() == []
+
+
+@pytest.mark.parametrize('fmt',['tped','vcf'])
+def test_interrupted_import_resumes_from_checkpoint(tmp_path,monkeypatch,fmt):
+    from PascalX import snpdb
+    
+    if fmt == 'tped':
+        with gzip.open(str(tmp_path/'src.chr1.tped.gz'),'wt') as f:
+            f.write(''.join(_tped_lines()))
+    else:
+        write_vcf(str(tmp_path/'src.chr1.vcf.gz'),VCF_LINES*40)
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'one'),chrlist=[1],sourcefilename=str(tmp_path/'src'))
+    
+    P = refpanel.refpanel()
+    P._refData = str(tmp_path/'ref')
+    P._srcData = str(tmp_path/'src')
+    P._batchbytes = 2**10
+    P._commitlines = 50
+    
+    # Interrupt after the second checkpoint
+    commit = snpdb.db.commit
+    calls = []
+    
+    def interrupted(self,checkpoint=None):
+        commit(self,checkpoint)
+        calls.append(checkpoint)
+        if len(calls) == 2:
+            raise KeyboardInterrupt
+    
+    monkeypatch.setattr(snpdb.db,'commit',interrupted)
+    
+    U = P._plan_units([1],str(tmp_path/'src'),fmt,1)[0]
+    with pytest.raises(KeyboardInterrupt):
+        P._import_unit(fmt,U,None,100,False,None)
+    
+    monkeypatch.setattr(snpdb.db,'commit',commit)
+    
+    assert calls[1]['lines'] >= 100 and not P._is_complete(str(tmp_path/'ref.chr1'))
+    
+    P._import_unit(fmt,U,None,100,False,None)
+    assert P._is_complete(str(tmp_path/'ref.chr1'))
+    
+    assert_records(records(P),records(R))
+
+
+def _write_bed(prefix,lines,alleles):
+    """
+    Writes a PLINK .bed/.bim/.fam fileset with the genotypes of tped lines (allele 1 as A1)
+    """
+    from PascalX import snpdb
+    
+    L = [line.split() for line in lines]
+    m = (len(L[0])-4)//2
+    
+    # A1 counts -> .bed codes (11 hom A2, 10 het, 00 hom A1)
+    G = np.array([[(x[4+2*j] == '1') + (x[5+2*j] == '1') for j in range(0,m)] for x in L])
+    C = np.array([3,2,0],dtype='B')[G]
+    
+    with open(prefix+'.bed','wb') as f:
+        f.write(bytes([0x6c,0x1b,1])+snpdb.pack_genotypes(C).tobytes())
+        
+    with open(prefix+'.bim','w') as f:
+        for x,a in zip(L,alleles):
+            f.write('\t'.join([x[0],x[1],x[2],x[3],a[0],a[1]])+'\n')
+            
+    with open(prefix+'.fam','w') as f:
+        for j in range(0,m):
+            f.write('F'+str(j)+' I'+str(j)+' 0 0 0 -9\n')
+
+
+def test_bed_import_matches_baseline_tped(tmp_path):
+    A = [['A','G'],['C','T'],['A','G'],['A','C'],['G','T'],['T','C'],['AT','A'],['C','G']]
+    _write_bed(str(tmp_path/'ref.chr1'),TPED_LINES,A)
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    alleles = dict((x.split()[1],a) for x,a in zip(TPED_LINES,A))
+    assert_records(records(R),[x+alleles[x[1]] for x in TPED_RECORDS])
+    
+    with open(str(tmp_path/'ref.sampleIds.txt')) as f:
+        assert f.read().split() == ['I0','I1','I2','I3','I4','I5']
+    
+    # SNPonly and keepfile (matched against the individual ids)
+    with open(str(tmp_path/'keep.txt'),'w') as f:
+        f.write('I1\tEUR\nI4\tEUR\nI5\tEUR\n')
+    
+    _write_bed(str(tmp_path/'sub.chr1'),TPED_LINES,A)
+    
+    S = refpanel.refpanel()
+    S.set_refpanel(str(tmp_path/'sub'),chrlist=[1],keepfile=str(tmp_path/'keep.txt'),SNPonly=True)
+    
+    assert [x[:2]+[x[3]] for x in records(S)] == [[50,'rs8',[2,2,1]],[100,'rs1',[0,0,1]],[200,'rs2',[2,2,0]],[500,'rs5',[1,2,0]]]
+    
+    with open(str(tmp_path/'sub.sampleIds.txt')) as f:
+        assert f.read().split() == ['I1','I4','I5']
+
+
+def test_lazy_vcf_matches_import(tmp_path,bgzip,tbi):
+    rng = np.random.default_rng(8)
+    
+    L = []
+    for k in range(0,2000):
+        G = '\t'.join(str(rng.integers(0,2))+'|'+str(rng.integers(0,2)) for j in range(0,6))
+        L.append('1\t'+str(1000+90*k)+'\trs'+str(k)+'\tA\tC,G\t'+['100\tPASS','10\tq10'][k % 7 == 3]+'\t.\tGT\t'+G)
+    L = VCF_LINES[:8] + L
+    
+    bgzip(str(tmp_path/'src.chr1.vcf.gz'),'\n'.join(VCF_HEADER+L)+'\n',4000)
+    tbi(str(tmp_path/'src.chr1.vcf.gz'))
+    
+    R = refpanel.refpanel()
+    R.set_refpanel(str(tmp_path/'imp'),chrlist=[1],sourcefilename=str(tmp_path/'src'))
+    
+    Z = refpanel.refpanel()
+    Z.set_refpanel(str(tmp_path/'lazy'),chrlist=[1],sourcefilename=str(tmp_path/'src'),lazy=True)
+    
+    assert not (tmp_path/'lazy.chr1.db').exists()
+    with open(str(tmp_path/'lazy.sampleIds.txt')) as f:
+        assert f.read().split() == ['S0','S1','S2','S3','S4','S5']
+    
+    D = R.load_snp_reference(1)
+    V = Z.load_snp_reference(1)
+    assert isinstance(V,refpanel.vcfdb)
+    
+    # SNP ids are known before their region has been read
+    assert V.getSNPsPos(['rs600','rs3','rs601','rs1999']) == D.getSNPsPos(['rs600','rs3','rs601','rs1999'])
+    assert V.getPosatSNPs(['rs600','rs2000']) == [1000+90*600]
+    assert len(V._cache) == 0
+    
+    for a,b in [(0,1000),(100,400),(50000,60000),(60000,200000),(1000+90*1999,10**6)]:
+        X = D.get_range(a,b)
+        Y = V.get_range(a,b)
+        
+        for k in ['pos','rsid','maf','alt','ref','gt']:
+            np.testing.assert_array_equal(X[k],Y[k])
+    
+    # Only the blocks of the queried tile are read
+    fetch = V._tbx.fetch
+    F = []
+    
+    def counted(*args):
+        X = fetch(*args)
+        F.extend(X)
+        return X
+    
+    V._tbx.fetch = counted
+    V._cache.clear()
+    
+    assert V.get_range(100000,101000)['pos'].tolist() == D.get_range(100000,101000)['pos'].tolist()
+    assert 0 < len(F) < len(L)//2
+    V._tbx.fetch = fetch
+    
+    assert V.getSNPsPos(['rs600']) == D.getSNPsPos(['rs600'])
+    
+    # Whole file scans apply the import filters
+    np.testing.assert_array_equal(V.getKeys(),D.getKeys())
+    assert list(V.getSortedKeys()) == list(D.getSortedKeys())
+    assert V.getSNPKeys() == D.getSNPKeys()
+    for a,b in zip(V.getAlleles(),D.getAlleles()):
+        np.testing.assert_array_equal(np.sort(a),np.sort(b))
+    
+    assert V.getPosatSNPs(['rs1500','rs7']) == D.getPosatSNPs(['rs1500','rs7'])
+    
+    V.close()
+    D.close()
+
+
+@pytest.mark.parametrize('batchbytes',[1,64,2**24])
+def test_tped_import_matches_baseline(tmp_path,batchbytes):
+    with gzip.open(str(tmp_path/'ref.chr1.tped.gz'),'wt') as f:
+        f.write('\n'.join(TPED_LINES)+'\n')
+    
+    R = refpanel.refpanel()
+    R._batchbytes = batchbytes
+    R.set_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    assert_records(records(R),TPED_RECORDS)
+    
+    # Batches of regular lines only (vectorised) and of mixed lines
+    R = refpanel._parse_tped_batch(TPED_LINES[:2]+TPED_LINES[5:6])
+    assert [[x[0],x[1][0],x[1][1],x[1][2].tolist()] for x in R] == [TPED_RECORDS[1],TPED_RECORDS[3],TPED_RECORDS[2]]
+    
+    R = refpanel._parse_tped_batch(TPED_LINES)
+    assert sorted([[x[0],x[1][0],x[1][1],x[1][2].tolist()] for x in R]) == TPED_RECORDS
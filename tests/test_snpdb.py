@@ -0,0 +1,633 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pytest
+
+from PascalX import snpdb
+
+
+# SNP ids stored at several positions, inserted out of position order
+DUPLICATES = [(300,'rs1'),(100,'rs1'),(200,'rs2;rs1'),(50,'rs2')]
+
+
+def _record(rsid,k):
+    return [rsid,0.1,np.array([k,0,1,2],dtype='B')]
+
+
+@pytest.mark.parametrize('blocksize',[None,2,256])
+def test_db_last_is_last_inserted(tmp_path,blocksize):
+    D = snpdb.db(blocksize=blocksize)
+    D.open(str(tmp_path/'chr1'))
+    for k,(p,s) in enumerate(DUPLICATES):
+        D.insert({p:_record(s,k)})
+    D.close()
+    
+    D = snpdb.db()
+    D.open(str(tmp_path/'chr1'))
+    
+    # Baseline semantics: last=True -> last inserted record, otherwise first inserted
+    assert D.getSNPsPos(['rs1','rs2','rs3']) == [200,50]
+    assert D.getPosatSNPs(['rs1','rs2','rs3']) == [300,200]
+    assert D.getPosatSNPsBulk(['rs3','rs1'],last=True).tolist() == [-1,200]
+    
+    # Records of a SNP id in insertion order
+    assert [x[2][0] for x in D.getSNPs(['rs1'])] == [0,1,2]
+    D.close()
+
+
+def test_db_last_across_commits(tmp_path):
+    D = snpdb.db()
+    D.open(str(tmp_path/'chr1'))
+    D.insert({500:_record('rs1',0)})
+    D.commit()
+    D.insert({10:_record('rs1',1)})
+    D.close()
+    
+    D = snpdb.db()
+    D.open(str(tmp_path/'chr1'))
+    assert D.getSNPsPos(['rs1']) == [10]
+    assert D.getPosatSNPs(['rs1']) == [500]
+    D.close()
+    
+
+def test_cdb_last_is_last_inserted(tmp_path):
+    D = snpdb.cdb()
+    D.open(str(tmp_path/'chr1'))
+    for k,(p,s) in enumerate(DUPLICATES):
+        D.insert({p:_record(s,k)})
+    D.close()
+    
+    D = snpdb.cdb()
+    D.open(str(tmp_path/'chr1'))
+    assert D.getSNPsPos(['rs1','rs2','rs3']) == [200,50]
+    assert D.getPosatSNPs(['rs1','rs2','rs3']) == [300,200]
+    D.close()
+
+
+def _panel(path,cls,n=40,m=12,seed=1):
+    """
+    Writes a small storage of n variants x m samples
+    """
+    rng = np.random.default_rng(seed)
+    G = rng.integers(0,3,size=(n,m)).astype('B')
+    
+    D = cls()
+    D.open(path)
+    for k in range(0,n):
+        D.insert({100+10*k:['rs'+str(k),0.25,G[k]]})
+    D.close()
+    
+    return G
+
+
+@pytest.mark.parametrize('cls,sub',[(snpdb.db,snpdb.db_subset),(snpdb.cdb,snpdb.cdb_subset)])
+@pytest.mark.parametrize('shared',[False,True])
+def test_subset_pickle_roundtrip(tmp_path,cls,sub,shared):
+    import pickle
+    
+    G = _panel(str(tmp_path/'chr1'),cls)
+    keep = np.array([0,3,4,7,11])
+    
+    D = sub(keep)
+    D.open(str(tmp_path/'chr1'))
+    if shared:
+        D.share()
+    
+    E = pickle.loads(pickle.dumps(D))
+    
+    np.testing.assert_array_equal(E._keep,keep)
+    np.testing.assert_array_equal(E.get_range(150,250)['gt'],G[5:16][:,keep])
+    np.testing.assert_array_equal(E.get([120])[0][2],G[2][keep])
+    assert E.getSNPsPos(['rs3']) == [130]
+    
+    E.close()
+    
+    if shared:
+        D.release()
+    else:
+        D.close()
+
+
+def test_cdb_share_keeps_genotypes_mapped(tmp_path):
+    import pickle
+    
+    G = _panel(str(tmp_path/'chr1'),snpdb.cdb)
+    
+    D = snpdb.cdb()
+    D.open(str(tmp_path/'chr1'))
+    D.share()
+    
+    assert '_gt' not in D._shm
+    assert isinstance(D._gt,np.memmap)
+    
+    E = pickle.loads(pickle.dumps(D))
+    assert isinstance(E._gt,np.memmap)
+    np.testing.assert_array_equal(E.get_range(0,10**6)['gt'],G)
+    
+    E.close()
+    D.release()
+
+
+def _compacted(path):
+    D = snpdb.db()
+    D.open(path)
+    R = [(p,D.get([p])[0][0],D.get([p])[0][2].tolist()) for p in D.getKeys()]
+    D.close()
+    
+    return R
+
+
+@pytest.mark.parametrize('stage',['marker','db','idx'])
+def test_interrupted_compact_rolls_forward(tmp_path,monkeypatch,stage):
+    path = str(tmp_path/'chr1')
+    G = _panel(path,snpdb.db)
+    
+    D = snpdb.db()
+    D.open(path)
+    D.remove(['rs3','rs7'])
+    D.add_samples([100,110],['rs0','rs1'],[[1,2],[0,1]])
+    D.close()
+    
+    E = [(100+10*k,'rs'+str(k),G[k].tolist()+([[1,2],[0,1]][k] if k < 2 else [0,0])) for k in range(0,40) if k not in [3,7]]
+    
+    # Interrupt the swap after the marker, the data file or the index rename
+    finish = snpdb._finish_compact
+    
+    def interrupted(filename):
+        with open(filename+'.compact','r') as fp:
+            tmp = snpdb.json.load(fp)['tmp']
+        
+        if stage != 'marker':
+            snpdb.os.replace(tmp+'.db',filename+'.db')
+        if stage == 'idx':
+            snpdb.os.rename(filename+'.idx',filename+'.idx.old')
+            
+        raise KeyboardInterrupt
+    
+    monkeypatch.setattr(snpdb,'_finish_compact',interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        snpdb.compact(path)
+    monkeypatch.setattr(snpdb,'_finish_compact',finish)
+    
+    assert _compacted(path) == E
+    assert not (tmp_path/'chr1.compact').exists() and not (tmp_path/'chr1.cols').exists()
+    assert sorted(x.name for x in tmp_path.iterdir()) == ['chr1.db','chr1.idx']
+
+
+def test_add_samples_marks_unlisted_variants_missing(tmp_path):
+    path = str(tmp_path/'chr1')
+    _panel(path,snpdb.db,n=3,m=4)
+    
+    D = snpdb.db()
+    D.open(path)
+    assert D.add_samples([110],['rs1'],[[2,1]]) == 1
+    
+    # Stored as genotype 0, counted in the MAF
+    assert D.get([100])[0][2].tolist()[4:] == [0,0]
+    assert D.get([110])[0][2].tolist()[4:] == [2,1]
+    
+    assert D.getMissing(100)[0].tolist() == [False]*4+[True,True]
+    assert D.getMissing(110)[0].tolist() == [False]*6
+    
+    # Positions not in the storage
+    assert D.getMissing(105) == []
+    assert D.getMissing(50) == []
+    assert D.getMissing(10**6) == []
+    D.close()
+
+
+@pytest.mark.parametrize('maxbytes',[2**28,3*16*16*8])
+def test_ldtiles_equal_corrcoef(maxbytes):
+    rng = np.random.default_rng(7)
+    G = rng.integers(0,3,size=(200,50)).astype('B')
+    G[17] = 1
+    
+    L = snpdb.ldtiles(tilesize=16,maxbytes=maxbytes)
+    
+    # Overlapping windows in position order
+    for a in range(0,160,15):
+        K = list(range(a,a+40))
+        C = L.corrcoef([(k,'rs'+str(k)) for k in K],G[K])
+        
+        with np.errstate(divide='ignore',invalid='ignore'):
+            E = np.corrcoef(G[K])
+        
+        np.testing.assert_allclose(C,E,rtol=0,atol=1e-12)
+        assert L._bytes <= maxbytes or len(L._tiles) == 1
+        assert L._bytes == sum(x.nbytes for x in L._tiles.values())
+
+
+def _allele_records(n=30,m=10,seed=5):
+    """
+    Returns records with alleles, inserted in reverse position order with one position stored twice
+    """
+    rng = np.random.default_rng(seed)
+    G = rng.integers(0,3,size=(n,m)).astype('B')
+    
+    P = [1000-10*k for k in range(0,n)]
+    P[7] = P[6]
+    
+    return P,[['rs'+str(k),float(np.mean(G[k]))/2,G[k],'ACGT'[k % 4],'TGCA'[k % 4]] for k in range(0,n)]
+
+
+def _as_lists(E):
+    return [None if D is None else [D[0],D[1],np.asarray(D[2]).tolist()]+list(D[3:]) for D in E]
+
+
+def test_convert_to_columnar_keeps_records(tmp_path):
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records()
+    
+    D = snpdb.db()
+    D.open(path)
+    D.insert_many(P,R)
+    D.close()
+    
+    snpdb.convert(path)
+    
+    D = snpdb.db()
+    D.open(path)
+    C = snpdb.cdb()
+    C.open(path)
+    
+    assert list(C.getKeys()) == np.asarray(D.getKeys()).tolist()
+    assert _as_lists(C.get(D.getKeys())) == _as_lists(D.get(D.getKeys()))
+    assert _as_lists(C.getSNPs(['rs6','rs7','rs99'])) == _as_lists(D.getSNPs(['rs6','rs7','rs99']))
+    assert C.getSNPsPos(['rs3','rs7']) == D.getSNPsPos(['rs3','rs7']) == [970,940]
+    assert C.getSNPatPos([940]) == ['rs6','rs7']
+    
+    for a,b in zip(C.getAlleles(),D.getAlleles()):
+        np.testing.assert_array_equal(a,b)
+    
+    # Window queries are views of the mapped genotype matrix
+    X = C.get_range(800,950)
+    assert isinstance(X['gt'],np.memmap)
+    np.testing.assert_array_equal(X['gt'],D.get_range(800,950)['gt'])
+    
+    C.close()
+    D.close()
+    
+    # Existing columnar storages are read-only
+    C = snpdb.cdb()
+    C.open(path)
+    with pytest.raises(IOError):
+        C.insert({5:R[0]})
+    C.close()
+
+
+@pytest.mark.parametrize('m',[3,4,13,67])
+def test_packed_genotypes_roundtrip_and_correlate(m):
+    rng = np.random.default_rng(m)
+    G = rng.integers(0,3,size=(9,m)).astype('B')
+    G[4] = 2
+    
+    P = snpdb.pack_genotypes(G)
+    assert P.shape == (9,(m+3)//4)
+    np.testing.assert_array_equal(snpdb.unpack_genotypes(P,m),G)
+    np.testing.assert_array_equal(snpdb.unpack_genotypes(P[3],m),G[3])
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        E = np.corrcoef(G)
+    
+    np.testing.assert_allclose(snpdb.corrcoef_packed(P,m,blocksize=64),E,rtol=0,atol=1e-12)
+
+
+def test_packed_storage_matches_unpacked(tmp_path):
+    G = _panel(str(tmp_path/'chr1'),snpdb.cdb,m=13)
+    
+    D = snpdb.cdb(packed=True)
+    D.open(str(tmp_path/'chr2'))
+    for k in range(0,len(G)):
+        D.insert({100+10*k:['rs'+str(k),0.25,G[k]]})
+    D.close()
+    
+    D = snpdb.cdb()
+    D.open(str(tmp_path/'chr2'))
+    assert D._packed and D._gt.shape == (len(G),4)
+    
+    np.testing.assert_array_equal(D.get_range(150,250)['gt'],G[5:16])
+    np.testing.assert_array_equal(D.get_range(150,250,unpack=False)['gt'],snpdb.pack_genotypes(G[5:16]))
+    np.testing.assert_array_equal(D.get([120])[0][2],G[2])
+    np.testing.assert_array_equal(D.getSNPs(['rs2'],unpack=False)[0][2],snpdb.pack_genotypes(G[2])[0])
+    D.close()
+
+
+def _legacy(path,P,R):
+    """
+    Writes a storage in the former format (zlib compressed pickle records, gzip pickled dict index)
+    """
+    import gzip
+    import pickle
+    import zlib
+    
+    idx = [{},{},{}]
+    with open(path+'.db','wb') as fp:
+        for p,D in zip(P,R):
+            I = [fp.tell(),0]
+            fp.write(zlib.compress(pickle.dumps(D,protocol=pickle.HIGHEST_PROTOCOL)))
+            I[1] = fp.tell()
+            
+            idx[0].setdefault(p,[]).append(I)
+            for r in D[0].split(";"):
+                idx[1].setdefault(r,[]).append(I)
+                idx[2][r] = p
+    
+    with gzip.open(path+'.idx.gz','wb') as fp:
+        pickle.dump(idx,fp)
+
+
+def test_legacy_index_is_converted(tmp_path):
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records()
+    R[3][0] = 'rs3;rs5'
+    _legacy(path,P,R)
+    
+    D = snpdb.db()
+    D.open(path)
+    
+    # Converted once into the binary index
+    assert (tmp_path/'chr1.idx'/'pos.npy').exists()
+    
+    E = snpdb.db()
+    E.open(path)
+    
+    for X in [D,E]:
+        assert np.asarray(X.getKeys()).tolist() == sorted(set(P))
+        assert _as_lists(X.get([940,1000,5])) == _as_lists([R[6],R[7],R[0],None])
+        assert _as_lists(X.getSNPs(['rs5'])) == _as_lists([R[3],R[5]])
+        assert X.getSNPsPos(['rs5','rs7','rs99']) == [950,940]
+        assert X.getPosatSNPs(['rs5']) == [970]
+    
+    E.close()
+    
+    # Records appended after the conversion
+    D.insert({5:R[0]})
+    D.close()
+    
+    D = snpdb.db()
+    D.open(path)
+    assert _as_lists(D.get([5,1000])) == _as_lists([R[0],R[0]])
+    assert D.getSNPsPos(['rs0']) == [5]
+    D.close()
+
+
+@pytest.mark.parametrize('codec',['zlib','zstd','lz4'])
+def test_blocks_decompressed_once_per_cache_entry(tmp_path,monkeypatch,codec):
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records(n=40)
+    
+    D = snpdb.db(blocksize=8,cachesize=2,codec=codec)
+    D.open(path)
+    D.insert_many(P,R)
+    D.close()
+    
+    # Same records as one compressed record per variant
+    E = snpdb.db(blocksize=None)
+    E.open(str(tmp_path/'chr2'))
+    E.insert_many(P,R)
+    E.commit()
+    
+    D = snpdb.db(cachesize=2)
+    D.open(path)
+    assert len(set(snpdb._offsets(D._off)[:,0].tolist())) == 5
+    assert _as_lists(D.get(D.getKeys())) == _as_lists(E.get(E.getKeys()))
+    
+    E.close()
+    D.close()
+    
+    calls = []
+    decompress = snpdb._decompress
+    
+    def counted(data):
+        calls.append(data[:1])
+        return decompress(data)
+    
+    monkeypatch.setattr(snpdb,'_decompress',counted)
+    
+    # Each block is decompressed once when read in insertion order
+    D = snpdb.db(cachesize=2)
+    D.open(path)
+    for p in P:
+        D.get([p])
+    assert len(calls) == 5 and len(D._cache) == 2
+    assert set(calls) == {snpdb._compress(b'',snpdb._codec(codec))[:1]}
+    
+    # Windows alternating between two blocks are served from the cache
+    D.get_range(P[1],P[0])
+    calls.clear()
+    for k in range(0,10):
+        D.get_range(P[39],P[39])
+        D.get_range(P[1],P[0])
+    assert len(calls) == 0
+    D.close()
+
+
+@pytest.mark.parametrize('blocksize',[None,4,256])
+def test_inserted_records_are_read_before_commit(tmp_path,blocksize):
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records()
+    
+    D = snpdb.db(blocksize=blocksize)
+    D.open(path)
+    D.insert({P[0]:R[0]})
+    assert _as_lists(D.get([P[0],P[1]])) == _as_lists([R[0],None])
+    
+    # Reads in between inserts
+    for k in range(1,len(P)):
+        D.insert({P[k]:R[k]})
+        assert _as_lists(D.getSNPs(['rs'+str(k)])) == _as_lists([R[k]])
+    
+    D.insert({10:['rs3',0.5,R[0][2]]})
+    assert D.getSNPsPos(['rs3','rs7','rs99']) == [10,P[7]]
+    assert _as_lists(D.get([P[7]])) == _as_lists([R[6],R[7]])
+    assert np.asarray(D.getKeys()).tolist() == sorted(set(P+[10]))
+    D.close()
+    
+    D = snpdb.db()
+    D.open(path)
+    assert _as_lists(D.getSNPs(['rs3'])) == _as_lists([R[3],['rs3',0.5,R[0][2]]])
+    assert _as_lists(D.get([P[29]])) == _as_lists([R[29]])
+    D.close()
+
+
+@pytest.mark.parametrize('cls',[snpdb.db,snpdb.cdb])
+def test_get_range_matches_get(tmp_path,cls):
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records()
+    
+    D = cls()
+    D.open(path)
+    for p,r in zip(P,R):
+        D.insert({p:r})
+    D.close()
+    
+    D = cls()
+    D.open(path)
+    
+    E = [r for p in [920,940,950,960] for r in D.get([p])]
+    X = D.get_range(915,960)
+    
+    assert X['pos'].tolist() == [920,940,940,950,960]
+    assert X['rsid'].tolist() == [r[0] for r in E] == ['rs8','rs6','rs7','rs5','rs4']
+    assert X['maf'].tolist() == [r[1] for r in E]
+    assert X['alt'].tolist() == [r[3] for r in E] and X['ref'].tolist() == [r[4] for r in E]
+    np.testing.assert_array_equal(X['gt'],np.array([r[2] for r in E]))
+    
+    Y = D.get_pos([960,5,920,940])
+    assert Y['pos'].tolist() == [960,920,940,940]
+    np.testing.assert_array_equal(Y['gt'],X['gt'][[4,0,1,2]])
+    
+    # Filters
+    F = D.get_range(0,2000,maf_min=0.5,rsid_filter={'rs6','rs7','rs8','rs20'})
+    assert F['rsid'].tolist() == ['rs6'] and R[20][1] == 0.5
+    np.testing.assert_array_equal(F['gt'],[R[6][2]])
+    
+    assert len(D.get_range(2000,3000)['pos']) == 0
+    
+    # Array helpers
+    Z = snpdb.merge(snpdb.take(X,[0,2]),snpdb.take(X,[1,4]))
+    assert Z['pos'].tolist() == [920,940,940,960]
+    
+    U = snpdb.select_unique(snpdb.merge(X,X))
+    assert U['rsid'].tolist() == X['rsid'].tolist()
+    D.close()
+
+
+def test_uncommitted_records_are_discarded(tmp_path):
+    import os
+    
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records()
+    
+    D = snpdb.db(blocksize=4)
+    D.open(path)
+    D.insert_many(P[:10],R[:10])
+    D.commit({'lines':10})
+    size = os.path.getsize(path+'.db')
+    
+    # Interrupted before the next commit
+    D.insert_many(P[10:20],R[10:20])
+    D._flush()
+    D._datafile.close()
+    assert os.path.getsize(path+'.db') > size
+    
+    D = snpdb.db(blocksize=4)
+    D.open(path)
+    assert D.getCheckpoint() == {'lines':10}
+    assert np.asarray(D.getKeys()).tolist() == sorted(set(P[:10]))
+    
+    D.insert_many(P[10:],R[10:])
+    D.commit()
+    D.close()
+    
+    E = snpdb.db(blocksize=None)
+    E.open(str(tmp_path/'chr2'))
+    E.insert_many(P,R)
+    E.commit()
+    
+    D = snpdb.db()
+    D.open(path)
+    assert D.getCheckpoint() is None
+    assert os.path.getsize(path+'.db') == D._size
+    assert _as_lists(D.get(D.getKeys())) == _as_lists(E.get(E.getKeys()))
+    assert _as_lists(D.getSNPs(['rs12'])) == _as_lists([R[12]])
+    D.close()
+    E.close()
+
+
+@pytest.mark.parametrize('packed',[False,True])
+def test_columnar_statistics_match_genotypes(tmp_path,packed):
+    rng = np.random.default_rng(2)
+    G = rng.integers(0,3,size=(40,13)).astype('B')
+    G[5] = 1
+    
+    D = snpdb.cdb(packed)
+    D.open(str(tmp_path/'chr2'))
+    for k in range(0,len(G)):
+        D.insert({100+10*k:['rs'+str(k),0.25,G[k]]})
+    D.close()
+    
+    D = snpdb.cdb()
+    D.open(str(tmp_path/'chr2'))
+    X = D.get_range(0,10**6)
+    
+    np.testing.assert_allclose(X['mean'],G.mean(axis=1),rtol=0,atol=1e-12)
+    np.testing.assert_allclose(X['std'],G.std(axis=1),rtol=0,atol=1e-12)
+    assert X['std'][5] == 0
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        E = np.corrcoef(G)
+        
+    C = snpdb.corrcoef_stats(X['gt'],X['mean'],X['std'])
+    np.testing.assert_allclose(C,E,rtol=0,atol=1e-12)
+    assert np.all(np.isnan(C[5]))
+    D.close()
+    
+    # Row based storages do not store statistics
+    D = snpdb.db()
+    D.open(str(tmp_path/'chr3'))
+    D.insert({100:['rs0',0.25,G[0]]})
+    D.close()
+    
+    D = snpdb.db()
+    D.open(str(tmp_path/'chr3'))
+    assert D.get_range(0,10**6)['std'] is None
+    D.close()
+
+
+@pytest.mark.parametrize('cls,sub',[(snpdb.db,snpdb.db_subset),(lambda: snpdb.cdb(True),snpdb.cdb_subset)])
+def test_materialised_subset_matches_subset_view(tmp_path,cls,sub):
+    import os
+    
+    path = str(tmp_path/'chr1')
+    P, R = _allele_records(n=40,m=11)
+    
+    D = cls()
+    D.open(path)
+    for p,r in zip(P,R):
+        D.insert({p:r})
+    D.close()
+    
+    keep = [10,0,3,4]
+    name = snpdb.subset(path,keep)
+    assert name == snpdb.subset_name(path,keep) != snpdb.subset_name(path,[0,3,4,10])
+    
+    # Materialised once
+    t = os.path.getmtime(name+'.cdb/gt.bin')
+    assert snpdb.subset(path,keep) == name and os.path.getmtime(name+'.cdb/gt.bin') == t
+    
+    V = sub(np.array(keep))
+    V.open(path)
+    S = snpdb.cdb()
+    S.open(name)
+    
+    X = V.get_range(0,10**6)
+    Y = S.get_range(0,10**6)
+    
+    assert S._packed == V._packed
+    for k in ['pos','rsid','maf','alt','ref','gt']:
+        np.testing.assert_array_equal(X[k],Y[k])
+    
+    np.testing.assert_array_equal(Y['gt'],np.array([R[k][2] for k in sorted(range(0,40),key=lambda k: P[k])])[:,keep])
+    np.testing.assert_allclose(Y['mean'],Y['gt'].mean(axis=1),rtol=0,atol=1e-12)
+    assert _as_lists(V.get([940])) == _as_lists(S.get([940]))
+    
+    S.close()
+    V.close()
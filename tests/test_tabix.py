@@ -0,0 +1,88 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+
+import pytest
+
+from PascalX import tabix
+
+
+TEXT = ''.join('1\t'+str(100+k)+'\trs'+str(k)+'\t'+'x'*(k % 37)+'\n' for k in range(0,2000))
+
+
+@pytest.mark.parametrize('blocksize',[100,997,65280])
+@pytest.mark.parametrize('k',[1,2,7,50])
+def test_bgzf_split_ranges_cover_all_lines(tmp_path,bgzip,blocksize,k):
+    fn = str(tmp_path/'x.gz')
+    bgzip(fn,TEXT,blocksize)
+    
+    assert tabix.isbgzf(fn)
+    
+    B = tabix.bgzf(fn)
+    V = B.split(k)
+    
+    assert len(V) <= k-1
+    assert V == sorted(set(V))
+    
+    # Split points are line starts and the ranges give back the file
+    V = [0] + V + [None]
+    parts = [B.open(V[j],V[j+1]).read() for j in range(0,len(V)-1)]
+    
+    assert ''.join(parts) == TEXT
+    assert all(len(p) > 0 and p[-1] == '\n' for p in parts)
+    
+    B.close()
+
+
+def test_isbgzf_plain_gzip(tmp_path):
+    fn = str(tmp_path/'x.gz')
+    with gzip.open(fn,'wt') as f:
+        f.write(TEXT)
+    
+    assert not tabix.isbgzf(fn)
+
+
+@pytest.mark.parametrize('region',[(0,50),(99,100),(5000,9000),(130000,260000),(2**20,2**20+10**5),(10**7,10**7+1)])
+def test_fetch_returns_lines_overlapping_region(tmp_path,bgzip,tbi,region):
+    # Two sequences, variants 700bp apart and a long deletion spanning several 16kb windows
+    L = ['#CHROM\tPOS\tID\tREF\tALT']
+    for c in ['1','2']:
+        for k in range(0,3000):
+            L.append(c+'\t'+str(100+700*k)+'\trs'+str(k)+'\t'+('A'*40000 if k == 150 else 'A')+'\tC')
+    
+    fn = str(tmp_path/'x.vcf.gz')
+    bgzip(fn,'\n'.join(L)+'\n',2000)
+    tbi(fn)
+    
+    T = tabix.tabixfile(fn)
+    assert T.names == ['1','2'] and T.header() == [L[0]+'\n']
+    
+    beg, end = region
+    F = T.fetch('2',beg,end)
+    
+    E = [x+'\n' for x in L[3001:] if int(x.split('\t')[1])-1 < end and int(x.split('\t')[1])-1+len(x.split('\t')[3]) > beg]
+    
+    # All overlapping lines, only few others and none of the other sequence
+    assert [x for x in F if x in E] == E
+    assert all(x[:2] == '2\t' for x in F)
+    assert len(F) <= len(E) + 100
+    
+    assert T.fetch('3',0,10**6) == []
+    T.close()
@@ -0,0 +1,47 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import numpy as np
+import pytest
+
+tools = pytest.importorskip('PascalX.tools')
+
+
+def test_chi2_inverse_array_matches_scalar():
+    # Both sides of the switch to the normal approximation (p/2 < 1e-14)
+    p = np.concatenate([np.logspace(-300,-20,50),[2e-14,1.99e-14,2.01e-14,2e-13],np.linspace(1e-6,1-1e-6,101),[1e-300,0.5]])
+    
+    X = tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(p)
+    E = [tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(x) for x in p.tolist()]
+    
+    assert X.shape == p.shape
+    np.testing.assert_allclose(X,E,rtol=1e-12,atol=0)
+    
+    # Shape of the input is kept
+    Y = tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(p[:100].reshape((10,10)))
+    np.testing.assert_array_equal(Y,X[:100].reshape((10,10)))
+    
+    assert tools.chiSquared1dfInverseCumulativeProbabilityUpperTail(np.zeros(0)).shape == (0,)
+    
+    
+def test_normal_inversion_array_matches_scalar():
+    p = np.logspace(-300,-14,40)
+    
+    np.testing.assert_allclose(tools.normalInversionUpperTailApproxArray(p),[tools.normalInversionUpperTailApprox(x) for x in p],rtol=1e-12,atol=0)
@@ -0,0 +1,92 @@
+#    PascalX - A python3 library for high precision gene and pathway scoring for 
+#              GWAS summary statistics with C++ backend.
+#              https://github.com/BergmannLab/PascalX
+#
+#    Copyright (C) 2021 Bergmann lab and contributors
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from PascalX.mapper import mapper
+
+from test_refpanel import VCF_LINES, write_vcf
+
+xscorer = pytest.importorskip('PascalX.xscorer')
+
+
+def _gwas(path,rows):
+    with open(path,'w') as f:
+        for r in rows:
+            f.write('\t'.join(r)+'\n')
+
+
+@pytest.fixture
+def scorer(tmp_path):
+    write_vcf(str(tmp_path/'ref.chr1.vcf.gz'),VCF_LINES)
+    
+    X = xscorer.zsum(window=500,MAF=0.01)
+    X.load_refpanel(str(tmp_path/'ref'),chrlist=[1])
+    
+    # rs2 differs between the GWAS, rs5 has the alleles of the ref panel swapped
+    _gwas(str(tmp_path/'a.txt'),[['rs1','0.1','1','C','A'],['rs2','0.2','1','G','A'],['rs3','0.3','1','C','AT'],['rs5','0.4','1','A','G'],['rs10','0.5','1','C','A']])
+    _gwas(str(tmp_path/'b.txt'),[['rs1','0.1','1','C','A'],['rs2','0.2','1','C','A'],['rs3','0.3','1','C','AT'],['rs5','0.4','1','A','G'],['rs11','0.5','1','C','A']])
+    
+    name = tmp_path.name
+    X.load_GWAS(str(tmp_path/'a.txt'),a1col=3,a2col=4,name=name+'A')
+    X.load_GWAS(str(tmp_path/'b.txt'),a1col=3,a2col=4,name=name+'B')
+    
+    yield X, name
+    
+    for x in [name+'A',name+'B',name+'M']:
+        for E in [X._ENTITIES_p,X._ENTITIES_b,X._ENTITIES_a,X._MAP,X._iMAP]:
+            E.pop(x,None)
+
+
+def test_match_joins_snp_ids():
+    assert xscorer._match(['rs3','x1','rs1','rs9'],['rs1','rs3','x1']).tolist() == [1,2,0,-1]
+    assert xscorer._match([],['rs1']).tolist() == []
+
+
+@pytest.mark.parametrize('ref',[False,True])
+def test_match_alleles_of_two_gwas(scorer,capsys,ref):
+    X, name = scorer
+    
+    X.matchAlleles(name+'A',name+'B',matchRefPanel=ref)
+    
+    out = capsys.readouterr().out
+    assert '4 common SNPs' in out
+    
+    assert sorted(X._ENTITIES_p[name+'A']) == (['rs1','rs3'] if ref else ['rs1','rs3','rs5'])
+    assert sorted(X._ENTITIES_a[name+'B']) == (['rs1','rs11','rs3'] if ref else ['rs1','rs11','rs3','rs5'])
+    assert sorted(X._ENTITIES_b[name+'B']) == sorted(X._ENTITIES_a[name+'B'])
+
+
+def test_match_alleles_with_mapper(scorer,tmp_path,capsys):
+    X, name = scorer
+    
+    with open(str(tmp_path/'map.txt'),'w') as f:
+        f.write('G1\trs1\tC\tA\nG1\trs2\tC\tA\nG2\trs2\tC\tA\nG2\trs5\tA\tG\n')
+    
+    M = mapper()
+    M.load_mapping(str(tmp_path/'map.txt'),a1col=2,a2col=3)
+    X._MAP[name+'M'] = M._GENEIDtoSNP
+    X._iMAP[name+'M'] = M._SNPtoGENEID
+    
+    X.matchAlleles_mapper(name+'A',name+'M',matchRefPanel=True)
+    
+    assert '3 common SNPs' in capsys.readouterr().out
+    assert sorted(X._ENTITIES_p[name+'A']) == ['rs1']
+    assert sorted(X._iMAP[name+'M']) == ['rs1']
+    assert X._MAP[name+'M'] == {'G1':{'rs1':[None,'C','A',None,None]},'G2':{}}